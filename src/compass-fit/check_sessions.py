@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+ check_sessions.py - checks the LAMMPS sessions of lammps.py against running
+                     LAMMPS once per frame, with fake_lmp.py in place of
+                     LAMMPS, so that the stdin protocol, the parsing of the
+                     thermo output and the reloading of the data file can be
+                     exercised without LAMMPS.
+
+    SYNOPSIS
+
+      check_sessions.py [basename] [frc_path]
+
+    DESCRIPTION
+
+      Converts basename (default runs/amide-rings/amide-rings) in a scratch
+      directory with the frc file frc_path (default data/compass.frc), then
+      computes the energies of the first frames of basename.arc on a
+      FramePool of 2 workers, twice, with the coefficients of a bond type
+      changed in between:
+
+        - launching fake_lmp.py for each frame,
+        - with a fake_lmp.py process session per worker (ProcessSession),
+        - with the fake LAMMPS Python module per worker (ModuleSession).
+
+      The energies and the thermo output of the last frame of the sessions
+      must equal those of the runs per frame, exactly for process sessions
+      as they parse the same text.  The sessions must read the data file
+      once per worker and evaluation.  Prints FAILED and exits with 1
+      otherwise.
+"""
+import os
+import sys
+import glob
+import shutil
+import signal
+import tempfile
+from run_msi2lmp import pymsi2lmp
+import frc
+import lammps
+from discover_output import read_arc_file
+from numpy import allclose, array_equal
+
+here  = os.path.dirname(os.path.abspath(__file__))
+# fake_lmp.py is run by this interpreter, whatever python is on the path.
+fake  = [sys.executable, os.path.join(here, 'fake_lmp.py')]
+default_model = os.path.join(here, '..', '..', 'runs', 'amide-rings', 'amide-rings')
+default_frc   = os.path.join(here, '..', '..', 'data', 'compass.frc')
+workers, frames = 2, 6
+
+# Returns the number of data files read by fake_lmp.py in the scratch
+# directories of pool and in the working directory.
+def data_reads(pool):
+    paths = glob.glob(os.path.join(pool.root, '*', 'fake_lmp.reads'))
+    return sum(len(open(p).readlines()) for p in paths + glob.glob('fake_lmp.reads'))
+
+# Returns the energies, the thermo output of the last frame and the number
+# of data files read for each set of parameters in compass (frc.Frc list).
+def evaluate(session, base, x, compass, use_session):
+    pool, results = lammps.FramePool(fake, workers, use_session), []
+    try:
+        for f in compass:
+            session.convert(f)
+            reads  = data_reads(pool)
+            energy = pool.energies(base, x)
+            results.append((energy, pool.thermo, data_reads(pool) - reads))
+    finally:
+        pool.close()
+    return results
+
+# Returns the frc file at path with the atom types of session that it lacks
+# added, with the mass of another type of the same element.  Their terms
+# have no parameters, which does not matter to the check.
+def model_frc(session, path):
+    f = frc.Frc(path)
+    masses = dict(f.types.values())
+    for a in session.system.atoms:
+        if not a.ff in f.types and a.sym in masses:
+            f.types[a.ff] = [a.sym, masses[a.sym]]
+    return f
+
+# Returns the frc file of model_frc with the parameters of the first bond
+# type of session that has any scaled by 1.1.
+def changed_frc(session, path):
+    f = model_frc(session, path)
+    for t in session.writer.btypes:
+        p = f.get_param(t, 'b')
+        if p is None: continue
+        f.set_param(t, 'b', [1.1*v for v in p])
+        return f
+    print 'FAILED: no bond parameters to change'
+    sys.exit(1)
+
+def main(args):
+    model   = os.path.abspath(args[1] if len(args) > 1 else default_model)
+    frcpath = os.path.abspath(args[2] if len(args) > 2 else default_frc)
+    # A hung session fails the check instead of blocking it.
+    signal.alarm(600)
+    cwd, scratch = os.getcwd(), tempfile.mkdtemp(prefix='check-sessions-')
+    try:
+        os.chdir(scratch)
+        base = os.path.basename(model)
+        for ext in ['.car', '.mdf', '.arc']: shutil.copy(model + ext, base + ext)
+        session = pymsi2lmp.Session(base, compiled=True)
+        compass = [model_frc(session, frcpath), changed_frc(session, frcpath)]
+        x = read_arc_file(base)[0][:frames]
+
+        failed = []
+        expected = evaluate(session, base, x, compass, False)
+        if array_equal(expected[0][0], expected[1][0]):
+            failed.append('changing the coefficients does not change the energies')
+        if [r[2] for r in expected] != [len(x)]*len(compass):
+            failed.append('runs per frame read %s data files' %[r[2] for r in expected])
+        # Module sessions import the fake module as lammps, which lammps.py
+        # finds outside its own directory.
+        shim = tempfile.mkdtemp(prefix='lammps-module-')
+        open(os.path.join(shim, 'lammps.py'), 'w').write('from fake_lmp import *\n')
+        modes = [('process session', None, True), ('module session', shim, False)]
+        if lammps.lammps_module():
+            print 'The LAMMPS Python module is importable, process sessions are not checked.'
+            modes = modes[1:]
+        for name, path, exact in modes:
+            if path: sys.path.insert(0, path)
+            try:
+                results = evaluate(session, base, x, compass, True)
+            finally:
+                if path: sys.path.remove(path)
+            for k, ((e, thermo, reads), (e0, thermo0, reads0)) in enumerate(zip(results, expected)):
+                if exact: same = array_equal(e, e0) and thermo == thermo0
+                else:     same = allclose(e, e0, rtol=1e-7) and sorted(thermo) == sorted(thermo0) and \
+                                 allclose([thermo[t] for t in sorted(thermo)],
+                                          [thermo0[t] for t in sorted(thermo0)], rtol=1e-7)
+                if not same:
+                    failed.append('%s: energies of evaluation %d differ from runs per frame' %(name, k+1))
+                if not 1 <= reads <= workers:
+                    failed.append('%s: %d data files read in evaluation %d' %(name, reads, k+1))
+            print '%-16s %d evaluations of %d frames checked' %(name, len(results), len(x))
+        shutil.rmtree(shim)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch)
+    for f in failed: print 'FAILED:', f
+    if failed: sys.exit(1)
+    print 'OK'
+
+if __name__ == '__main__':
+    main(sys.argv)
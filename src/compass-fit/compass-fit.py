@@ -3,7 +3,39 @@
 
     SYNOPSIS
    
-      compass-fit.py [basename] [original_frc_path]
+      compass-fit.py [-workers N] [-lmp LAMMPS] [-session] [-native]
+                     [-analytic] [-stride N]
+                     [basename] [original_frc_path]
+
+    OPTIONS
+
+      -workers N
+          Number of LAMMPS runs done at the same time, one per frame of the
+          trajectory.  Defaults to the number of cpus.
+
+      -lmp LAMMPS
+          Path of the LAMMPS executable (default /opt/lammps/lmp_openmpi).
+
+      -session
+          Keeps one LAMMPS session alive per worker, which reads the data file
+          once per evaluation and then only updates the positions for each
+          frame.  The LAMMPS Python module is used if it can be imported.
+
+      -native
+          Computes the energies with the class2 evaluator in pymsi2lmp
+          instead of LAMMPS.  The topology is built once and only the
+          coefficients are updated for each set of parameters.  Its terms
+          match those of LAMMPS (see pymsi2lmp/check_class2.py).
+
+      -analytic
+          Fits with the analytic Jacobian of the class2 evaluator (implies
+          -native).  Force constants are solved for directly and the other
+          parameters are refined with the linear ones solved at each step.
+
+      -stride N
+          Fits to every Nth frame of the trajectory only (default 1).  The
+          frames are read into basename.arc.npy the first time, and later
+          runs only read the frames that are used from it.
 """
 
 from run_msi2lmp import * 
@@ -11,13 +43,39 @@ import sys
 import modify_frc
 from scipy.optimize import leastsq
 import lammps
+import frc
+import class2
+import jacobian
 from numpy import *
 from numpy.linalg import norm
 from discover_output import read_arc_file, read_disco_energy_file
 
+# Removes the options from args, returns the remaining arguments and a
+# dictionary of the options.
+def parse_options(args):
+    options = {'-workers': None, '-lmp': '/opt/lammps/lmp_openmpi',
+               '-session': False, '-native': False, '-analytic': False,
+               '-stride': '1'}
+    positional, i = [], 0
+    while i < len(args):
+        if args[i] in ['-session', '-native', '-analytic']:
+            options[args[i]] = True
+            i += 1
+        elif args[i] == '-np':
+            print '-np is now -workers, as in pymsi2lmp.py.'
+            sys.exit(1)
+        elif args[i] in options:
+            options[args[i]] = args[i+1]
+            i += 2
+        else:
+            positional.append(args[i])
+            i += 1
+    return positional, options
+
 # Main input file.
 def main(args):
     import glob
+    args, options = parse_options(args)
     # Finds the first *.mdf file in the directory and uses that as the basename.
     base    = glob.glob('*.mdf')[0][0:-4]
     frcfile = 'compass.frc'
@@ -25,28 +83,64 @@ def main(args):
     if len(args) > 1: base     = args[1]
     if len(args) > 2: frcfile  = args[2]
     if len(args) > 3: 
-        print 'compass_fitter.py [basename] [original_frc_path]'
+        print 'compass-fit.py [-workers N] [-lmp LAMMPS] [-session] [-native]',
+        print '[-analytic] [-stride N]',
+        print '[basename] [original_frc_path]'
         return
 
-    # Calls msi2lmp and returns the output as strings.
-    run.missing, param_count = call_msi2lmp(base, frcfile)
+    # Converts the model once, the session then only rewrites the Coeffs
+    # sections of the data file for each new set of parameters, gathered
+    # from tables compiled for the types of the model.
+    run.session = pymsi2lmp.Session(base, compiled=True)
+    run.frc     = frc.Frc(frcfile)
+    run.order   = modify_frc.section_order(frcfile)
+    run.missing, param_count = unknown_parameters(run.session.convert(run.frc))
     run.base    = base    
     run.frcfile = frcfile
     run.newfrc  = 'compass-new.frc'
+    workers     = options['-workers'] and int(options['-workers'])
+    if options['-native'] or options['-analytic']:
+        run.native = class2.Class2(run.session.system, run.frc)
+    else:
+        run.native = None
+        run.frames = lammps.FramePool(options['-lmp'], workers, options['-session'])
     # Initialize unknown parameters
     v = zeros((param_count))
     print 'Attempting to fit',param_count,'parameters.'        
     
-    residual.x, residual.e = read_arc_file(base)        
-    if param_count > 0:                
-        # Minimize error in energy with least squares.
-        v = leastsq(residual, v, args=(), epsfcn=0.0004)[0]        
-            
-    err = norm(residual(v)) / norm(residual.e)     
+    stride = int(options['-stride'])
+    # The workers of the frame pool and their scratch directories are
+    # removed even if the fit fails.
+    try:
+        x, e   = read_arc_file(base)
+        residual.x, residual.e = x[::stride], e[::stride]
+        if param_count > 0 and options['-analytic']:
+            pmap = jacobian.ParameterMap(run.native, frc.Frc(frcfile), frcfile,
+                                         run.missing, v)
+            v = jacobian.fit(pmap, v, residual.x, residual.e)
+        elif param_count > 0:
+            # leastsq needs at least as many residuals as parameters.
+            if len(residual.e) < param_count:
+                print 'Only', len(residual.e), 'frames to fit', param_count, 'parameters,',
+                print 'which needs at least as many frames as parameters.'
+                if stride > 1: print 'Use a smaller -stride than', stride, 'or a longer trajectory.'
+                else:          print 'Use a longer trajectory, or -analytic.'
+                sys.exit(1)
+            # Minimize error in energy with least squares.
+            v = leastsq(residual, v, args=(), epsfcn=0.0004)[0]        
+                
+        err = norm(residual(v)) / norm(residual.e)     
+    finally:
+        if not run.native: run.frames.close()
     print 'Relative error norm is: %.2g' % err 
+    # Makes a new frc file in the current directory with the new parameters.
+    modify_frc.update(run.frcfile, run.newfrc, run.missing, v)
     
     # Last run energy breakdown.
-    lmp_e = lammps.get_pe_from_log_file()
+    if run.native:
+        lmp_e = dict((k, e[-1]) for k,e in run.thermo.items())
+    else:
+        lmp_e = run.frames.thermo
     ms_e  = read_disco_energy_file(base)
     
     def compare(lmp, ms):
@@ -76,15 +170,15 @@ def residual(v):
     
 # Returns the LAMMPS energies for a set of trajectories.
 def run(v, x):
-    energy = zeros((len(x)))
-    # Makes a new frc file in the current directory with the new parameters.
-    modify_frc.update(run.frcfile, run.newfrc, run.missing, v)
-    call_msi2lmp(run.base, run.newfrc)
-    for i, xi in enumerate(x):
-        lammps.modify_data_file(run.base, xi, i) 
-        lmpout    = lammps.run(run.base, i, '/opt/lammps/lmp_openmpi')
-        energy[i] = lammps.extract_energy(lmpout)
-    return array(energy)
+    # Sets the new parameters in the frc tables, no frc file is written.
+    modify_frc.update_tables(run.frc, run.order, run.missing, v)
+    if run.native:
+        run.native.set_coeffs(run.frc)
+        run.thermo = run.native.thermo(x)
+        return run.thermo['PotEng']
+    # The bundle saves the workers from parsing the atoms of the data file.
+    run.session.convert(run.frc, binary=True)
+    return run.frames.energies(run.base, x)
 
 if __name__ == '__main__': main(sys.argv)
 
@@ -3,29 +3,161 @@
     Reads output files created by MS discover.
 """
 
+import os
+import bisect
+import tempfile
+import numpy as np
 from numpy import array
+import run_msi2lmp   # Puts pymsi2lmp on the path.
+from insight import tokenize
+
+# First line of each frame in a trajectory file, followed by the energy.
+frame_header = 'Materials Studio Generated CAR File'
+# Lines of a frame other than atom lines.
+non_atom_lines = (frame_header, '!', 'PBC', 'end')
+# Size of the blocks of the arc file that are parsed at a time.
+block_size = 1 << 20
 
 # Reads atom coords and energy in the materials studio trajectory file.
-# Each timestep trajectory is packed into a 1D array
-# with the dimension varying fastest, eg [x1 y1 z1 ... xn yn zn].
+# Returns an (n_frames, n_atoms, 3) array of coordinates and the energies,
+# see read_arc_frames.
 def read_arc_file(base):
-    arc = open(base+ '.arc', 'r')
-    energy     = []
-    trajectory = []
+    return read_arc_frames(base)
+
+# Returns the paths of the coordinates and energies saved for an arc file.
+# The energies are saved with the size of the arc file they were read from.
+def arc_cache_paths(base):
+    return base + '.arc.npy', base + '.arc-energy.npz'
+
+# Returns the energies saved for the arc file at arcpath in epath, or None
+# if they are missing or older than the arc file, or were read from an arc
+# file of another size.
+def cached_energies(arcpath, epath):
+    if not os.path.exists(epath) or os.path.getmtime(epath) < os.path.getmtime(arcpath):
+        return None
+    try:
+        saved = np.load(epath)
+        if int(saved['arc_size']) != os.path.getsize(arcpath): return None
+        return saved['energy']
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+# Reads the trajectory base.arc as an (n_frames, n_atoms, 3) array and the
+# array of energies.  The first time, the coordinates are saved next to the
+# arc file in .npy format, and later calls open them memory-mapped (as long
+# as the arc file has not changed), so frames are only read from disk when
+# they are used and taking a subset of the frames costs nothing.  The arc
+# file is scanned once for the offsets of its frames, which are then parsed
+# from the offsets.
+def read_arc_frames(base, cache=True):
+    arcpath = base + '.arc'
+    xpath, epath = arc_cache_paths(base)
+    if cache and os.path.exists(xpath) and \
+       os.path.getmtime(xpath) >= os.path.getmtime(arcpath):
+        energy = cached_energies(arcpath, epath)
+        if energy is not None: return np.load(xpath, mmap_mode='r'), energy
+
+    offsets, size = frame_offsets(arcpath)
+    ends = offsets[1:] + [size]
+    arc  = open(arcpath, 'r')
+    natoms = 0
+    if offsets:
+        arc.seek(offsets[0])
+        natoms = len(parse_block(arc.read(ends[0] - offsets[0]))[1])
+    x, tmp = allocate_frames(xpath if cache else None, (len(offsets), natoms, 3))
+    try:
+        energy, k = [], 0
+        while k < len(offsets):
+            # Frames k to m-1, about block_size bytes of them.
+            m = max(k+1, bisect.bisect_right(ends, offsets[k] + block_size, k))
+            arc.seek(offsets[k])
+            e, xyz = parse_block(arc.read(ends[m-1] - offsets[k]))
+            if len(xyz) != (m-k)*natoms:
+                raise ValueError('%s: frames do not all have %d atoms' %(arcpath, natoms))
+            x[k:m] = xyz.reshape(m-k, natoms, 3)
+            energy += e
+            k = m
+    except:
+        if tmp: os.remove(tmp)
+        raise
+    finally:
+        arc.close()
+    energy = array(energy, dtype=float)
+
+    if tmp:
+        x.flush()
+        del x
+        fd, etmp = tempfile.mkstemp('.tmp.npz', os.path.basename(epath) + '.',
+                                    os.path.dirname(os.path.abspath(epath)))
+        fid = os.fdopen(fd, 'wb')
+        np.savez(fid, energy=energy, arc_size=size)
+        fid.close()
+        os.rename(tmp, xpath)
+        os.rename(etmp, epath)
+        return np.load(xpath, mmap_mode='r'), energy
+    return x, energy
+
+# Yields the text of an arc file in blocks of whole lines.
+def arc_blocks(path):
+    arc = open(path, 'r')
     while True:
-        line = arc.readline().strip()
-        if not line: break
-        if line.startswith('Materials Studio Generated CAR File'):
-            energy.append(float(line.split()[-1]))
-            trajectory.append([])
-            # Ignore !DATE line
-            arc.readline()
-            while True:
-                line = arc.readline().strip()
-                if not line or line=='end': break
-                for s in line.split()[1:4]:
-                    trajectory[-1].append(float(s))
-    return trajectory, array(energy)
+        block = arc.read(block_size)
+        if not block: break
+        yield block + arc.readline()
+    arc.close()
+
+# Returns the offsets of the header lines of the frames of an arc file and
+# the size of the file, in one pass over its blocks.  Blocks end at line
+# ends, so no header is split between two blocks.
+def frame_offsets(path):
+    offsets, start = [], 0
+    for block in arc_blocks(path):
+        k = block.find(frame_header)
+        while k >= 0:
+            offsets.append(start + k)
+            k = block.find(frame_header, k + len(frame_header))
+        start += len(block)
+    return offsets, start
+
+# Parses a block of lines of an arc file.  Returns the energies of the frame
+# headers and an (n_atoms, 3) array of the coordinates of the atom lines.
+def parse_block(block):
+    lines  = block.split('\n')
+    energy = [float(l.split()[-1]) for l in lines if l.startswith(frame_header)]
+    atoms  = [l for l in lines if l.strip() and not l.startswith(non_atom_lines)]
+    xyz    = np.empty((len(atoms), 3))
+    if not atoms: return energy, xyz
+    tokens, count = tokenize('\n'.join(atoms))
+    if (count == count[0]).all():
+        # Every line has the same number of columns, so the columns of the
+        # coordinates are strided slices of the tokens.
+        width = count[0]
+        for c in range(3):
+            xyz[:,c] = np.fromstring(' '.join(tokens[1+c::width]), sep=' ')
+    else:
+        # The coordinates follow the first token of each line.
+        first = np.append(0, np.cumsum(count)[:-1])
+        xyz[:] = np.fromstring(' '.join(tokens[i] for i in (first[:,None] + [1,2,3]).ravel()),
+                               sep=' ').reshape(-1, 3)
+    return energy, xyz
+
+# Returns an array for the frames and its path, a memory-mapped .npy file
+# written under a temporary name unique to the process next to path if
+# possible, or an array in memory and None.
+def allocate_frames(path, shape):
+    if path:
+        try:
+            fd, tmp = tempfile.mkstemp('.tmp.npy', os.path.basename(path) + '.',
+                                       os.path.dirname(os.path.abspath(path)))
+            os.close(fd)
+        except (IOError, OSError):
+            return np.zeros(shape), None
+        try:
+            return np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float64,
+                                             shape=shape), tmp
+        except (IOError, OSError):
+            os.remove(tmp)
+    return np.zeros(shape), None
 
 # Reads the MS disco energy file (useful if you want to try to compare term-by-term.
 def read_disco_energy_file(base):    
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+ fake_lmp.py - a stand-in for LAMMPS, to check the sessions and the frame
+               pool of lammps.py where LAMMPS is not installed (see
+               check_sessions.py).  Run as a program, it reads commands on
+               stdin like lmp; the class lammps drives it like the LAMMPS
+               Python module.  Thermo output is printed as LAMMPS prints it,
+               and on stdin it is only flushed after thermo_modify flush yes,
+               as LAMMPS's is through a pipe.  Commands it does not know stop
+               it with an error, as in LAMMPS.
+
+               The energy terms are made up from the coordinates and from
+               the coefficients of the data file, so that reading a new data
+               file changes them.  Each data file read is appended to
+               fake_lmp.reads in the working directory.
+"""
+import sys
+
+# LAMMPS names of the thermo keywords.
+thermo_names = {'pe': 'PotEng', 'evdwl': 'E_vdwl', 'ecoul': 'E_coul',
+                'ebond': 'E_bond', 'eangle': 'E_angle', 'edihed': 'E_dihed',
+                'eimp': 'E_impro'}
+# Coeffs sections that the made up terms depend on.
+term_sections = {'evdwl': 'Pair Coeffs', 'ebond': 'Bond Coeffs',
+                 'eangle': 'Angle Coeffs', 'edihed': 'Dihedral Coeffs',
+                 'eimp': 'Improper Coeffs'}
+# Commands that only set up a model LAMMPS would compute with.
+ignored = ['echo', 'units', 'boundary', 'atom_style', 'pair_style',
+           'bond_style', 'angle_style', 'dihedral_style', 'improper_style',
+           'pair_modify', 'special_bonds', 'neighbor', 'fix', 'timestep']
+
+# Stops LAMMPS with an error message.
+class LammpsError(Exception):
+    pass
+
+# The state of a LAMMPS instance: the atoms, the sums of the coefficients of
+# each Coeffs section and the thermo settings.
+class Engine:
+    def __init__(self, out=None, log=None):
+        self.out, self.log = out, log
+        self.clear()
+        self.flush  = False
+        self.thermo = {}
+
+    def clear(self):
+        self.x, self.coeffs, self.keywords = None, {}, ['pe']
+
+    # Writes output to the screen and the log.
+    def write(self, s):
+        if self.out: self.out.write(s)
+        if self.log: self.log.write(s)
+
+    # Runs one or more lines of commands.
+    def command(self, lines):
+        for line in lines.split('\n'):
+            c = line.split('#')[0].split()
+            if not c or c[0] in ignored: continue
+            if not hasattr(self, 'do_' + c[0]):
+                raise LammpsError('Unknown command: ' + line.strip())
+            getattr(self, 'do_' + c[0])(c[1:])
+            if self.flush and self.out: self.out.flush()
+
+    def do_clear(self, args):
+        self.clear()
+
+    def do_thermo_style(self, args):
+        if args[0] != 'custom' or [k for k in args[1:] if not k in thermo_names]:
+            raise LammpsError('Illegal thermo_style command')
+        self.keywords = args[1:]
+
+    def do_thermo_modify(self, args):
+        if args != ['flush', 'yes']:
+            raise LammpsError('Illegal thermo_modify command')
+        self.flush = True
+
+    # Reads the coordinates and the sum of each Coeffs section.
+    def do_read_data(self, args):
+        section, x = None, []
+        for line in open(args[0]):
+            c = line.split()
+            if not c: continue
+            if not c[0][0] in '-.0123456789':
+                section = line.strip()
+                continue
+            if section == 'Atoms':
+                x.append([float(v) for v in c[4:7]])
+            elif section and section.endswith('Coeffs'):
+                self.coeffs[section] = (self.coeffs.get(section, 0.0) +
+                                        sum(float(v) for v in c[1:]))
+        self.x = x
+        open('fake_lmp.reads', 'a').write(args[0] + '\n')
+
+    # Reads new positions from a dump file: read_dump path 0 x y z box yes.
+    def do_read_dump(self, args):
+        if self.x is None: raise LammpsError('Read_dump command before box is defined')
+        if args[1:] != ['0', 'x', 'y', 'z', 'box', 'yes']:
+            raise LammpsError('Illegal read_dump command')
+        lines = open(args[0]).read().split('\n')
+        n = int(lines[3])
+        if n != len(self.x): raise LammpsError('Read_dump atom count mismatch')
+        for line in lines[9:9+n]:
+            c = line.split()
+            self.x[int(c[0])-1] = [float(v) for v in c[1:4]]
+
+    # Computes the terms and prints their thermo output for each step.
+    def do_run(self, args):
+        if self.x is None: raise LammpsError('Run command before box is defined')
+        steps = int(args[0])
+        s = sum(0.5*x + 0.01*y*y - 0.1*z for x,y,z in self.x)
+        self.thermo = {'ecoul': 0.2*s}
+        for k, section in term_sections.items():
+            self.thermo[k] = 0.1*s*(1.0 + 1e-3*self.coeffs.get(section, 0.0))
+        self.thermo['pe'] = sum(self.thermo.values())
+        self.write('Setting up run ...\n')
+        self.write(' '.join(thermo_names[k] for k in self.keywords) + ' \n')
+        for step in range(steps+1):
+            self.write(''.join(' %12.8g' %self.thermo[k] for k in self.keywords) + ' \n')
+        self.write('Loop time of 0 on 1 procs for %d steps with %d atoms\n\n'
+                   %(steps, len(self.x)))
+
+# The LAMMPS Python module interface used by lammps.ModuleSession.
+class lammps:
+    def __init__(self, cmdargs=None):
+        self.engine = Engine()
+
+    def command(self, s):
+        self.engine.command(s)
+
+    def scatter_atoms(self, name, type, count, data):
+        x = list(data)
+        self.engine.x = [x[i:i+3] for i in range(0, len(x), 3)]
+
+    def get_thermo(self, keyword):
+        return self.engine.thermo[keyword]
+
+    def close(self):
+        pass
+
+# Runs commands from stdin, printing to stdout and log.lammps.
+def main():
+    engine = Engine(sys.stdout, open('log.lammps', 'w'))
+    engine.write('LAMMPS (fake_lmp.py)\n')
+    try:
+        while True:
+            line = sys.stdin.readline()
+            if line == '': break
+            engine.command(line)
+    except LammpsError, e:
+        engine.write('ERROR: %s\n' %e)
+        sys.exit(1)
+    engine.write('Total wall time: 0:00:00\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+ jacobian.py - analytic derivatives of the class2 energies with respect to
+   the unknown parameters fitted by compass-fit.py, and a fit that uses them.
+   The parameters are set in the frc tables in memory (no frc file is
+   written) and the energies and their derivatives with respect to every
+   coefficient come from the class2 evaluator in pymsi2lmp.  The energy is
+   linear in the force constants, which are solved for directly, while the
+   equilibrium values and van der Waals parameters are refined with
+   leastsq using the analytic Jacobian.
+"""
+import modify_frc
+import class2
+from numpy import array, zeros, nonzero, flatnonzero
+from numpy.linalg import lstsq, norm
+from scipy.optimize import leastsq
+
+# Maps the unknown parameters v onto the coefficients of a class2.Class2.
+class ParameterMap:
+    def __init__(self, native, frc, frcpath, unknown, v):
+        self.native  = native
+        self.frc     = frc
+        self.order   = modify_frc.section_order(frcpath)
+        self.unknown = unknown
+        self.update(v)
+        self.probe(v)
+
+    # Sets the parameters v (starting values are filled in v in place).
+    def update(self, v):
+        modify_frc.update_tables(self.frc, self.order, self.unknown, v)
+        self.native.set_coeffs(self.frc)
+
+    # Finds the coefficients that each parameter is copied into by changing
+    # the parameters one at a time.  Coefficients are exact copies of the
+    # parameters, so this gives the exact derivatives.  A parameter is linear
+    # if the energy is linear in all of the coefficients it is copied into.
+    def probe(self, v):
+        base = dict((name, c.copy()) for name,c in self.native.coeff.items())
+        self.entries = []
+        self.linear  = zeros(len(v), dtype=bool)
+        for k in range(len(v)):
+            u = array(v, dtype=float)
+            u[k] += 1.0
+            self.update(u)
+            entries = []
+            for name in base:
+                d = self.native.coeff[name] - base[name]
+                entries += [(name, i, j, d[i,j]) for i,j in zip(*nonzero(d))]
+            self.entries.append(entries)
+            self.linear[k] = all(j in class2.linear_columns[name]
+                                 for name,i,j,d in entries)
+        self.update(v)
+
+    # Returns the energy of each frame of x for parameters v.
+    def energies(self, v, x):
+        self.update(v)
+        return self.native.thermo(x)['PotEng']
+
+    # Returns the derivatives of the energy of each frame of x with respect
+    # to the parameters v, as an (n_frames, n_parameters) array.
+    def jacobian(self, v, x):
+        self.update(v)
+        g = self.native.gradient(x)
+        jac = zeros((len(g['b']), len(v)))
+        for k, entries in enumerate(self.entries):
+            for name, i, j, d in entries:
+                jac[:,k] += d*g[name][:,i,j]
+        return jac
+
+# Solves for the linear parameters of v (in place) that best fit energies e,
+# the energy being exactly linear in them.  Returns their Jacobian.
+def solve_linear(pmap, v, x, e):
+    lin = pmap.linear
+    jac = pmap.jacobian(v, x)[:,lin]
+    v[lin] += lstsq(jac, e - pmap.energies(v, x), rcond=None)[0]
+    return jac
+
+# Fits the parameters v to the energies e of frames x.  The nonlinear
+# parameters are refined with leastsq, with the linear parameters solved for
+# at every step (variable projection) and the Jacobian projected out of the
+# space of the linear parameters.
+def fit(pmap, v, x, e):
+    v = array(v, dtype=float)
+    x = pmap.native.frames(x)
+    pmap.update(v)
+    nl = flatnonzero(~pmap.linear)
+    print 'Solving for', pmap.linear.sum(), 'linear parameters,',
+    print 'refining', len(nl), 'nonlinear parameters.'
+    solve_linear(pmap, v, x, e)
+    if len(nl) == 0: return v
+    if len(nl) > len(e):
+        print 'Too few frames to refine the nonlinear parameters.'
+        return v
+
+    def residual(u):
+        v[nl] = u
+        solve_linear(pmap, v, x, e)
+        r = pmap.energies(v, x) - e
+        print norm(r) / norm(e)
+        return r
+
+    def dresidual(u):
+        v[nl] = u
+        lin = solve_linear(pmap, v, x, e)
+        jac = pmap.jacobian(v, x)[:,nl]
+        return jac - lin.dot(lstsq(lin, jac, rcond=None)[0])
+
+    v[nl] = leastsq(residual, v[nl], Dfun=dresidual)[0]
+    solve_linear(pmap, v, x, e)
+    return v
@@ -3,8 +3,18 @@
  This script makes a LAMMPS input file to fit a compass potential.
 """
 
+import os
+import sys
+import imp
+import ctypes
+import itertools
+import shutil
+import tempfile
 import subprocess
+import multiprocessing
+import multiprocessing.util
 from subprocess import PIPE
+from numpy import array, asarray, column_stack
 default_lmp_input = """echo none
 units               real
 boundary            s s s 
@@ -22,6 +32,39 @@ timestep            0
 run                 1
 """
 
+# Input of a LAMMPS session that is kept alive, see Session.
+session_lmp_input = """echo none
+units               real
+boundary            s s s 
+atom_style          full
+pair_style          lj/class2/coul/cut 9.5 9.5
+%s
+pair_modify         shift no 
+special_bonds       lj/coul 0.0 0.0 1.0 angle yes dihedral yes
+read_data           %s
+neighbor            0.3 nsq
+thermo_style        custom pe evdwl ecoul ebond eangle edihed eimp
+thermo_modify       flush yes
+"""
+
+# Thermo keywords of the sessions and the names LAMMPS prints them with.
+thermo_keywords = [('pe',    'PotEng'),  ('evdwl',  'E_vdwl'), 
+                   ('ecoul', 'E_coul'),  ('ebond',  'E_bond'),
+                   ('eangle','E_angle'), ('edihed', 'E_dihed'),
+                   ('eimp',  'E_impro')]
+
+# Dump file header used by a LAMMPS process session to read new positions.
+dump_header = """ITEM: TIMESTEP
+0
+ITEM: NUMBER OF ATOMS
+%d
+ITEM: BOX BOUNDS ss ss ss
+%.9f %.9f
+%.9f %.9f
+%.9f %.9f
+ITEM: ATOMS id x y z
+"""
+
 # Scans the input file to see if pair/bond/angle/dihedral/improper are there.
 def input_file_terms(inputfile):
     types = '' 
@@ -35,10 +78,18 @@ def input_file_terms(inputfile):
         elif line.endswith('xlo xhi'): return types
     return types
 
-# Writes the lammps input file.
-def run(base, step, lmp):
+# Returns the command line that starts LAMMPS, lmp being the path of the
+# executable or a list of the command and its arguments (e.g. an interpreter
+# and a script).
+def lmp_command(lmp):
+    if isinstance(lmp, (list, tuple)): return list(lmp)
+    return [lmp]
+
+# Writes the lammps input file.  LAMMPS is run in the directory cwd.
+def run(base, step, lmp, cwd=None):
     inputfile = base + '.lammps.%03d'%step
-    p = subprocess.Popen([lmp], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    p = subprocess.Popen(lmp_command(lmp), stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                         cwd=cwd)
     types = input_file_terms(inputfile)
     return p.communicate(default_lmp_input %(types, inputfile))[0]
 
@@ -64,42 +115,292 @@ def get_num_atoms(base):
         if line.endswith(tag):
             return int(line[0:-len(tag)])
 
+# Atom line of a template, the coordinates being left as fields to fill in.
+template_atom = ' %6d %6d %3d %9.6f' + ' %%15.9f %%15.9f %%15.9f\n'
+
+# Returns the path of the bundle written with the data file at path (see
+# pymsi2lmp bundle.py), or None if there is none as new as the data file.
+def data_bundle(path):
+    if not path.endswith('.lammps'): return None
+    bundle = path[:-len('.lammps')] + '.npz'
+    if os.path.exists(bundle) and os.path.getmtime(bundle) >= os.path.getmtime(path):
+        return bundle
+    return None
+
+# A LAMMPS data file parsed once into a template, so that the data file of
+# each frame is made by filling in only the bounds and the coordinates of
+# the Atoms section.  The header, the atom id/molecule/type/charge columns
+# and the topology after the Atoms section are kept preformatted.  If the
+# data file has a bundle (see data_bundle), the atom columns are taken from
+# its arrays and the topology is sliced from the text, so that no line after
+# the header is parsed.
+class DataTemplate:
+    def __init__(self, path):
+        bundle = data_bundle(path)
+        if bundle:
+            text  = open(path, 'r').read()
+            start = text.find('\n', text.find('\nAtoms') + 1) + 1
+            lines = iter(text[:start].splitlines(True))
+        else:
+            lines = iter(open(path, 'r').readlines())
+        head, self.axes = [], []
+        # Copy line for line until encounter the Atoms line.
+        # The bounds are left as fields to fill in.
+        for line in lines:
+            axis = [d for d in 'xyz' if line.strip().endswith('%slo %shi' %(d,d))]
+            if axis:
+                self.axes += axis
+                head.append(' %%15.9f %%15.9f %slo %shi\n' %(axis[0], axis[0]))
+            else: head.append(line.replace('%', '%%'))
+            if line.startswith('Atoms'): break 
+
+        if bundle:
+            self.from_bundle(head, bundle)
+            # The blank line after the atoms and the sections following them.
+            end = text.find('\nBonds', start)
+            self.format = ''.join(head)
+            self.tail   = text[end:] if end >= 0 else '\n'
+            return
+
+        # Atom lines keep their first four columns, blank lines are kept.
+        self.natoms = 0
+        for line in lines:
+            if line.strip() == '': 
+                head.append(line)
+                continue
+            elif line.startswith('Bonds'):
+                head.append(line.replace('%', '%%'))
+                break
+            c = line.split()        
+            c = (int(c[0]),int(c[1]),int(c[2]),float(c[3]))
+            head.append(' %6d %6d %3d %9.6f' %c + ' %15.9f %15.9f %15.9f\n')
+            self.natoms += 1
+        self.format = ''.join(head)
+        # Remainder of file.
+        self.tail = ''.join(lines)
+
+    # Appends the atom lines made from the arrays of the bundle at path to
+    # head, after the blank line that follows the Atoms line.
+    def from_bundle(self, head, path):
+        import bundle
+        arrays = bundle.load(path)
+        self.natoms = len(arrays['x'])
+        columns = itertools.izip(xrange(1, self.natoms+1),
+                                 arrays['molecule'].tolist(),
+                                 arrays['atom_type'].tolist(),
+                                 arrays['charge'].tolist())
+        head.append('\n')
+        head.append((template_atom*self.natoms)
+                    %tuple(itertools.chain.from_iterable(columns)))
+
+    # Returns the data file for coordinates x, packed as [x1 y1 z1 ... zn]
+    # or as an (n,3) array.  The bounds are those of the atoms of the frame.
+    def render(self, x):
+        x = asarray(x, dtype=float).reshape(-1, 3)
+        b = bounds(x)
+        b = [v for d in self.axes for v in b[2*'xyz'.index(d):2*'xyz'.index(d)+2]]
+        return self.format %tuple(b + x.ravel().tolist()) + self.tail
+
+    # Writes the data file for coordinates x with a single write.
+    def write(self, path, x):
+        fid = open(path, 'w')
+        fid.write(self.render(x))
+        fid.close()
+
+# Templates of data files already parsed and the keys they were parsed
+# under, by path.
+templates = {}
+
+# Returns the template of a data file, which is only parsed again if key
+# differs from the key it was parsed under.  The caller gives the key (e.g.
+# the generation of FramePool), so that the file is not read for each
+# frame; by default it is the modification time and size of the file.
+def load_template(path, key=None):
+    if key is None:
+        st  = os.stat(path)
+        key = st.st_mtime, st.st_size
+    if templates.get(path, (None,))[0] != key:
+        templates[path] = key, DataTemplate(path)
+    return templates[path][1]
+
 # Reads the data file and modifies the atomic positions.
-# Each new file is saved as base.lammps.05.step
-def modify_data_file(base, x, step):
-    old = open(base + '.lammps', 'r')
-    new = open(base + '.lammps.%03d'%step, 'w')
-
-    def bounds(d, lo, hi):
-        return ' %15.9f %15.9f %slo %shi\n' %(lo,hi,d,d)
-
-    # Copy line for line until encounter the Atoms line.
-    # Replace the bounds with the updated bounds.
-    for line in old:
-        if line.strip().endswith('xlo xhi'):
-            new.write(bounds('x', min(x[0::3]), max(x[0::3])))
-        elif line.strip().endswith('ylo yhi'):
-            new.write(bounds('y', min(x[1::3]), max(x[1::3])))
-        elif line.strip().endswith('zlo zhi'):
-            new.write(bounds('z', min(x[2::3]), max(x[2::3]))) 
-        else: new.write(line)
-        if line.startswith('Atoms'): break 
-
-    # Write new atom lines (or add blank lines).
-    i = 0
-    for line in old:
-        if line.strip() == '': 
-            new.write(line)
-            continue
-        elif line.startswith('Bonds'):
-            new.write(line)
-            break
-        c = line.split()        
-        c = (int(c[0]),int(c[1]),int(c[2]),float(c[3]),x[i],x[i+1],x[i+2])
-        new.write(' %6d %6d %3d %9.6f %15.9f %15.9f %15.9f\n' %c)
-        i += 3
-    # Copy remainder of file.
-    for line in old: new.write(line)
+# Each new file is saved as base.lammps.step, or as out.lammps.step.  The
+# key is that of load_template.
+def modify_data_file(base, x, step, out=None, key=None):
+    if out == None: out = base
+    load_template(base + '.lammps', key).write(out + '.lammps.%03d'%step, x)
+
+# Returns the LAMMPS Python module, or None if it cannot be imported.  As
+# this module is also named lammps, its own directory is not searched.
+def lammps_module():
+    here = os.path.dirname(os.path.abspath(__file__))
+    path = [p for p in sys.path if os.path.abspath(p or '.') != here]
+    try:
+        return imp.load_module('lammps_python', *imp.find_module('lammps', path))
+    except ImportError:
+        return None
+
+# A LAMMPS process that is kept alive and driven through stdin.  The data 
+# file is read once, then for each frame the positions are read from a dump
+# file written in cwd and the energy is computed with run 0.
+class ProcessSession:
+    def __init__(self, lmp, cwd):
+        self.dump = os.path.join(cwd, 'frame.dump')
+        self.p = subprocess.Popen(lmp_command(lmp), stdin=PIPE, stdout=PIPE, cwd=cwd)
+
+    # Sends commands to LAMMPS.
+    def command(self, s):
+        self.p.stdin.write(s + '\n')
+        self.p.stdin.flush()
+
+    # Reads the data file, and the force field in it, discarding any model 
+    # read before.
+    def load(self, datafile):
+        self.command('clear\n' + session_lmp_input 
+                     %(input_file_terms(datafile), datafile))
+
+    # Returns the thermo output for coordinates x [x1 y1 z1 ... zn].
+    def thermo(self, x):
+        x = asarray(x, dtype=float).reshape(-1, 3)
+        fid = open(self.dump, 'w')
+        fid.write(dump_header %((len(x),) + tuple(bounds(x))))
+        fid.write(('%d %.9f %.9f %.9f\n'*len(x)) 
+                  %tuple(c for i,xi in enumerate(x.tolist()) for c in [i+1]+xi))
+        fid.close()
+        self.command('read_dump %s 0 x y z box yes\nrun 0' %self.dump)
+        # Thermo output is flushed, so the values line follows the header.
+        out = []
+        while True:
+            line = self.p.stdout.readline()
+            if line == '': 
+                raise RuntimeError('LAMMPS session ended:\n' + ''.join(out))
+            out.append(line)
+            if line.split()[:1] == ['PotEng']:
+                names  = line.split()
+                values = [float(v) for v in self.p.stdout.readline().split()]
+                return dict(zip(names, values))
+
+    # Ends LAMMPS by closing its input.
+    def close(self):
+        self.p.communicate()
+
+# A LAMMPS session using the LAMMPS Python module, the positions are 
+# scattered into LAMMPS directly.
+class ModuleSession:
+    def __init__(self, module):
+        self.lmp = module.lammps(cmdargs=['-screen', 'none', '-log', 'none'])
+
+    def load(self, datafile):
+        self.lmp.command('clear')
+        script = session_lmp_input %(input_file_terms(datafile), datafile)
+        for line in script.split('\n'): self.lmp.command(line)
+
+    def thermo(self, x):
+        x = asarray(x, dtype=float).ravel()
+        self.lmp.scatter_atoms('x', 1, 3, (ctypes.c_double*len(x))(*x))
+        self.lmp.command('run 0')
+        return dict((name, self.lmp.get_thermo(key)) 
+                    for key,name in thermo_keywords)
+
+    def close(self):
+        self.lmp.close()
+
+# Returns a LAMMPS session, using the Python module if it can be imported.
+def open_session(lmp, cwd):
+    module = lammps_module()
+    if module: return ModuleSession(module)
+    return ProcessSession(lmp, cwd)
+
+# Returns [xlo, xhi, ylo, yhi, zlo, zhi] of an (n,3) array of coordinates,
+# in one pass over the array.
+def bounds(x):
+    return column_stack((x.min(axis=0), x.max(axis=0))).ravel().tolist()
+
+# Scratch directory of a worker process of a FramePool.
+scratch = None
+# LAMMPS session of a worker process and the data file generation it read.
+session, generation = None, None
+
+# Makes a scratch directory in root for a new worker process.
+def init_worker(root):
+    global scratch
+    scratch = tempfile.mkdtemp(prefix='worker-', dir=root)
+    multiprocessing.util.Finalize(None, close_session, exitpriority=10)
+
+# Closes the LAMMPS session of a worker process when it exits.
+def close_session():
+    if session: session.close()
+
+# Runs one frame in the scratch directory of the worker, so that the data
+# files and log.lammps of different workers do not collide.  The template
+# of the data file is only parsed again when the generation changes.
+# Returns the energy and the log of the run, which is kept as
+# log.lammps.step.
+def run_frame(task):
+    base, x, step, lmp, gen = task
+    out = os.path.join(scratch, os.path.basename(base))
+    modify_data_file(base, x, step, out, gen)
+    try:
+        energy = extract_energy(run(out, step, lmp, scratch))
+    except SystemExit:
+        # extract_energy exits on a failed run, which would hang the pool.
+        raise RuntimeError('LAMMPS failed on frame %d' %step)
+    log = os.path.join(scratch, 'log.lammps.%03d'%step)
+    os.rename(os.path.join(scratch, 'log.lammps'), log)
+    return energy, log
+
+# Runs one frame in the LAMMPS session of the worker.  The data file is only
+# read again when the generation changes.  Returns the thermo output.
+def run_session_frame(task):
+    global session, generation
+    base, x, step, lmp, gen = task
+    if session == None: session = open_session(lmp, scratch)
+    if generation != gen:
+        session.load(base + '.lammps')
+        generation = gen
+    return session.thermo(x)
+
+# Runs the frames of a trajectory concurrently on a pool of worker processes
+# (by default one per cpu), each with its own scratch directory.  If session
+# is true, each worker keeps a LAMMPS session alive (see open_session) that
+# reads the data file once per call of energies, instead of launching LAMMPS
+# for every frame.  Each call of energies is a new generation of the data
+# file, which the workers read once.
+class FramePool:
+    def __init__(self, lmp, workers=None, session=False):
+        if not workers: workers = multiprocessing.cpu_count()
+        self.lmp  = lmp
+        self.session    = session
+        self.generation = 0
+        self.root = tempfile.mkdtemp(prefix='compass-fit-')
+        self.pool = multiprocessing.Pool(workers, init_worker, (self.root,))
+
+    # Returns the energy of each frame in x, in frame order.  The thermo
+    # output of the last frame is kept in self.thermo, and without sessions
+    # its log is copied to log.lammps in the working directory.
+    def energies(self, base, x):
+        base  = os.path.abspath(base)
+        self.generation += 1
+        # A timeout on get keeps the run interruptible by Ctrl-C.
+        if self.session:
+            tasks = [(base, xi, i, self.lmp, self.generation) 
+                     for i,xi in enumerate(x)]
+            thermo = self.pool.map_async(run_session_frame, tasks).get(1e9)
+            self.thermo = thermo[-1]
+            return array([t['PotEng'] for t in thermo])
+
+        tasks = [(base, xi, i, self.lmp, self.generation)
+                 for i,xi in enumerate(x)]
+        results = self.pool.map_async(run_frame, tasks).get(1e9)
+        shutil.copy(results[-1][1], 'log.lammps')
+        self.thermo = get_pe_from_log_file(results[-1][1])
+        return array([e for e,log in results])
+
+    # Stops the workers and removes their scratch directories.
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        shutil.rmtree(self.root)
 
 # Reads the potential energies reported in the log file.
 def get_pe_from_log_file(log=''):
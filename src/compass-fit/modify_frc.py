@@ -60,10 +60,54 @@ def update(oldfrc, newfrc, unknown, p):
                 modified.write(line)
                 break
 
-# Writes a formatted parameter line to the frc file.
-def write_atom_group(fid, term, atoms, p, ct):
+# Returns the terms of the sections of an frc file in the order that update
+# assigns the parameters to them.
+def section_order(oldfrc):
+    order = []
+    for line in open(oldfrc, 'r'):
+        cols = line.split()
+        if line[0] == '#' and cols[0] in headers: order.append(headers[cols[0]])
+    return order
+
+# Sets the new parameters p in the tables of frc (a frc.Frc of oldfrc), with
+# the same result as reading the file written by update.  Order is given by
+# section_order(oldfrc).
+def update_tables(frc, order, unknown, p):
+    ct = 0
+    for term in order:
+        if term in unknown: 
+            for atom_group in unknown[term]:
+                ct = set_atom_group(frc, term, atom_group, p, ct)
+
+# Replaces parameters that have not been given a starting value yet.
+def initial_guess(term, p, ct):
     if term == 'a' and abs(p[ct])<10.0 : p[ct] = 120.0
     if term == 'b' and p[ct]<0.1: p[ct] = 1.5
+    if term == 'vdw':
+        if p[ct]<0.1: p[ct] = 4.0
+        if p[ct+1]<=0.0: p[ct+1] = 0.05
+
+# Atoms are a single type for vdw and a list of types otherwise.
+def atom_list(atoms):
+    if isinstance(atoms, str): return [atoms]
+    return atoms
+
+# Sets the parameters of an atom group in the frc tables.
+def set_atom_group(frc, term, atoms, p, ct):
+    initial_guess(term, p, ct)
+    n = term_parameter_count(term, atoms)
+    param = list(p[ct:ct+n])
+    if term == 'tor' and not nonzero_torsion_angles:
+        param = [param[0], 0.0, param[1], 0.0, param[2], 0.0]
+    elif term == 'oop' and not nonzero_oop_angles:
+        param = [param[0], 0.0]
+    frc.set_param(atom_list(atoms), term, param)
+    return ct + n
+
+# Writes a formatted parameter line to the frc file.
+def write_atom_group(fid, term, atoms, p, ct):
+    initial_guess(term, p, ct)
+    atoms  = atom_list(atoms)
     natoms = len(atoms)
     line = ' 1.0   0   ' + natoms*('  %-4s') + ' '
     line = line%tuple(atoms)
@@ -84,7 +128,7 @@ def write_atom_group(fid, term, atoms, p, ct):
 # Returns parameters count for a term, some require atoms due to symmetry.
 def term_parameter_count(term, atoms=[]):    
     sizes = {'a':4,'bb':1,'aat':1,'tor':3,
-             'b':4,'aa':1,'mbt':3,'oop':1, 'bb13':1}
+             'b':4,'aa':1,'mbt':3,'oop':1, 'bb13':1, 'vdw':2}
     if nonzero_torsion_angles: sizes['tor'] = 6
     if nonzero_oop_angles:     sizes['oop'] = 2
     if term in sizes: return sizes[term]
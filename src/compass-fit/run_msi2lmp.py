@@ -12,10 +12,11 @@ from modify_frc import term_parameter_count as count
 # Calls pymsi2lmp and returns the which parameters are missing and 
 # the total number of unknown coefficients.
 def call_msi2lmp(model, frc):
-    missing = pymsi2lmp.msi2lmp(model, frc)    
-    unknown = {}
-    for m in missing:
-        if not m[0] in unknown: unknown[m[0]] = []
-        unknown[m[0]].append(m[1])
+    return unknown_parameters(pymsi2lmp.msi2lmp(model, frc))
+
+# Groups the missing parameters (a frc2lmp.Missing) by term and counts the
+# unknown coefficients.
+def unknown_parameters(missing):
+    unknown = missing.groups()
     ct = sum([sum([count(m,a) for a in unknown[m]]) for m in unknown])
     return unknown,ct
\ No newline at end of file
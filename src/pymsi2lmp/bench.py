@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""
+ bench.py - timing benchmarks for the conversion pipeline.
+    SYNOPSIS
+        bench.py [-i INPUTPATH] [-n COPIES] [-np N] [-frc COMPASSPATH]
+                 [-read] [-memory] [-bonds]
+
+    DESCRIPTION
+        Times the topology builders of molecular.System and of the array
+        engine in topology.py on the model INPUTPATH.car/.mdf and on larger
+        models made by replicating it 2, 4, ... COPIES times, so that the
+        scaling with system size can be seen.
+
+        -i INPUTPATH
+            Basename of files exported by Materials Studio, defaults to the
+            mdi-chain model in runs/mdi.
+
+        -n COPIES
+            Largest number of copies of the model to time (default 16).
+
+        -np N
+            Also times the array engine enumerating terms in N processes.
+
+        -frc COMPASSPATH
+            Times reading the frc file, parsed and from the cache, instead.
+
+        -read
+            Times reading the car and mdf files line by line and with the
+            bulk reader instead, and reports the throughput in atoms/s.
+
+        -memory
+            Reports the bytes per atom and per topology term held by the
+            slotted Atom and AtomSet objects, by the same objects with a
+            per-instance dictionary, and by the arrays of insight.Model and
+            topology.Topology instead.
+
+        -bonds
+            Checks the bonds perceived from the coordinates (bonding.py)
+            against the bonds of the mdf file, then times perception on
+            periodic boxes of 1, 8, ... COPIES copies of the model, shifted
+            so that molecules cross the faces of the box, checking the bonds
+            of each.
+"""
+import os
+import sys
+import time
+import insight
+import frc
+import bonding
+from box import Box
+import numpy as np
+from molecular import Atom, System
+from topology import Topology
+
+default_model = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'runs', 'mdi', 'mdi-chain')
+
+# Returns a system made of n copies of the atoms in system.
+def replicate(system, n):
+    atoms = []
+    for c in range(n):
+        offset = c*len(system.atoms)
+        for a in system.atoms:
+            b      = Atom()
+            b.x    = a.x[:]
+            b.conn = [j+offset for j in a.conn]
+            b.seq  = a.seq
+            b.ff   = a.ff
+            b.sym  = a.sym
+            b.q    = a.q
+            atoms.append(b)
+    return System(atoms, system.title, system.pbc, system.bounds)
+
+# Returns the wall time of the fastest of repeat calls to f.
+def best_time(f, repeat=3):
+    t = []
+    for i in range(repeat):
+        t0 = time.time()
+        f()
+        t.append(time.time()-t0)
+    return min(t)
+
+# Times each topology builder on the system for both engines, and for the
+# array engine in the given number of processes.
+def topology(system, processes=1):
+    print '%8s %6s %8s %8s %10s %12s' %('atoms','engine','builder','terms',
+                                        'time (s)','terms/s')
+    engines = [('list', lambda: system), ('array', lambda: Topology(system))]
+    if processes > 1:
+        engines.append(('np %d' %processes,
+                        lambda: Topology(system, processes)))
+    for engine, make in engines:
+        t0 = time.time()
+        e  = make()
+        print '%8d %6s %8s %8s %10.4f' %(len(system.atoms), engine, 'setup', '',
+                                         time.time()-t0)
+        for name in ['bonds', 'angles', 'dihedrals', 'impropers']:
+            builder = getattr(e, name)
+            terms   = len(builder()[0])
+            t       = best_time(builder)
+            print '%8d %6s %8s %8d %10.4f %12.0f' %(len(system.atoms), engine,
+                                   name[:8], terms, t, terms/max(t, 1e-9))
+        if e is not system: e.close()
+
+# Times reading an frc file with and without the parsed table cache.
+def frc_read(path):
+    frc.Frc(path)
+    parse = best_time(lambda: frc.Frc(path, cache=False), 10)
+    cache = best_time(lambda: frc.Frc(path), 10)
+    print '%s: parse %.2f ms, cached %.2f ms' %(path, 1e3*parse, 1e3*cache)
+
+# Times reading the car and mdf files with both readers.
+def read(base):
+    def lines():
+        atoms, index, pbc, bounds = insight.read_car(base + '.car')
+        insight.read_mdf(base + '.mdf', atoms, index)
+    n = len(insight.read_model(base).x)
+    print '%8s %8s %10s %12s' %('atoms', 'reader', 'time (s)', 'atoms/s')
+    for reader, f in [('lines', lines),
+                      ('bulk', lambda: insight.read_model(base)),
+                      ('system', lambda: insight.get_system(base))]:
+        t = best_time(f, 10)
+        print '%8d %8s %10.4f %12.0f' %(n, reader, t, n/max(t, 1e-9))
+
+# Returns the bonds of a CSR adjacency as sorted keys i*n+j, i < j.
+def bond_keys(indptr, indices):
+    i, j = bonding.bond_pairs(indptr, indices)
+    return np.sort(i*(len(indptr) - 1) + j)
+
+# Compares the perceived bonds with the bonds of the mdf file, and times
+# perception on periodic boxes of copies of the model.
+def bonds(base, copies):
+    model = insight.read_model(base)
+    r     = bonding.radii(model.sym_names)[model.sym]
+    mdf   = bond_keys(model.indptr, model.indices)
+    found = bond_keys(*bonding.perceive(model.x, r))
+    n     = len(model.x)
+    print '%s: %d mdf bonds, %d perceived, %d missing, %d extra' %(base,
+           len(mdf), len(found), len(np.setdiff1d(mdf, found)),
+           len(np.setdiff1d(found, mdf)))
+    # Copies on a grid with a gap of 3 Angstrom, shifted and wrapped into
+    # the periodic box.
+    lo   = model.x.min(axis=0)
+    cell = model.x.max(axis=0) - lo + 3.0
+    print '%8s %8s %10s %12s %6s' %('atoms', 'bonds', 'time (s)', 'atoms/s', 'check')
+    k = 1
+    while k**3 <= copies:
+        grid  = np.array([(a,b,c) for a in range(k) for b in range(k) for c in range(k)])
+        x     = (model.x - lo)[None,:,:] + (grid*cell)[:,None,:] + 0.5*cell
+        box   = k*cell
+        x     = (x.reshape(-1, 3) % box)
+        rk    = np.tile(r, k**3)
+        t0    = time.time()
+        indptr, indices = bonding.perceive(x, rk, Box(box))
+        t     = time.time() - t0
+        m     = k**3*n
+        offset   = n*np.arange(k**3)[:,None]
+        expected = ((mdf // n)[None,:] + offset)*m + (mdf % n)[None,:] + offset
+        check = np.array_equal(bond_keys(indptr, indices), np.sort(expected.ravel()))
+        print '%8d %8d %10.4f %12.0f %6s' %(m, len(indices)//2, t, m/max(t, 1e-9),
+                                            'ok' if check else 'FAILED')
+        k *= 2
+
+# Instances with a per-instance dictionary, as Atom and AtomSet had.
+class DictObject:
+    pass
+
+# Returns a copy of the slotted obj that keeps its attributes in a
+# dictionary, with tuples as lists.
+def with_dict(obj):
+    d = DictObject()
+    for name in obj.__slots__:
+        value = getattr(obj, name)
+        if isinstance(value, tuple): value = list(value)
+        setattr(d, name, value)
+    return d
+
+# Returns the bytes held by obj and the objects it refers to, counting each
+# object that is not in seen once.
+def size_of(obj, seen):
+    if id(obj) in seen: return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        size += sum(size_of(x, seen) for x in obj)
+    elif isinstance(obj, dict):
+        size += sum(size_of(k, seen) + size_of(v, seen) for k,v in obj.items())
+    elif hasattr(obj, '__slots__'):
+        size += sum(size_of(getattr(obj, n), seen) for n in obj.__slots__)
+    elif hasattr(obj, '__dict__'):
+        size += size_of(obj.__dict__, seen)
+    return size
+
+# Reports the bytes per atom and per term of each representation.
+def memory(base):
+    model  = insight.read_model(base)
+    system = insight.get_system(base)
+    terms  = []
+    for name in ['bonds', 'angles', 'dihedrals', 'impropers']:
+        terms += getattr(system, name)()[0]
+    topology = Topology(system)
+    arrays   = 0
+    for name in ['bonds', 'angles', 'dihedrals', 'impropers']:
+        a, tid, types = getattr(topology, name)()
+        arrays += a.nbytes + tid.nbytes
+    rows = [('atoms', len(system.atoms),
+             [('dict', size_of([with_dict(a) for a in system.atoms], set())),
+              ('slots', size_of(system.atoms, set())),
+              ('arrays', sum(getattr(model, n).nbytes for n in
+                             ['x','q','seq','ff','sym','indptr','indices']))]),
+            ('terms', len(terms),
+             [('dict', size_of([with_dict(t) for t in terms], set())),
+              ('slots', size_of(terms, set())),
+              ('arrays', arrays)])]
+    print '%8s %8s %8s %12s %10s' %('', 'count', 'layout', 'bytes', 'per item')
+    for name, n, sizes in rows:
+        for layout, size in sizes:
+            print '%8s %8d %8s %12d %10.1f' %(name, n, layout, size,
+                                              size/float(max(n, 1)))
+
+def main(args):
+    base, copies, processes = default_model, 16, 1
+    for i in range(1, len(args)):
+        if args[i] == '-i':   base   = args[i+1]
+        elif args[i] == '-n': copies = int(args[i+1])
+        elif args[i] == '-np': processes = int(args[i+1])
+        elif args[i] == '-frc': return frc_read(args[i+1])
+        else: continue
+    if '-read' in args: return read(base)
+    if '-memory' in args: return memory(base)
+    if '-bonds' in args: return bonds(base, copies)
+
+    system = insight.get_system(base)
+    n = 1
+    while n <= copies:
+        topology(replicate(system, n), processes)
+        n *= 2
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+ bonding.py - perceives bonds from atomic coordinates, for models without an
+              mdf file (or with a stale one).  Atoms are bonded if they are
+              closer than the sum of their covalent radii plus a tolerance.
+              Close pairs are found with a cell list: atoms are binned into
+              cells at least as wide as the largest bond length, so only
+              atoms in the same or adjacent cells are compared, and the work
+              grows linearly with the number of atoms.  Periodic boxes (see
+              box.py) are wrapped, with distances taken to the nearest image.
+              Bonds of any origin can be checked for unphysical lengths, such
+              as those of molecules wrapped wrongly into their box.
+"""
+import sys
+import itertools
+import numpy as np
+from topology import expand
+
+# Covalent radii (Angstrom) by element, from Cordero et al., Dalton Trans.
+# (2008) 2832.  Carbon is sp3 and iron is low spin.
+covalent_radii = {'H':  0.31, 'He': 0.28, 'Li': 1.28, 'Be': 0.96, 'B':  0.84,
+                  'C':  0.76, 'N':  0.71, 'O':  0.66, 'F':  0.57, 'Ne': 0.58,
+                  'Na': 1.66, 'Mg': 1.41, 'Al': 1.21, 'Si': 1.11, 'P':  1.07,
+                  'S':  1.05, 'Cl': 1.02, 'Ar': 1.06, 'K':  2.03, 'Ca': 1.76,
+                  'Ti': 1.60, 'Fe': 1.32, 'Cu': 1.32, 'Zn': 1.22, 'Ge': 1.20,
+                  'As': 1.19, 'Se': 1.20, 'Br': 1.20, 'Kr': 1.16, 'Sn': 1.39,
+                  'I':  1.39, 'Xe': 1.40}
+
+# Distance (Angstrom) added to the sum of the covalent radii of a bond.
+tolerance = 0.45
+
+# Bonds are unphysical if shorter than shortest (Angstrom), or longer than
+# stretch times the longest bond perceived between their elements.
+shortest = 0.5
+stretch  = 1.5
+
+# Returns the covalent radius of each element name as an array.  Elements
+# without a radius get default, or if it is None, stop the program.
+def radii(elements, default=None):
+    r = []
+    for e in elements:
+        e = e.capitalize()
+        if not e in covalent_radii and default is not None:
+            r.append(default)
+            continue
+        if not e in covalent_radii:
+            print 'Element', e, 'has no covalent radius, add it to bonding.py.'
+            sys.exit(1)
+        r.append(covalent_radii[e])
+    return np.array(r)
+
+# Returns the cell of each atom of a cell list and the number of cells
+# along each axis.  A periodic box (a box.Box) is divided into whole cells
+# at least cutoff wide between their faces, in fractional coordinates;
+# otherwise cutoff wide cells span the atoms.
+def cell_grid(x, cutoff, box):
+    if box is not None:
+        n = np.maximum(1, np.floor(box.widths/cutoff)).astype(np.int64)
+        return np.floor(box.fractional(x)*n).astype(np.int64) % n, n
+    lo = x.min(axis=0)
+    n  = np.floor((x.max(axis=0) - lo)/cutoff).astype(np.int64) + 1
+    return np.clip(np.floor((x - lo)/cutoff).astype(np.int64), 0, n-1), n
+
+# Returns the shifts from a cell to its neighbors along an axis of n cells,
+# each neighbor cell once (a periodic axis of 1 or 2 cells has fewer).
+def axis_shifts(n, pbc):
+    if pbc and n < 3: return sorted(set(s % n for s in (-1, 0, 1)))
+    return [-1, 0, 1]
+
+# Returns the distances between atoms i and j (arrays) at coordinates x, to
+# the nearest image in box (a box.Box) if it is given.
+def bond_lengths(x, i, j, box=None):
+    d = x[j] - x[i]
+    if box is not None: d = box.minimum_image(d)
+    return np.sqrt((d*d).sum(axis=1))
+
+# Yields the pairs of atoms closer than cutoff, each once, as arrays i, j and
+# their distances.  In a periodic box (a box.Box) the distance is to the
+# nearest image, so the box must be at least twice the cutoff wide.
+def close_pairs(x, cutoff, box=None):
+    x = np.asarray(x, dtype=float).reshape(-1, 3)
+    if len(x) == 0: return
+    pbc   = box is not None
+    c, n  = cell_grid(x, cutoff, box)
+    cell  = (c[:,0]*n[1] + c[:,1])*n[2] + c[:,2]
+    order = np.argsort(cell, kind='mergesort')
+    # Occupied cells, their atoms being order[start:start+count].
+    occupied, start, count = np.unique(cell[order], return_index=True,
+                                       return_counts=True)
+    oc = np.column_stack((occupied // (n[1]*n[2]), occupied // n[2] % n[1],
+                          occupied % n[2]))
+    shifts = list(itertools.product(*[axis_shifts(n[d], pbc) for d in range(3)]))
+    # Unless a periodic axis has fewer than 3 cells, each pair of neighbor
+    # cells is visited once, by the half of the shifts above (0,0,0).
+    half = not pbc or (n >= 3).all()
+    if half: shifts = [t for t in shifts if t >= (0,0,0)]
+    for shift in shifts:
+        b = oc + shift
+        if pbc: b %= n
+        valid = ((b >= 0) & (b < n)).all(axis=1)
+        a = np.flatnonzero(valid)
+        key = (b[a,0]*n[1] + b[a,1])*n[2] + b[a,2]
+        k = np.minimum(np.searchsorted(occupied, key), len(occupied)-1)
+        hit = occupied[k] == key
+        a, k = a[hit], k[hit]
+        # Every atom of cell a against every atom of its neighbor cell k.
+        p, local = expand(count[a]*count[k])
+        i = order[start[a][p] + local // count[k][p]]
+        j = order[start[k][p] + local %  count[k][p]]
+        if not half or shift == (0,0,0):
+            keep = i < j
+            i, j = i[keep], j[keep]
+        r = bond_lengths(x, i, j, box)
+        keep = r < cutoff
+        yield i[keep], j[keep], r[keep]
+
+# Returns the bonds of a CSR adjacency as arrays i, j with i < j.
+def bond_pairs(indptr, indices):
+    i = np.repeat(np.arange(len(indptr)-1, dtype=np.int64), np.diff(indptr))
+    keep = i < indices
+    return i[keep], indices[keep].astype(np.int64)
+
+# Returns the bonds between atoms i and j (arrays) of lengths that cannot be
+# right for atoms with covalent radii r, as their positions in i and j and
+# their lengths.  Lengths are to the nearest image in box if it is given.
+def unphysical_bonds(x, r, i, j, box=None):
+    x = np.asarray(x, dtype=float).reshape(-1, 3)
+    d = bond_lengths(x, i, j, box)
+    bad = np.flatnonzero((d < shortest) | (d > stretch*(r[i] + r[j] + tolerance)))
+    return bad, d[bad]
+
+# Returns the bonds perceived from the coordinates x of atoms with covalent
+# radii r (see radii), as a CSR adjacency (indptr, indices) with the
+# neighbors of each atom in increasing order.  Distances are to the nearest
+# image in box (a box.Box) if it is given.
+def perceive(x, r, box=None):
+    r = np.asarray(r, dtype=float)
+    if len(r) == 0:
+        return np.zeros(1, dtype=np.int32), np.zeros(0, dtype=np.int32)
+    cutoff = 2.0*r.max() + tolerance
+    i, j   = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for a, b, d in close_pairs(x, cutoff, box):
+        bonded = d < r[a] + r[b] + tolerance
+        i.append(a[bonded])
+        j.append(b[bonded])
+    i, j = np.concatenate(i), np.concatenate(j)
+    row, col = np.concatenate((i, j)), np.concatenate((j, i))
+    order    = np.lexsort((col, row))
+    indptr   = np.zeros(len(r)+1, dtype=np.int32)
+    np.cumsum(np.bincount(row, minlength=len(r)), out=indptr[1:])
+    return indptr, col[order].astype(np.int32)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+ box.py - the periodic simulation box of a model.  The box is set up once
+          from the cell lengths and angles of the car file, in the LAMMPS
+          orientation (a along x, b in the xy plane), and gives the bounds
+          and tilt factors of the data file, the wrapping of atoms into the
+          box and the nearest image of a displacement.  Orthogonal boxes
+          are worked out per axis, triclinic ones in fractional coordinates.
+"""
+import itertools
+import numpy as np
+
+# Periodic box with edge vectors a, b and c of the given lengths and angles
+# alpha (b,c), beta (a,c) and gamma (a,b) in degrees, its lower corner at lo.
+class Box:
+    def __init__(self, lengths, angles=(90.0, 90.0, 90.0), lo=(0.0, 0.0, 0.0)):
+        a, b, c = [float(l) for l in lengths]
+        self.lo = np.array(lo, dtype=float)
+        # Right angles are exact, so orthogonal boxes have no tilt at all.
+        cos = [0.0 if t == 90.0 else np.cos(np.radians(t)) for t in angles]
+        xy  = b*cos[2]
+        xz  = c*cos[1]
+        ly  = np.sqrt(b*b - xy*xy)
+        yz  = (b*c*cos[0] - xy*xz)/ly
+        lz  = np.sqrt(c*c - xz*xz - yz*yz)
+        # Rows are the edge vectors.
+        self.h = np.array([[a, 0.0, 0.0], [xy, ly, 0.0], [xz, yz, lz]])
+        self.lengths   = self.h.diagonal().copy()
+        self.tilt      = (xy, xz, yz)
+        self.triclinic = any(t != 0.0 for t in self.tilt)
+        self.hinv      = np.linalg.inv(self.h)
+        # Reduced basis of the lattice and the vectors to the 26 neighbors
+        # of a cell in it, for minimum_image.
+        self.reduced = reduced_basis(self.h)
+        self.rinv    = np.linalg.inv(self.reduced)
+        self.shifts  = [np.dot(n, self.reduced)
+                        for n in itertools.product((-1, 0, 1), repeat=3)
+                        if n != (0, 0, 0)]
+        hi = self.lo + self.lengths
+        # xlo, xhi, ylo, yhi, zlo, zhi of the data file.
+        self.bounds = tuple(np.column_stack((self.lo, hi)).ravel().tolist())
+        # Distance between opposite faces, the widest sphere the box holds.
+        if self.triclinic:
+            v = abs(np.linalg.det(self.h))
+            self.widths = v/np.sqrt((np.cross(self.h[[1,2,0]],
+                                              self.h[[2,0,1]])**2).sum(axis=1))
+        else:
+            self.widths = self.lengths
+
+    # Returns the fractional coordinates of x, in [0,1] inside the box.
+    def fractional(self, x):
+        if self.triclinic: return (x - self.lo).dot(self.hinv)
+        return (x - self.lo)/self.lengths
+
+    # Returns the displacements d taken to their nearest image, for any
+    # displacement and any cell.  Rounding fractional displacements is
+    # exact for orthogonal boxes only, so in a triclinic box they are
+    # rounded in the reduced basis and then moved to a neighboring image
+    # for as long as one is nearer.  With the basis reduced, the nearer
+    # neighbors are enough to find the nearest image.
+    def minimum_image(self, d):
+        if not self.triclinic:
+            return d - self.lengths*np.round(d/self.lengths)
+        s = d.dot(self.rinv)
+        d = (s - np.round(s)).dot(self.reduced)
+        r = (d*d).sum(axis=-1)
+        moved = True
+        while moved:
+            moved = False
+            for shift in self.shifts:
+                e = d + shift
+                q = (e*e).sum(axis=-1)
+                closer = q < r
+                if closer.any():
+                    d = np.where(closer[...,None], e, d)
+                    r = np.where(closer, q, r)
+                    moved = True
+        return d
+
+    # Returns whether each atom of x is outside the box, faces excluded.
+    def outside(self, x):
+        if self.triclinic:
+            s = self.fractional(x)
+            return ((s < 0) | (s > 1)).any(axis=1)
+        lo, hi = np.array(self.bounds[0::2]), np.array(self.bounds[1::2])
+        return ((x < lo) | (x > hi)).any(axis=1)
+
+    # Returns the coordinates x wrapped into the box.  Atoms below a face
+    # are shifted by whole periods until they are at or above it, atoms
+    # above the opposite face until they are at or below it.  Atoms in the
+    # box or on a face are not moved.  In an orthogonal box periods are
+    # added one at a time to the coordinates still out, so that the result
+    # is the same to the last bit as shifting each atom in a loop.
+    def wrap(self, x):
+        if not self.triclinic:
+            lo = np.array(self.bounds[0::2])
+            hi = np.array(self.bounds[1::2])
+            y  = np.array(x, dtype=float)
+            dy = np.broadcast_to(hi - lo, y.shape)
+            below = y < lo
+            while below.any():
+                y[below] += dy[below]
+                below = y < lo
+            above = y > hi
+            while above.any():
+                y[above] -= dy[above]
+                above = y > hi
+            return y
+        s = self.fractional(x)
+        n = np.where(s < 0, np.ceil(-s), 0.0) - np.where(s > 1, np.ceil(s-1), 0.0)
+        y = x + n.dot(self.h)
+        # Corrects for rounding in n, which could leave an atom out by a period.
+        s = self.fractional(y)
+        return y + (np.where(s < 0, 1.0, 0.0) - np.where(s > 1, 1.0, 0.0)).dot(self.h)
+
+# Returns a basis of the lattice of the rows of h whose vectors are as short
+# as combinations with the other two allow (Minkowski reduced), found by
+# replacing a vector with a shorter combination until there is none.
+def reduced_basis(h):
+    b = np.array(h, dtype=float)
+    m = np.array([(p, q) for p in range(-2, 3) for q in range(-2, 3)], dtype=float)
+    shortened = True
+    while shortened:
+        shortened = False
+        for i in range(3):
+            j, k = [a for a in range(3) if a != i]
+            v = b[i] + m[:,:1]*b[j] + m[:,1:]*b[k]
+            r = (v*v).sum(axis=1)
+            best = r.argmin()
+            if r[best] < (1.0 - 1e-12)*b[i].dot(b[i]):
+                b[i] = v[best]
+                shortened = True
+    return b
+
+# Returns the orthogonal box with bounds (xlo, xhi, ylo, yhi, zlo, zhi).
+def from_bounds(bounds):
+    lo  = np.array(bounds[0::2], dtype=float)
+    box = Box(np.array(bounds[1::2], dtype=float) - lo, lo=lo)
+    box.bounds = tuple(float(v) for v in bounds)
+    return box
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+ bundle.py - a binary companion of the LAMMPS data file, for tools that
+             would otherwise parse the text.  The bundle is an uncompressed
+             .npz archive holding the sections of the data file as arrays,
+             with ids and types numbered from 1 as in the data file:
+
+                bounds            xlo xhi ylo yhi zlo zhi
+                tilt              xy xz yz, for triclinic boxes only
+                atom_type         (N,) type of each atom
+                molecule          (N,) molecule column of each atom
+                charge            (N,) charge of each atom
+                x                 (N,3) coordinates
+                bonds, angles,    (M,k) atom ids of each term
+                dihedrals,
+                impropers
+                bond_type, ...    (M,) type of each term
+                atom_types, ...   force field type names of each type
+                masses            mass of each atom type
+                pair_coeffs, ...  coefficients of each type, one array per
+                                  Coeffs section (e.g. bondbond13_coeffs)
+
+             As the members of the archive are stored, load maps them into
+             memory instead of reading them.
+"""
+import struct
+import zipfile
+import numpy as np
+
+# Returns the bundle name of a Coeffs section, e.g. 'bondbond13_coeffs'.
+def coeffs_name(header):
+    return header.split()[0].lower() + '_coeffs'
+
+# Writes the arrays (a dictionary of name -> array) as a bundle to path.
+def write(path, arrays):
+    fid = open(path, 'wb')
+    np.savez(fid, **arrays)
+    fid.close()
+
+# Returns the arrays of the bundle at path as a dictionary.  If mmap is true,
+# arrays stored uncompressed are mapped read-only from the file; others are
+# read.
+def load(path, mmap=True):
+    arrays = {}
+    archive = zipfile.ZipFile(path)
+    fid = open(path, 'rb')
+    for info in archive.infolist():
+        name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+        array = None
+        if mmap and info.compress_type == zipfile.ZIP_STORED:
+            array = map_member(path, fid, info)
+        if array is None:
+            array = np.lib.format.read_array(archive.open(info.filename))
+        arrays[name] = array
+    fid.close()
+    archive.close()
+    return arrays
+
+# Returns a stored .npy member of the archive fid at path, mapped into
+# memory, or None if it cannot be mapped (objects or no data).
+def map_member(path, fid, info):
+    # The data follows the local file header, its name and extra field.
+    fid.seek(info.header_offset)
+    local = fid.read(30)
+    name_length, extra_length = struct.unpack('<HH', local[26:30])
+    fid.seek(info.header_offset + 30 + name_length + extra_length)
+    version = np.lib.format.read_magic(fid)
+    if version == (1, 0):
+        shape, fortran, dtype = np.lib.format.read_array_header_1_0(fid)
+    else:
+        shape, fortran, dtype = np.lib.format.read_array_header_2_0(fid)
+    if dtype.hasobject or int(np.prod(shape)) == 0: return None
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape,
+                     order='F' if fortran else 'C', offset=fid.tell())
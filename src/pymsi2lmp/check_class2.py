@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+ check_class2.py - checks the class2 energy terms of class2.py against those
+                   recorded from LAMMPS.
+
+    SYNOPSIS
+
+      check_class2.py [frc_path]
+
+    DESCRIPTION
+
+      For each model in recorded (a periodic triclinic one and one that is
+      not periodic), writes the data file of the model with the frc file
+      frc_path (default data/compass.frc) and checks that it is the data
+      file base.thermo.data that LAMMPS was run on (see base.thermo.in), so
+      that the record still applies.  Then checks that Class2.thermo gives
+      the energy terms of base.thermo.log, term by term, to within 1e-6
+      kcal/mol plus 1e-9 of the term.
+
+      The coordinates of the car file are used, which are not wrapped into
+      the box, and a second frame moves every atom by whole periods (or the
+      model by a translation if it is not periodic), which must not change
+      the terms.
+
+      amide-rings has types that data/compass.frc lacks, which are given
+      the parameters of the types in stand_ins so that no term is left out.
+
+      Prints FAILED and exits with 1 otherwise.
+"""
+import os
+import sys
+import numpy as np
+from cStringIO import StringIO
+import insight
+import frc
+import lammps_writer
+import class2
+
+here = os.path.dirname(os.path.abspath(__file__))
+runs = os.path.join(here, '..', '..', 'runs')
+default_frc = os.path.join(here, '..', '..', 'data', 'compass.frc')
+
+# Models with a recorded LAMMPS run, by basename under runs.
+recorded = ['amide-rings/amide-rings', 'triclinic/benzene-methanol']
+
+# Types missing from data/compass.frc and the types whose parameters they
+# take, for every interaction.
+stand_ins = [('c3"', "c3'"), ('n3mh', 'n3m'), ('h1n', 'h1')]
+
+# Gives each type in stand_ins that compass lacks the parameters of its
+# stand-in.
+def add_stand_ins(compass):
+    for t, s in stand_ins:
+        if t in compass.types: continue
+        compass.types[t] = compass.types[s]
+        compass.equiv[t] = compass.equiv[s]
+        compass.set_param([t], 'vdw', compass.direct([s], 'vdw'))
+
+# Returns the energy terms of the thermo output of a LAMMPS log, by name.
+def read_thermo(path):
+    lines = open(path).readlines()
+    for k, line in enumerate(lines):
+        names = line.split()
+        if names[:1] == ['PotEng']:
+            return dict(zip(names, [float(v) for v in lines[k+1].split()]))
+    return {}
+
+# Returns the data file of system with the parameters of compass, without
+# its title line.
+def data_file(system, compass):
+    fid = StringIO()
+    lammps_writer.DataWriter(system).write(fid, compass)
+    return fid.getvalue().split('\n', 1)[1]
+
+# Returns the coordinates of system moved by random whole periods of its box,
+# or by a random translation if it has none.
+def moved(system, rng):
+    x = np.asarray(system.x, dtype=float)
+    if system.box is None: return x + rng.uniform(-20.0, 20.0, 3)
+    return x + rng.randint(-2, 3, x.shape).dot(system.box.h)
+
+def main(args):
+    frcpath = os.path.abspath(args[1] if len(args) > 1 else default_frc)
+    rng, failed = np.random.RandomState(1), []
+    for model in recorded:
+        base = os.path.join(runs, model)
+        compass = frc.Frc(frcpath)
+        add_stand_ins(compass)
+        system = insight.get_system(base, False, compass)
+        if data_file(system, compass) != open(base + '.thermo.data').read().split('\n', 1)[1]:
+            failed.append('%s: the data file is not the one recorded' %model)
+        lammps = read_thermo(base + '.thermo.log')
+        if not lammps:
+            failed.append('%s: no thermo output in %s.thermo.log' %(model, model))
+        energy = class2.Class2(system, compass)
+        terms  = energy.thermo(np.array([system.x, moved(system, rng)]))
+        print model
+        for name in sorted(lammps):
+            e = terms[name]
+            print '  %-8s %20.10f %20.10f' %(name, lammps[name], e[0])
+            if abs(e[0] - lammps[name]) > 1e-6 + 1e-9*abs(lammps[name]):
+                failed.append('%s: %s is %.10f, LAMMPS gives %.10f'
+                              %(model, name, e[0], lammps[name]))
+            if abs(e[1] - e[0]) > 1e-6 + 1e-9*abs(e[0]):
+                failed.append('%s: %s changed from %.10f to %.10f with atoms moved'
+                              %(model, name, e[0], e[1]))
+
+    for f in failed: print 'FAILED:', f
+    if failed: sys.exit(1)
+    print 'OK'
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+ check_periodic.py - checks the data files written for a periodic triclinic
+                     model against the cell of its car file.
+
+    SYNOPSIS
+
+      check_periodic.py [basename] [frc_path]
+
+    DESCRIPTION
+
+      Converts basename (default runs/triclinic/benzene-methanol) in a scratch
+      directory with the frc file frc_path (default data/compass.frc), with
+      the System builders, with -stream and with -perceive, and checks that:
+
+        - the bounds and the xy xz yz line of the header are those of the
+          PBC line of the car file, worked out here from the LAMMPS formulas,
+        - every atom is in the box, and was moved from its car position by
+          whole periods only (the model has atoms outside its box),
+        - no bond of unphysical length is reported, as bonds that cross a
+          face are measured to the nearest image,
+        - the three data files are the same, but for the charges and terms
+          of -perceive, which takes the charges from the car file; its bonds
+          are those of the mdf file.
+
+      Box.minimum_image is also checked against a search of all images
+      near random displacements, in cells as skewed as LAMMPS allows.
+
+      Prints FAILED and exits with 1 otherwise.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import itertools
+import numpy as np
+from box import Box
+
+here = os.path.dirname(os.path.abspath(__file__))
+default_model = os.path.join(here, '..', '..', 'runs', 'triclinic', 'benzene-methanol')
+default_frc   = os.path.join(here, '..', '..', 'data', 'compass.frc')
+
+# Returns the cell (a b c alpha beta gamma) and the coordinates of a car file.
+def read_car(path):
+    cell, x = None, []
+    for line in open(path):
+        c = line.split()
+        if c[:1] == ['PBC'] and len(c) >= 7: cell = [float(v) for v in c[1:7]]
+        elif len(c) == 9: x.append([float(v) for v in c[1:4]])
+    return cell, np.array(x)
+
+# Returns the header lines of a data file ending in key (e.g. 'xlo xhi') as
+# lists of numbers, and the sections as lists of lines, by section name.
+def read_data(path):
+    header, sections, name = {}, {}, None
+    fid = open(path)
+    fid.readline()
+    for line in fid:
+        c = line.split()
+        if not c: continue
+        if c[0][0].isalpha():
+            name = line.strip()
+            sections[name] = []
+        elif name:
+            sections[name].append(c)
+        else:
+            header[' '.join(x for x in c if x[0].isalpha())] = [float(v) for v in c
+                                                                if not v[0].isalpha()]
+    fid.close()
+    return header, sections
+
+# Returns whether the numbers a equal b to within 1e-8, as printed.
+def same(a, b):
+    return len(a) == len(b) and np.allclose(a, b, rtol=0, atol=1e-8)
+
+# Returns the edge vectors (rows) of the LAMMPS box of a cell.
+def cell_vectors(cell):
+    a, b, c = cell[0:3]
+    cos = np.cos(np.radians(cell[3:6]))
+    lx = a
+    xy = b*cos[2]
+    xz = c*cos[1]
+    ly = np.sqrt(b*b - xy*xy)
+    yz = (b*c*cos[0] - xy*xz)/ly
+    lz = np.sqrt(c*c - xz*xz - yz*yz)
+    return np.array([[lx, 0.0, 0.0], [xy, ly, 0.0], [xz, yz, lz]])
+
+# Runs pymsi2lmp.py on base with the frc file at frcpath and the options,
+# returns its output and the data file.
+def convert(base, frcpath, options):
+    out = subprocess.Popen([sys.executable, os.path.join(here, 'pymsi2lmp.py'),
+                            '-i', base, '-frc', frcpath] + options,
+                           stdout=subprocess.PIPE).communicate()[0]
+    return out, read_data(base + '.lammps')
+
+# Returns the bonds of the sections of a data file as a set of atom pairs.
+def bond_set(sections):
+    return set(tuple(sorted(int(v) for v in c[2:4])) for c in sections.get('Bonds', []))
+
+# Returns the number of random displacements whose minimum image is longer
+# than the nearest image found by searching every image within five periods,
+# in cells with random tilts of up to half their edge lengths.
+def minimum_image_misses(cells=20, n=500):
+    rng, misses = np.random.RandomState(1), 0
+    for k in range(cells):
+        lx, ly, lz = rng.uniform(10.0, 30.0, 3)
+        xy, xz, yz = rng.uniform(-0.5, 0.5, 3)*[lx, lx, ly]
+        # The cell of these edge vectors.
+        a, b, c = lx, np.sqrt(xy*xy + ly*ly), np.sqrt(xz*xz + yz*yz + lz*lz)
+        cos = [(xy*xz + ly*yz)/(b*c), xz/c, xy/b]
+        box = Box((a, b, c), np.degrees(np.arccos(cos)))
+        d = rng.uniform(-2.0, 2.0, (n, 3)).dot(box.h)
+        nearest = np.inf
+        for m in itertools.product(range(-5, 6), repeat=3):
+            e = d + np.dot(m, box.h)
+            nearest = np.minimum(nearest, (e*e).sum(axis=1))
+        r = (box.minimum_image(d)**2).sum(axis=1)
+        misses += (r > nearest*(1.0 + 1e-12)).sum()
+    return misses
+
+def main(args):
+    model   = os.path.abspath(args[1] if len(args) > 1 else default_model)
+    frcpath = os.path.abspath(args[2] if len(args) > 2 else default_frc)
+    cwd, scratch = os.getcwd(), tempfile.mkdtemp(prefix='check-periodic-')
+    failed = []
+    try:
+        os.chdir(scratch)
+        base = os.path.basename(model)
+        for ext in ['.car', '.mdf']: shutil.copy(model + ext, base + ext)
+        cell, x0 = read_car(base + '.car')
+        h = cell_vectors(cell)
+        runs = [(name, convert(base, frcpath, options)) for name, options in
+                [('builders', []), ('-stream', ['-stream']), ('-perceive', ['-perceive'])]]
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch)
+
+    for name, (out, (header, sections)) in runs:
+        bounds = header.get('xlo xhi', []) + header.get('ylo yhi', []) + header.get('zlo zhi', [])
+        if not same(bounds, [0.0, h[0,0], 0.0, h[1,1], 0.0, h[2,2]]):
+            failed.append('%s: bounds %s, not those of the cell' %(name, bounds))
+        if not same(header.get('xy xz yz', []), [h[1,0], h[2,0], h[2,1]]):
+            failed.append('%s: tilt %s, not that of the cell' %(name, header.get('xy xz yz')))
+        if 'unphysical' in out:
+            failed.append('%s: bonds reported as unphysical:\n%s' %(name, out))
+        atoms = sorted(sections['Atoms'], key=lambda c: int(c[0]))
+        x = np.array([[float(v) for v in c[4:7]] for c in atoms])
+        s = x.dot(np.linalg.inv(h))
+        outside = ((s < -1e-9) | (s > 1+1e-9)).any(axis=1)
+        if outside.any():
+            failed.append('%s: %d atoms outside the box' %(name, outside.sum()))
+        periods = (x - x0).dot(np.linalg.inv(h))
+        if np.abs(periods - np.round(periods)).max() > 1e-6:
+            failed.append('%s: atoms moved by other than whole periods' %name)
+        wrapped = np.round(periods).any(axis=1).sum()
+        if not wrapped:
+            failed.append('%s: no atom was wrapped, the model does not check wrapping' %name)
+
+    misses = minimum_image_misses()
+    if misses:
+        failed.append('minimum_image missed the nearest image of %d displacements' %misses)
+
+    data = [r[1][1] for r in runs]
+    if data[0] != data[1]:
+        failed.append('-stream: the data file differs from that of the builders')
+    if bond_set(data[2][1]) != bond_set(data[0][1]):
+        failed.append('-perceive: the bonds differ from those of the mdf file')
+    if data[2][0] != data[0][0] or \
+       [c[4:7] for c in data[2][1]['Atoms']] != [c[4:7] for c in data[0][1]['Atoms']]:
+        failed.append('-perceive: the header or coordinates differ from those of the builders')
+
+    for f in failed: print 'FAILED:', f
+    if failed: sys.exit(1)
+    print '%d of %d atoms wrapped into a triclinic box, %d conversions checked' \
+          %(wrapped, len(x0), len(runs))
+    print 'OK'
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+"""
+ class2.py - evaluates the CLASS2 (COMPASS) potential energy of a system
+             without running LAMMPS.  Every term follows the formulas of the
+             LAMMPS styles used for the data file written by lammps_writer
+             (bond, angle, dihedral and improper style class2 and pair style
+             lj/class2/coul/cut with 1-2 and 1-3 pairs excluded), using the
+             index arrays of the topology engine and the coefficients from
+             frc2lmp.  Nonbonded pairs come from the cell list of
+             bonding.close_pairs, and in a periodic box every distance is
+             to the nearest image.  Coordinates are given as an (n_frames,
+             n_atoms, 3) array and the bonded terms of every frame are
+             computed at once.  The derivatives of the energy with respect
+             to every coefficient are also available, see Class2.gradient.
+             check_class2.py compares the terms with those of LAMMPS.
+"""
+import numpy as np
+import frc2lmp
+import bonding
+
+# Coulomb constant in LAMMPS real units.
+qqr2e = 332.06371
+# Degrees to radians.
+deg = np.pi/180.0
+# Smallest sine used in dihedral angles, as in LAMMPS.
+small = 1.0e-7
+
+# Terms summed into each energy reported by LAMMPS thermo output.
+thermo_terms = [('E_vdwl',  ['vdw']),
+                ('E_coul',  ['q']),
+                ('E_bond',  ['b']),
+                ('E_angle', ['a', 'bb', 'ba']),
+                ('E_dihed', ['tor', 'mbt', 'ebt', 'at', 'aat', 'bb13']),
+                ('E_impro', ['oop', 'aa'])]
+
+# Coefficient sections: the frc2lmp function, the types it is given (atom,
+# bond, angle, dihedral or improper types) and the number of coefficients.
+sections = [('vdw',  frc2lmp.pair,              'atom',     2),
+            ('b',    frc2lmp.bond,              'bond',     4),
+            ('a',    frc2lmp.angle,             'angle',    4),
+            ('tor',  frc2lmp.torsion,           'dihedral', 6),
+            ('oop',  frc2lmp.oop,               'improper', 2),
+            ('bb',   frc2lmp.bondbond,          'angle',    3),
+            ('ba',   frc2lmp.bondangle,         'angle',    4),
+            ('aa',   frc2lmp.angleangle,        'improper', 6),
+            ('aat',  frc2lmp.angleangletorsion, 'dihedral', 3),
+            ('ebt',  frc2lmp.endbondtorsion,    'dihedral', 8),
+            ('mbt',  frc2lmp.midbondtorsion,    'dihedral', 4),
+            ('bb13', frc2lmp.bondbond13,        'dihedral', 3),
+            ('at',   frc2lmp.angletorsion,      'dihedral', 8)]
+
+# Columns of each section that the energy is linear in (force constants),
+# the others are equilibrium values or van der Waals parameters.
+linear_columns = {'vdw': [],        'b':   [1,2,3], 'a':    [1,2,3],
+                  'tor': [0,2,4],   'oop': [0],     'bb':   [0],
+                  'ba':  [0,1],     'aa':  [0,1,2], 'aat':  [0],
+                  'ebt': range(6),  'mbt': [0,1,2], 'bb13': [0],
+                  'at':  range(6)}
+
+# Returns the dot product along the last axis.
+def dot(a, b):
+    return (a*b).sum(-1)
+
+# Returns the length of vectors along the last axis.
+def length(a):
+    return np.sqrt(dot(a, a))
+
+# Returns the angle (radians) between vectors a and b.
+def angle(a, b):
+    return np.arccos(np.clip(dot(a, b)/(length(a)*length(b)), -1.0, 1.0))
+
+# Sums the (n_frames, n_terms) derivatives in columns d over the terms of
+# each type, returns an (n_frames, ntypes, len(d)) array.
+def by_type(d, tid, ntypes):
+    d   = np.array(d).transpose(2, 1, 0)
+    out = np.zeros((ntypes,) + d.shape[1:])
+    np.add.at(out, tid, d)
+    return out.transpose(1, 0, 2)
+
+# Evaluates the class2 energy of a system for any number of frames.  The
+# box of a periodic system must be at least twice the cutoff wide, so that
+# each pair interacts through one image only.
+class Class2:
+    def __init__(self, system, frc, cutoff=9.5):
+        self.box = system.box
+        if self.box is not None and (self.box.widths < 2.0*cutoff).any():
+            raise ValueError('the box of %s is narrower than twice the cutoff'
+                             %system.title)
+        topology = system.topology()
+        self.atom_type, atypes = topology.atom_types()
+        self.index, self.type_index, self.types = {}, {'atom': self.atom_type}, {}
+        self.types['atom'] = atypes
+        for name, builder in [('bond',     topology.bonds),
+                              ('angle',    topology.angles),
+                              ('dihedral', topology.dihedrals),
+                              ('improper', topology.impropers)]:
+            self.index[name], self.type_index[name], self.types[name] = builder()
+        self.counts = dict((kind, np.bincount(tid, minlength=len(self.types[kind])))
+                           for kind, tid in self.type_index.items())
+        self.q      = np.array([a.q for a in system.atoms])
+        self.natoms = len(system.atoms)
+        self.cutoff = cutoff
+        self.exclusions()
+        self.tables = None
+        self.set_coeffs(frc)
+
+    # Computes the coefficient arrays from the force field, this is all that
+    # needs to be done again when the force field parameters change.
+    # The parameters are resolved once for the types of the system (see
+    # frc2lmp.Tables) and only read again on later calls with the same frc.
+    def set_coeffs(self, frc):
+        self.tables = frc2lmp.compiled(self.tables, self.types, frc)
+        self.coeff, self.missing = {}, frc2lmp.Missing()
+        for name, f, kind, ncol in sections:
+            c, missing = self.tables.coeffs(f, self.missing, self.counts[kind])
+            self.coeff[name] = np.array(c, dtype=float).reshape(-1, ncol)
+        self.mix()
+
+    # Mixes the pair coefficients, always sixthpower for lj/class2.
+    def mix(self):
+        eps, sigma = self.coeff['vdw'][:,0], self.coeff['vdw'][:,1]
+        s6   = sigma**6
+        self.sum6  = s6[:,None] + s6[None,:]
+        self.sigma = (0.5*self.sum6)**(1.0/6.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.eps = 2.0*np.sqrt(np.outer(eps, eps))*np.outer(sigma**3, sigma**3)/self.sum6
+        self.eps[self.sum6 == 0.0] = 0.0
+
+    # Stores the pairs without nonbonded interactions (bonded and 1-3 pairs)
+    # as a sorted array of keys i*natoms+j, i<j.
+    def exclusions(self):
+        b, a = self.index['bond'], self.index['angle']
+        pairs = np.vstack((b, a[:,[0,2]]))
+        pairs.sort(axis=1)
+        self.excluded = np.unique(pairs[:,0].astype(np.int64)*self.natoms + pairs[:,1])
+
+    # Returns x as an (n_frames, n_atoms, 3) array.
+    def frames(self, x):
+        return np.asarray(x, dtype=float).reshape(-1, self.natoms, 3)
+
+    # Returns the energy of each term in each frame of x as a dictionary of
+    # arrays with keys as in discover_output.read_disco_energy_file.
+    def terms(self, x):
+        x = self.frames(x)
+        e = {}
+        e['vdw'], e['q'] = self.pair(x)
+        e['b'] = self.bond(x)
+        e['a'], e['bb'], e['ba'] = self.angle(x)
+        (e['tor'], e['mbt'], e['ebt'],
+         e['at'],  e['aat'], e['bb13']) = self.dihedral(x)
+        e['oop'], e['aa'] = self.improper(x)
+        e['pe'] = sum(e.values())
+        return e
+
+    # Returns the energies of each frame named as in LAMMPS thermo output.
+    def thermo(self, x):
+        e = self.terms(x)
+        t = dict((name, sum(e[k] for k in keys)) for name,keys in thermo_terms)
+        t['PotEng'] = e['pe']
+        return t
+
+    # Returns the derivatives of the potential energy of each frame with
+    # respect to the coefficients, as a dictionary of (n_frames, ntypes, ncol)
+    # arrays with the same keys and layout as self.coeff.  Coefficients that
+    # are copied into several sections by frc2lmp (e.g. r0 of a bond into the
+    # bond-bond terms) have a derivative in each section.
+    def gradient(self, x):
+        x = self.frames(x)
+        g = {}
+        g['vdw'] = self.pair_gradient(x)
+        g['b']   = self.bond_gradient(x)
+        g['a'], g['bb'], g['ba'] = self.angle_gradient(x)
+        (g['tor'], g['mbt'], g['ebt'],
+         g['at'],  g['aat'], g['bb13']) = self.dihedral_gradient(x)
+        g['oop'], g['aa'] = self.improper_gradient(x)
+        return g
+
+    # Returns the coefficients of the terms of a section as columns.
+    def columns(self, name, kind):
+        return self.coeff[name][self.type_index[kind]].T
+
+    # Returns the number of types of a section.
+    def ntypes(self, name):
+        return len(self.coeff[name])
+
+    # Returns the vectors from atoms i to atoms j in each frame, to the
+    # nearest image in a periodic box.
+    def vectors(self, x, i, j):
+        d = x[:,j] - x[:,i]
+        if self.box is not None: d = self.box.minimum_image(d)
+        return d
+
+    # Yields the frame f, the nonbonded pairs i, j closer than the cutoff in
+    # it and their distances r, in blocks of pairs of neighbor cells (see
+    # bonding.close_pairs).
+    def pairs(self, x):
+        n = self.natoms
+        for f in range(len(x)):
+            for i, j, r in bonding.close_pairs(x[f], self.cutoff, self.box):
+                key  = np.minimum(i, j).astype(np.int64)*n + np.maximum(i, j)
+                keep = ~np.in1d(key, self.excluded)
+                yield f, i[keep], j[keep], r[keep]
+
+    # Returns the 9-6 van der Waals and Coulomb energies.
+    def pair(self, x):
+        evdw, ecoul = np.zeros(len(x)), np.zeros(len(x))
+        for f, i, j, r in self.pairs(x):
+            ti, tj = self.atom_type[i], self.atom_type[j]
+            s  = self.sigma[ti,tj]/r
+            s6 = s**6
+            evdw[f]  += (self.eps[ti,tj]*(2.0*s6*s*s*s - 3.0*s6)).sum()
+            ecoul[f] += (qqr2e*self.q[i]*self.q[j]/r).sum()
+        return evdw, ecoul
+
+    # Returns the derivatives of the van der Waals energy with respect to the
+    # epsilon and sigma of each atom type, through the mixing rules.
+    def pair_gradient(self, x):
+        nf, nt = len(x), self.ntypes('vdw')
+        # Sums of the energy per unit epsilon_ij (a) and of the derivative
+        # with respect to sigma_ij (b) over the pairs of each pair of types.
+        a, b = np.zeros((nf, nt*nt)), np.zeros((nf, nt*nt))
+        for f, i, j, r in self.pairs(x):
+            ti, tj = self.atom_type[i], self.atom_type[j]
+            sigma  = self.sigma[ti,tj]
+            s  = sigma/r
+            s6 = s**6
+            s9 = s6*s*s*s
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ds = np.where(sigma > 0.0, 18.0*self.eps[ti,tj]*(s9 - s6)/sigma, 0.0)
+            a[f] += np.bincount(ti*nt + tj, 2.0*s9 - 3.0*s6, minlength=nt*nt)
+            b[f] += np.bincount(ti*nt + tj, ds, minlength=nt*nt)
+        a = a.reshape(nf, nt, nt)
+        b = b.reshape(nf, nt, nt)
+        a += a.transpose(0, 2, 1)
+        b += b.transpose(0, 2, 1)
+        # Derivatives of epsilon_ij and sigma_ij with respect to the epsilon
+        # and sigma of type i.
+        eps, sigma = self.coeff['vdw'][:,0], self.coeff['vdw'][:,1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            de_de = np.where(eps[:,None] > 0.0, 0.5*self.eps/eps[:,None], 0.0)
+            de_ds = np.where(sigma[:,None] > 0.0,
+                    self.eps*(3.0/sigma[:,None] - 6.0*sigma[:,None]**5/self.sum6), 0.0)
+            ds_ds = np.where(self.sigma > 0.0, 0.5*sigma[:,None]**5/self.sigma**5, 0.0)
+        g = np.zeros((nf, nt, 2))
+        g[:,:,0] = (a*de_de).sum(2)
+        g[:,:,1] = (a*de_ds + b*ds_ds).sum(2)
+        return g
+
+    # Returns the difference of each bond length from r0.
+    def bond_geometry(self, x):
+        i, j = self.index['bond'].T
+        r0 = self.columns('b', 'bond')[0]
+        return length(self.vectors(x, i, j)) - r0
+
+    # Returns the quartic bond energies.
+    def bond(self, x):
+        dr = self.bond_geometry(x)
+        r0, k2, k3, k4 = self.columns('b', 'bond')
+        return (k2*dr**2 + k3*dr**3 + k4*dr**4).sum(1)
+
+    def bond_gradient(self, x):
+        dr = self.bond_geometry(x)
+        r0, k2, k3, k4 = self.columns('b', 'bond')
+        d = [-(2.0*k2*dr + 3.0*k3*dr**2 + 4.0*k4*dr**3), dr**2, dr**3, dr**4]
+        return by_type(d, self.type_index['bond'], self.ntypes('b'))
+
+    # Returns the two bond lengths and the difference of the angle from
+    # theta0 (radians) of each angle.
+    def angle_geometry(self, x):
+        i, j, k = self.index['angle'].T
+        d1, d2 = self.vectors(x, j, i), self.vectors(x, j, k)
+        theta0 = self.columns('a', 'angle')[0]
+        return length(d1), length(d2), angle(d1, d2) - theta0*deg
+
+    # Returns the quartic angle, bond-bond and bond-angle energies.
+    def angle(self, x):
+        r1, r2, dtheta = self.angle_geometry(x)
+        theta0, k2, k3, k4 = self.columns('a', 'angle')
+        ea  = k2*dtheta**2 + k3*dtheta**3 + k4*dtheta**4
+        m, bb_r1, bb_r2 = self.columns('bb', 'angle')
+        ebb = m*(r1 - bb_r1)*(r2 - bb_r2)
+        n1, n2, ba_r1, ba_r2 = self.columns('ba', 'angle')
+        eba = n1*(r1 - ba_r1)*dtheta + n2*(r2 - ba_r2)*dtheta
+        return ea.sum(1), ebb.sum(1), eba.sum(1)
+
+    # The bond-angle energy also depends on theta0 of the angle.
+    def angle_gradient(self, x):
+        r1, r2, dtheta = self.angle_geometry(x)
+        tid, nt = self.type_index['angle'], self.ntypes('a')
+        theta0, k2, k3, k4 = self.columns('a', 'angle')
+        m, bb_r1, bb_r2 = self.columns('bb', 'angle')
+        n1, n2, ba_r1, ba_r2 = self.columns('ba', 'angle')
+        dtheta0 = -deg*(2.0*k2*dtheta + 3.0*k3*dtheta**2 + 4.0*k4*dtheta**3
+                        + n1*(r1 - ba_r1) + n2*(r2 - ba_r2))
+        ga  = by_type([dtheta0, dtheta**2, dtheta**3, dtheta**4], tid, nt)
+        gbb = by_type([(r1 - bb_r1)*(r2 - bb_r2),
+                       -m*(r2 - bb_r2), -m*(r1 - bb_r1)], tid, nt)
+        gba = by_type([(r1 - ba_r1)*dtheta, (r2 - ba_r2)*dtheta,
+                       -n1*dtheta, -n2*dtheta], tid, nt)
+        return ga, gbb, gba
+
+    # Returns the three bond lengths, the two angles (radians) and the
+    # dihedral angle phi of each dihedral, computed as in LAMMPS
+    # dihedral_style class2.
+    def dihedral_geometry(self, x):
+        i1, i2, i3, i4 = self.index['dihedral'].T
+        vb1, vb2, vb3 = (self.vectors(x, i2, i1), self.vectors(x, i2, i3),
+                         self.vectors(x, i3, i4))
+        r1, r2, r3 = length(vb1), length(vb2), length(vb3)
+        c0 = dot(vb1, vb3)/(r1*r3)
+        costh12 = np.clip( dot(vb1, vb2)/(r1*r2), -1.0, 1.0)
+        costh23 = np.clip(-dot(vb2, vb3)/(r2*r3), -1.0, 1.0)
+        sc1 = np.maximum(np.sqrt(np.maximum(1.0 - costh12**2, 0.0)), small)
+        sc2 = np.maximum(np.sqrt(np.maximum(1.0 - costh23**2, 0.0)), small)
+        c   = np.clip((c0 + costh12*costh23)/(sc1*sc2), -1.0, 1.0)
+        phi = np.arccos(c)
+        phi = np.where(dot(np.cross(vb1, vb2), vb3) > 0.0, -phi, phi)
+        return r1, r2, r3, np.arccos(costh12), np.arccos(costh23), phi
+
+    # Returns the torsion and torsion cross term energies.
+    def dihedral(self, x):
+        r1, r2, r3, th1, th2, phi = self.dihedral_geometry(x)
+        cos = [np.cos(phi), np.cos(2.0*phi), np.cos(3.0*phi)]
+
+        k1, phi1, k2, phi2, k3, phi3 = self.columns('tor', 'dihedral')
+        etor = (k1*(1.0 - np.cos(phi - phi1*deg)) + k2*(1.0 - np.cos(2.0*phi - phi2*deg))
+                                                  + k3*(1.0 - np.cos(3.0*phi - phi3*deg)))
+        a1, a2, a3, mbt_r = self.columns('mbt', 'dihedral')
+        embt = (r2 - mbt_r)*(a1*cos[0] + a2*cos[1] + a3*cos[2])
+        b1, b2, b3, c1, c2, c3, ebt_r1, ebt_r3 = self.columns('ebt', 'dihedral')
+        eebt = ((r1 - ebt_r1)*(b1*cos[0] + b2*cos[1] + b3*cos[2])
+              + (r3 - ebt_r3)*(c1*cos[0] + c2*cos[1] + c3*cos[2]))
+        d1, d2, d3, e1, e2, e3, at_th1, at_th2 = self.columns('at', 'dihedral')
+        eat  = ((th1 - at_th1*deg)*(d1*cos[0] + d2*cos[1] + d3*cos[2])
+              + (th2 - at_th2*deg)*(e1*cos[0] + e2*cos[1] + e3*cos[2]))
+        m, aat_th1, aat_th2 = self.columns('aat', 'dihedral')
+        eaat = m*(th1 - aat_th1*deg)*(th2 - aat_th2*deg)*cos[0]
+        n, bb13_r1, bb13_r3 = self.columns('bb13', 'dihedral')
+        ebb13 = n*(r1 - bb13_r1)*(r3 - bb13_r3)
+        return [e.sum(1) for e in [etor, embt, eebt, eat, eaat, ebb13]]
+
+    def dihedral_gradient(self, x):
+        r1, r2, r3, th1, th2, phi = self.dihedral_geometry(x)
+        tid, nt = self.type_index['dihedral'], self.ntypes('tor')
+        cos = [np.cos(phi), np.cos(2.0*phi), np.cos(3.0*phi)]
+
+        k1, phi1, k2, phi2, k3, phi3 = self.columns('tor', 'dihedral')
+        d = []
+        for n, k, phin in [(1.0, k1, phi1), (2.0, k2, phi2), (3.0, k3, phi3)]:
+            d += [1.0 - np.cos(n*phi - phin*deg), -deg*k*np.sin(n*phi - phin*deg)]
+        gtor = by_type(d, tid, nt)
+        a1, a2, a3, mbt_r = self.columns('mbt', 'dihedral')
+        gmbt = by_type([(r2 - mbt_r)*c for c in cos]
+                       + [-(a1*cos[0] + a2*cos[1] + a3*cos[2])], tid, nt)
+        b1, b2, b3, c1, c2, c3, ebt_r1, ebt_r3 = self.columns('ebt', 'dihedral')
+        gebt = by_type([(r1 - ebt_r1)*c for c in cos] + [(r3 - ebt_r3)*c for c in cos]
+                       + [-(b1*cos[0] + b2*cos[1] + b3*cos[2]),
+                          -(c1*cos[0] + c2*cos[1] + c3*cos[2])], tid, nt)
+        d1, d2, d3, e1, e2, e3, at_th1, at_th2 = self.columns('at', 'dihedral')
+        dth1, dth2 = th1 - at_th1*deg, th2 - at_th2*deg
+        gat  = by_type([dth1*c for c in cos] + [dth2*c for c in cos]
+                       + [-deg*(d1*cos[0] + d2*cos[1] + d3*cos[2]),
+                          -deg*(e1*cos[0] + e2*cos[1] + e3*cos[2])], tid, nt)
+        m, aat_th1, aat_th2 = self.columns('aat', 'dihedral')
+        dth1, dth2 = th1 - aat_th1*deg, th2 - aat_th2*deg
+        gaat = by_type([dth1*dth2*cos[0], -deg*m*dth2*cos[0], -deg*m*dth1*cos[0]],
+                       tid, nt)
+        n, bb13_r1, bb13_r3 = self.columns('bb13', 'dihedral')
+        dr1, dr3 = r1 - bb13_r1, r3 - bb13_r3
+        gbb13 = by_type([dr1*dr3, -n*dr3, -n*dr1], tid, nt)
+        return gtor, gmbt, gebt, gat, gaat, gbb13
+
+    # Returns the angles ABC, ABD and CBD (radians) and the average out of
+    # plane angle chi of each improper, computed as in LAMMPS
+    # improper_style class2 with atom j (B) at the center.
+    def improper_geometry(self, x):
+        a, b, c, d = self.index['improper'].T
+        rab, rcb, rdb = (self.vectors(x, b, a), self.vectors(x, b, c),
+                         self.vectors(x, b, d))
+        r = length(rab)*length(rcb)*length(rdb)
+        thABC, thABD, thCBD = angle(rab, rcb), angle(rab, rdb), angle(rcb, rdb)
+        # Out of plane angles of AB from CBD, of CB from DBA and of DB from ABC.
+        chi  = np.arcsin(np.clip(dot(np.cross(rcb, rdb), rab)/(r*np.sin(thCBD)), -1.0, 1.0))
+        chi += np.arcsin(np.clip(dot(np.cross(rdb, rab), rcb)/(r*np.sin(thABD)), -1.0, 1.0))
+        chi += np.arcsin(np.clip(dot(np.cross(rab, rcb), rdb)/(r*np.sin(thABC)), -1.0, 1.0))
+        return thABC, thABD, thCBD, chi/3.0
+
+    # Returns the Wilson out of plane and angle-angle energies.
+    def improper(self, x):
+        thABC, thABD, thCBD, chi = self.improper_geometry(x)
+        k, chi0 = self.columns('oop', 'improper')
+        eoop = np.where(k != 0.0, k*(chi - chi0*deg)**2, 0.0)
+        m1, m2, m3, th1, th2, th3 = self.columns('aa', 'improper')
+        dABC, dABD, dCBD = thABC - th1*deg, thABD - th2*deg, thCBD - th3*deg
+        eaa = m1*dABC*dCBD + m2*dABC*dABD + m3*dABD*dCBD
+        return eoop.sum(1), eaa.sum(1)
+
+    def improper_gradient(self, x):
+        thABC, thABD, thCBD, chi = self.improper_geometry(x)
+        tid, nt = self.type_index['improper'], self.ntypes('oop')
+        k, chi0 = self.columns('oop', 'improper')
+        dchi = chi - chi0*deg
+        goop = by_type([dchi**2, -2.0*deg*k*dchi], tid, nt)
+        m1, m2, m3, th1, th2, th3 = self.columns('aa', 'improper')
+        dABC, dABD, dCBD = thABC - th1*deg, thABD - th2*deg, thCBD - th3*deg
+        gaa = by_type([dABC*dCBD, dABC*dABD, dABD*dCBD,
+                       -deg*(m1*dCBD + m2*dABD),
+                       -deg*(m2*dABC + m3*dCBD),
+                       -deg*(m1*dABC + m3*dABD)], tid, nt)
+        return goop, gaa
@@ -4,11 +4,22 @@
           parameters for an interaction for a specific set of atom types.
           Interactions are alphabetically sorted by atom type in such that
           their symmetries are preserved, e.g. dihedral DCBA becomes ABCD.
-          Lists of atom types are stored by ':' delimited strings so that they
-          are hashable and can be stored in a dictionary for fast searching.          
+          Atom type names are interned as small integers when they are read,
+          and lists of atom types are stored as tuples of these codes, so that
+          they are hashable and can be stored in a dictionary for fast
+          searching without building a string for every key.
+          The file is read in a single pass, and the parsed tables are cached
+          on disk (see cache_dir), so that an unchanged frc file is only
+          parsed once.
 """
 
 import re
+import os
+import gzip
+import hashlib
+import cPickle
+import numpy as np
+from collections import OrderedDict
 
 # Abbreviations for each of the types of interactions in the COMPASS potential.
 # Each interaction is of class: NONBOND, BOND, ANGLE, TORSION, or OOP.
@@ -26,21 +37,47 @@ compass_key = { 'b':    ['#quartic_bond',          'BOND'],
                 'aat':  ['#angle-angle-torsion_1', 'TORSION'],
                 'vdw':  ['#nonbond(9-6)',          'NONBOND']}
 
-# Returns a file handle at the beginning of a section in an frc file.
-def open_at(path, section):
+# Number of values of the parameters of each interaction.  Bond-angle,
+# end-bond-torsion and angle-torsion parameters given for one side only are
+# repeated for the other side, as frc2lmp does.
+widths = {'vdw': 2, 'b':   4, 'a':    4, 'tor': 6, 'oop': 2, 'bb':  1,
+          'ba':  2, 'aa':  1, 'aat':  1, 'ebt': 6, 'mbt': 3, 'bb13': 1,
+          'at':  6}
+
+# Directory of the parsed frc file cache.  Set PYMSI2LMP_CACHE to change it,
+# or set it to an empty string to disable the cache.
+cache_dir = os.environ.get('PYMSI2LMP_CACHE',
+                           os.path.join(os.path.expanduser('~'), '.pymsi2lmp'))
+
+# Returns the path of the cache file for an frc file.  There is one cache
+# file per frc path, which is overwritten when the frc file changes.
+def cache_path(path):
+    key = hashlib.sha1(os.path.abspath(path)).hexdigest()
+    return os.path.join(cache_dir, 'frc-' + key + '.pickle')
+
+# Version of the layout of the cached tables, changed when the layout does.
+cache_version = 2
+
+# Returns the key that a cache file must match to be used: the layout of the
+# tables, the frc path, its modification time and a hash of its contents.
+def cache_stamp(path):
     try:
-        fid = open(path, 'r')  
-        for line in fid: 
-            if line.startswith(section): return fid    
-    except:
+        mtime = os.path.getmtime(path)
+        sha1  = hashlib.sha1(open(path, 'rb').read()).hexdigest()
+    except (IOError, OSError):
+        return None
+    return (cache_version, os.path.abspath(path), mtime, sha1)
+
+# Opens an frc file for reading, files ending in .gz are decompressed.
+def open_frc(path):
+    try:
+        if path.endswith('.gz'): return gzip.open(path, 'r')
+        return open(path, 'r')
+    except IOError:
         print 'Error: frc file,', path, 'cannot be opened.'
         import sys
         sys.exit()
-    
-    print 'Error: frc file does not have', section
-    import sys
-    sys.exit()
-                
+
 # Returns the sorting function used by the interaction.
 def sort_function(interaction):
     style = compass_key[interaction][1]
@@ -102,23 +139,106 @@ def skip(s):
     return s.strip()=='' or s[0]=='!' or s[0]=='@' or s[0]=='>'
 
 # Reads an frc file and supplies the parameters needed for a lammps input.
+# The path may also be an open stream (e.g. sys.stdin or a StringIO), which
+# is read as is and never cached.
 class Frc:
-    def __init__(self, path):
+    def __init__(self, path, cache=True):
+        self.clear_resolved()
+        # Counts the keys added to the tables and the parameters set, and
+        # holds the count at the last change of each parameter set, in the
+        # order of the changes, so that compiled tables can be brought up to
+        # date (see Compiled).
+        self.layout, self.serial, self.changed = 0, 0, OrderedDict()
+        if hasattr(path, 'read'):
+            self.path = getattr(path, 'name', '<stream>')
+            self.read(path)
+            return
+
         self.path  = path
-        self.types = self.read_masses()
-        self.read_equiv()
-                
-        self.coeff = {}        
-        for i in compass_key:
-            self.coeff[i] = self.readparam(i)
+        stamp = cache and cache_dir and cache_stamp(path)
+        if stamp and self.load_cache(stamp): return
+
+        fid = open_frc(path)
+        self.read(fid)
+        fid.close()
+        if stamp: self.save_cache(stamp)
+
+    # Loads the tables from the cache, returns False if there is no cache
+    # entry matching stamp.
+    def load_cache(self, stamp):
+        try:
+            fid = open(cache_path(self.path), 'rb')
+        except IOError:
+            return False
+        try:
+            if cPickle.load(fid) != stamp: return False
+            self.types, self.equiv, self.coeff, self.codes = cPickle.load(fid)
+        except Exception:
+            return False
+        finally:
+            fid.close()
+        return True
+
+    # Saves the tables to the cache.  The file is written under a temporary
+    # name and renamed, so that concurrent runs never read a partial file.
+    def save_cache(self, stamp):
+        path = cache_path(self.path)
+        tmp  = '%s.%d' %(path, os.getpid())
+        try:
+            if not os.path.isdir(cache_dir): os.makedirs(cache_dir)
+            fid = open(tmp, 'wb')
+            try:
+                cPickle.dump(stamp, fid, cPickle.HIGHEST_PROTOCOL)
+                cPickle.dump((self.types, self.equiv, self.coeff, self.codes),
+                             fid, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                fid.close()
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            pass
   
     # Finds forcefield coefficients from the interaction type and 
-    # forcefield types of a set of atoms.
+    # forcefield types of a set of atoms.  Results are memoized by
+    # interaction and types, see lookup_stats.
     def get_param(self, fftypes, interaction):
-        ffstr = ':'.join(fftypes)
+        key = (interaction, tuple(fftypes))
+        if key in self.resolved:
+            self.lookups['hits'] += 1
+            return self.resolved[key]
+        self.lookups['misses'] += 1
+        tier, param = self.resolve(fftypes, interaction)
+        self.lookups[tier] += 1
+        self.resolved[key] = param
+        return param
+
+    # Forgets memoized parameters and lookup counts.  This must be called if
+    # the coefficient tables are changed.
+    def clear_resolved(self):
+        self.resolved = {}
+        self.lookups  = dict((k,0) for k in ['hits', 'misses', 'direct',
+                                             'equivalence', 'wildcard', 'missing'])
+
+    # Returns the lookup counters: memo hits and misses, and for the misses
+    # which tier found the parameters (direct, equivalence or wildcard), or
+    # whether they are missing.
+    def lookup_stats(self):
+        return dict(self.lookups)
+
+    # Searches the tables for the parameters of fftypes, trying the types
+    # as given, then their equivalent types, then torsion wildcards.
+    # Returns the tier that found the parameters and the parameters.
+    def resolve(self, fftypes, interaction):
+        tier, key = self.resolve_key(fftypes, interaction)
+        if key is None: return tier, None
+        return tier, self.coeff[interaction][key]
+
+    # Same as resolve, but returns the key of the parameters in the table of
+    # the interaction instead of the parameters (None if missing).
+    def resolve_key(self, fftypes, interaction):
+        key   = self.key(fftypes)
         coeff = self.coeff[interaction]                                
-        if ffstr in coeff:
-            return coeff[ffstr]
+        if key in coeff:
+            return 'direct', key
         
         sortf = sort_function(interaction)
         # Try again with equivalent types.  NOTE: tries to replace all atoms.
@@ -134,55 +254,85 @@ class Frc:
                 equiv_fftypes.append(self.equiv[a][style-1])
             else:
                 equiv_fftypes.append(a)
-        eqffstr = ':'.join(sortf(equiv_fftypes))
-
-        # Optional: if you want to see which equivalences are being used.
-        # This can end up producing a lot of output.
-        #print 'Replacing', ffstr, 'with', eqffstr, 'for', interaction        
-        if eqffstr in coeff: return coeff[eqffstr]
+        key = self.key(sortf(equiv_fftypes))
+        if key in coeff: return 'equivalence', key
         
         # Ok - now we are desperate - try wildcards.
         if compass_key[interaction][1]=='TORSION':
-            ffstr = ':'.join(sortf(fftypes[:-1]+['*']))        
-            if ffstr in coeff: return coeff[ffstr]
-            ffstr = ':'.join(sortf(['*']+fftypes[1::]))
-            if ffstr in coeff: return coeff[ffstr]
-            ffstr = ':'.join(sortf(['*']+fftypes[1:-1]+['*']))
-            if ffstr in coeff: return coeff[ffstr]
-        return None
+            key = self.key(sortf(fftypes[:-1]+['*']))        
+            if key in coeff: return 'wildcard', key
+            key = self.key(sortf(['*']+fftypes[1::]))
+            if key in coeff: return 'wildcard', key
+            key = self.key(sortf(['*']+fftypes[1:-1]+['*']))
+            if key in coeff: return 'wildcard', key
+        return 'missing', None
 
-    # Reads the equivalences table.
-    def read_equiv(self):
-        fid = open_at(self.path, '#equivalence')
-        self.equiv = {}
-        for line in fid:
-            if skip(line):         continue
-            if next_section(line): break
-            x = line.split()
-            self.equiv[x[2]] = x[3::]    
-        
-    # Reads the atomic masses field.
-    def read_masses(self):
-        fid = open_at(self.path, '#atom_types')
-        types = {}        
-        for line in fid:
-            if skip(line):         continue
-            if next_section(line): break
-            # Remove comment from line and split into columns.
-            x = line[0:39].split() 
-            if len(x) != 5:        continue
-            # types[fftype] = element, mass.
-            types[x[2]] = [x[4], float(x[3])] 
-        return types
-            
-    # Reads parameters from each interaction type.
-    def readparam(self, interaction):
-        table = {}        
-        fid   = open_at(self.path, compass_key[interaction][0])
-        sortf = sort_function(interaction)
+    # Returns the parameters of fftypes as given in the table of interaction,
+    # without equivalences or wildcards, or None if there are none.
+    def direct(self, fftypes, interaction):
+        return self.coeff[interaction].get(self.key(fftypes))
+
+    # Returns the key of a list of fftypes in the tables, the tuple of their
+    # codes.  Names that were never interned have no code (None), so a key
+    # holding them is in no table.
+    def key(self, fftypes):
+        codes = self.codes
+        return tuple([codes.get(a) for a in fftypes])
+
+    # Returns the key of a list of fftypes, interning new names.
+    def intern_key(self, fftypes):
+        codes = self.codes
+        return tuple([codes.setdefault(a, len(codes)) for a in fftypes])
+
+    # Returns the parameters of combos (a dictionary of lists of fftypes by
+    # interaction) resolved once into dense tables, see Compiled.
+    def compile(self, combos):
+        return Compiled(self, combos)
+
+    # Reads all tables from an open frc file in a single pass.  Each line is
+    # passed to the reader of the section it is in.  As before, only the first
+    # section with a given header is read.
+    def read(self, fid):
+        self.types, self.equiv, self.coeff, self.codes = {}, {}, {}, {}
+        readers = {'#atom_types': self.read_mass, '#equivalence': self.read_equiv}
+        for i in compass_key:
+            self.coeff[i] = {}
+            readers[compass_key[i][0]] = self.param_reader(i)
+
+        reader, found = None, set()
         for line in fid:
-            if skip(line):         continue
-            if next_section(line): break
+            if skip(line): continue
+            if line[0]=='#' and next_section(line):
+                header = line.split()[0]
+                reader = None
+                if header in readers and not header in found:
+                    reader = readers[header]
+                    found.add(header)
+            elif reader: reader(line)
+
+        for header in readers:
+            if not header in found:
+                print 'Error: frc file does not have', header
+                import sys
+                sys.exit()
+
+    # Reads a line of the equivalences table.
+    def read_equiv(self, line):
+        x = line.split()
+        self.equiv[x[2]] = x[3::]
+
+    # Reads a line of the atomic masses field.
+    def read_mass(self, line):
+        # Remove comment from line and split into columns.
+        x = line[0:39].split() 
+        if len(x) != 5: return
+        # types[fftype] = element, mass.
+        self.types[x[2]] = [x[4], float(x[3])] 
+
+    # Returns a function that reads a parameter line of an interaction type.
+    def param_reader(self, interaction):
+        store = self.param_store(interaction)
+        def read_param(line):
             x = line.split()
             # Determines how many atoms types are listed in the line.
             # All fftypes start with a letter or * for wildcard.
@@ -192,8 +342,16 @@ class Frc:
                 if not (x[2+i][0].isalpha() or x[2+i][0]=='*'):
                     natoms = i
                     break
-            fftypes = x[2:2+natoms]
-            param   = [float(y) for y in x[2+natoms::]]
+            store(x[2:2+natoms], [float(y) for y in x[2+natoms::]])
+        return read_param
+
+    # Returns a function that stores the parameters of a list of fftypes in
+    # the table of an interaction, as given on a line of the frc file.
+    def param_store(self, interaction):
+        table = self.coeff[interaction]
+        sortf = sort_function(interaction)
+        swap  = interaction in ['ebt','at']
+        def store(fftypes, param):
             s_fftypes = sortf(fftypes[:])
             
             # Some interactions coefficients are not symmetric.
@@ -203,7 +361,84 @@ class Frc:
                 param = param[::-1]                                                        
             # If end-bond-torsion or angle-torsion was reversed, 
             # swap left and right parameters.
-            if any(interaction==x for x in ['ebt','at']) and fftypes[0]!=s_fftypes[0]:
+            if swap and fftypes[0]!=s_fftypes[0]:
                 param[0:3],param[3:6] = param[3:6],param[0:3]                                                
-            table[':'.join(s_fftypes)] = param
-        return table
+            key = self.intern_key(s_fftypes)
+            if not key in table: self.layout += 1
+            table[key] = param
+            return key
+        return store
+
+    # Sets the parameters of fftypes as if they were read from the frc file,
+    # so that the tables can be changed without writing a new file.
+    def set_param(self, fftypes, interaction, param):
+        key = self.param_store(interaction)(list(fftypes), list(param))
+        self.serial += 1
+        self.changed.pop((interaction, key), None)
+        self.changed[interaction, key] = self.serial
+        self.clear_resolved()
+
+# Returns the parameters param with widths[interaction] values.
+def pad(param, interaction):
+    n = widths[interaction]
+    if len(param) and n % len(param) == 0: return list(param)*(n//len(param))
+    raise ValueError('%s parameters have %d values, expected %d' 
+                     %(compass_key[interaction][0], len(param), n))
+
+# Parameters of a fixed set of type combinations of each interaction, e.g.
+# the types found in a system, resolved once into dense tables.  Row i of
+# table[interaction][index[interaction]] holds the parameters of the i-th
+# combination, zero if they are missing (index -1, the last row).  Van der
+# Waals parameters are only looked up directly, as in frc2lmp.pair.  The
+# tables must be updated when parameters are set (Frc.set_param), which
+# resolves the combinations again only if parameters were added, and
+# otherwise reads only the parameters set since the last update.
+class Compiled:
+    def __init__(self, frc, combos):
+        self.frc    = frc
+        self.combos = combos
+        self.layout = None
+        self.update()
+
+    # Resolves each distinct parameter once, numbering the rows of the table
+    # of each interaction.  Missing parameters are given the last row.
+    def resolve(self):
+        frc = self.frc
+        self.rows, self.index = {}, {}
+        for interaction, combos in self.combos.items():
+            rows  = {}
+            index = np.empty(len(combos), dtype=np.int32)
+            for i,t in enumerate(combos):
+                if interaction == 'vdw':
+                    key = frc.key([t])
+                    if not key in frc.coeff['vdw']: key = None
+                    tier = 'missing' if key is None else 'direct'
+                else:
+                    tier, key = frc.resolve_key(list(t), interaction)
+                frc.lookups['misses'] += 1
+                frc.lookups[tier]     += 1
+                if key is None: index[i] = -1
+                else:           index[i] = rows.setdefault(key, len(rows))
+            self.rows[interaction]  = rows
+            self.index[interaction] = index
+        self.layout = frc.layout
+
+    # Reads the values of the parameters into the tables, all of them if the
+    # combinations were resolved again.
+    def update(self):
+        frc = self.frc
+        if self.layout != frc.layout:
+            self.resolve()
+            self.table = {}
+            for interaction, rows in self.rows.items():
+                coeff = frc.coeff[interaction]
+                keys  = sorted(rows, key=rows.get)
+                table = [pad(coeff[key], interaction) for key in keys]
+                self.table[interaction] = np.array(table + [widths[interaction]*[0.0]])
+        else:
+            for interaction, key in reversed(frc.changed):
+                if frc.changed[interaction, key] <= self.serial: break
+                row = self.rows.get(interaction, {}).get(key)
+                if row is not None:
+                    self.table[interaction][row] = pad(frc.coeff[interaction][key], interaction)
+        self.serial = frc.serial
@@ -3,82 +3,155 @@
  frc2lmp.py - These routines are for converting frc parameter data into a 
               format that can easily be written to a LAMMPS input file.
 """
+import json
+import numpy as np
+from collections import OrderedDict
 from frc import sort_bond_or_angle as sort
 from frc import sort_aa as sortaa
+from frc import compass_key
+
+# Collects the parameters that are missing from an frc file, once for each
+# interaction and types, in the order they are first found.  The number of
+# terms of the system that need each parameter is summed.  Iterating gives
+# [interaction, types] pairs, as the missing lists did.
+class Missing(object):
+    def __init__(self):
+        self.terms = OrderedDict()      # (interaction, types) -> terms.
+        self.types = {}                 # (interaction, types) -> types given.
+
+    # Records that n terms need the parameter of interaction for types.
+    def add(self, interaction, types, n=1):
+        key = (interaction, type_key(types))
+        if key not in self.terms:
+            self.terms[key] = 0
+            self.types[key] = types
+        self.terms[key] += n
+
+    def __iter__(self):
+        for key in self.terms: yield [key[0], self.types[key]]
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, m):
+        return (m[0], type_key(m[1])) in self.terms
+
+    # Returns the types missing for each interaction, in order.
+    def groups(self):
+        groups = OrderedDict()
+        for interaction, types in self:
+            groups.setdefault(interaction, []).append(types)
+        return groups
+
+    # Returns the missing parameters as a list of dictionaries.
+    def records(self):
+        return [OrderedDict([('interaction', key[0]),
+                             ('section',     compass_key[key[0]][0]),
+                             ('types',       type_list(self.types[key])),
+                             ('terms',       n)])
+                for key, n in self.terms.items()]
+
+    # Writes the missing parameters to a JSON file.
+    def write_json(self, path):
+        fid = open(path, 'w')
+        json.dump(self.records(), fid, indent=1)
+        fid.close()
+
+# Types are lists of fftype strings, or a single string for vdw.
+def type_key(types):
+    if isinstance(types, str): return types
+    return tuple(types)
+
+# Returns types as a list of fftype strings.
+def type_list(types):
+    if isinstance(types, str): return [types]
+    return list(types)
+
+# Returns the collector to add missing parameters to, a new one if None.
+def collector(missing):
+    if missing is None: return Missing()
+    return missing
+
+# Returns the number of terms of type i, or 1 if the counts are not known.
+def terms(counts, i):
+    if counts is None: return 1
+    return int(counts[i])
+
 # Returns the pairwise coefficients in an list for each type.
-def pair(types, frc):
-    coeffs,missing = [],[]
-    for t in types:
-        if t in frc.coeff['vdw']:
-            c = frc.coeff['vdw'][t][::-1]
+def pair(types, frc, missing=None, counts=None):
+    coeffs,missing = [],collector(missing)
+    for i,t in enumerate(types):
+        c = frc.direct([t], 'vdw')
+        if c != None:
+            c = c[::-1]
         else:
-            missing += [['vdw', t]]
+            missing.add('vdw', t, terms(counts, i))
             c = 2*[0.0]
         coeffs.append(tuple(c))
     return coeffs,missing
         
 # Returns the bond coefficients in an list for each type.       
-def bond(types, frc):
-    coeffs,missing = [],[]
-    for t in types:
+def bond(types, frc, missing=None, counts=None):
+    coeffs,missing = [],collector(missing)
+    for i,t in enumerate(types):
         c = frc.get_param(t, 'b') 
         if c == None:
-            missing += [['b', t]]
+            missing.add('b', t, terms(counts, i))
             c = 4*[0.0]        
         coeffs.append(tuple(c))
     return coeffs,missing
 
 # Returns the angle coefficients in an list for each type.
-def angle(types, frc):
-    coeffs,missing = [],[]
-    for t in types:        
+def angle(types, frc, missing=None, counts=None):
+    coeffs,missing = [],collector(missing)
+    for i,t in enumerate(types):        
         c = frc.get_param(t, 'a')        
         if c == None:
-            missing += [['a', t]]
+            missing.add('a', t, terms(counts, i))
             c = 4*[0.0]
         coeffs.append(tuple(c))
     return coeffs,missing
         
 # Returns the torsion coefficients in an list for each type.
-def torsion(types, frc):
-    coeffs,missing = [],[]
-    for t in types:
+def torsion(types, frc, missing=None, counts=None):
+    coeffs,missing = [],collector(missing)
+    for i,t in enumerate(types):
         c = frc.get_param(t, 'tor')
         if c == None:
-            missing += [['tor', t]]
+            missing.add('tor', t, terms(counts, i))
             c = 6*[0.0]
         coeffs.append(tuple(c))
     return coeffs,missing
 
 # Returns the  coefficients in an list for each type.
-def oop(types, frc):
-    coeffs,missing = [],[]
-    for t in types:
+def oop(types, frc, missing=None, counts=None):
+    coeffs,missing = [],collector(missing)
+    for i,t in enumerate(types):
         c = frc.get_param(t, 'oop')
         if c == None:
-            missing += [['oop', t]]
+            missing.add('oop', t, terms(counts, i))
             c = 2*[0.0]
         coeffs.append(tuple(c))
     return coeffs,missing
 
 # Returns the bond-bond coefficients in an list for each type.
-def bondbond(types, frc):
-    coeffs,missing = [],[]
-    for t in types:        
+def bondbond(types, frc, missing=None, counts=None):
+    coeffs,missing = [],collector(missing)
+    for i,t in enumerate(types):        
         b1,b2 = frc.get_param(sort(t[0:2]),'b'),frc.get_param(sort(t[1:3]),'b')        
         bb = frc.get_param(t, 'bb')
         try:
             c = bb + [b1[0], b2[0]]
         except:
-            missing += [['bb',t]]
+            missing.add('bb', t, terms(counts, i))
             c = 3*[0.0]        
         coeffs.append(tuple(c))
     return coeffs,missing
         
 # Returns the bond-angle coefficients in an list for each type.
-def bondangle(types, frc):
-    coeffs,missing = [],[]
-    for t in types:        
+def bondangle(types, frc, missing=None, counts=None):
+    coeffs,missing = [],collector(missing)
+    for i,t in enumerate(types):        
         b1,b2 = frc.get_param(sort(t[0:2]),'b'),frc.get_param(sort(t[1:3]),'b')
         ba = frc.get_param(t, 'ba')
         try:
@@ -86,14 +159,14 @@ def bondangle(types, frc):
             c = ba + [b1[0], b2[0]]
         except:                            
             c = 4*[0.0]        
-            missing += [['ba',  t]]
+            missing.add('ba', t, terms(counts, i))
         coeffs.append(tuple(c))
     return coeffs,missing
         
 # Returns the angle-angle coefficients in an list for each type.
-def angleangle(types, frc):
-    coeffs,missing = [],[]        
-    for t in types:        
+def angleangle(types, frc, missing=None, counts=None):
+    coeffs,missing = [],collector(missing)        
+    for i,t in enumerate(types):        
         #   jj'_______k'
         #    /\
         #   /  \        E = K*(theta-theta0)*(theta'-theta0')
@@ -108,13 +181,13 @@ def angleangle(types, frc):
         t1,t2,t3 = frc.get_param(a1,'a'),frc.get_param(a2,'a'),frc.get_param(a3,'a')        
         
         if any([p==None for p in [t1,t2,t3,m1,m2,m3]]):                    
-            if m1==None and not ['aa',aa1] in missing: missing += [['aa',aa1]]
-            if m2==None and not ['aa',aa2] in missing: missing += [['aa',aa2]]
-            if m3==None and not ['aa',aa3] in missing: missing += [['aa',aa3]]
+            if m1==None: missing.add('aa', aa1, terms(counts, i))
+            if m2==None: missing.add('aa', aa2, terms(counts, i))
+            if m3==None: missing.add('aa', aa3, terms(counts, i))
             
-            if t1 == None: missing += [[ 'a', a1]]
-            if t2 == None: missing += [[ 'a', a2]]
-            if t3 == None: missing += [[ 'a', a3]]
+            if t1 == None: missing.add('a', a1, terms(counts, i))
+            if t2 == None: missing.add('a', a2, terms(counts, i))
+            if t3 == None: missing.add('a', a3, terms(counts, i))
             c = 6*[0.0]
         else:
             c = m1 + m2 + m3 + [t1[0],t2[0],t3[0]]
@@ -123,14 +196,14 @@ def angleangle(types, frc):
     return coeffs,missing
     
 # Returns the angle-angle-torsion coefficients in an list for each type.
-def angleangletorsion(types, frc):
-    coeffs,missing = [],[]
-    for t in types:
+def angleangletorsion(types, frc, missing=None, counts=None):
+    coeffs,missing = [],collector(missing)
+    for i,t in enumerate(types):
         a1,a2=sort(t[0:3]),sort(t[1:4])
         t1,t2 = frc.get_param(a1,'a'),frc.get_param(a2,'a')
         aat   = frc.get_param(t, 'aat')                
         if t1==None or t2==None or aat==None:
-            missing += [['aat', t]]
+            missing.add('aat', t, terms(counts, i))
             c = 3*[0.0]
         else:
             c = aat + [t1[0], t2[0]]        
@@ -138,13 +211,13 @@ def angleangletorsion(types, frc):
     return coeffs,missing
 
 # Returns the end-bond-torsion coefficients in an list for each type.
-def endbondtorsion(types, frc):
-    coeffs,missing = [],[]
-    for t in types:
+def endbondtorsion(types, frc, missing=None, counts=None):
+    coeffs,missing = [],collector(missing)
+    for i,t in enumerate(types):
         b1,b3 = frc.get_param(sort(t[0:2]),'b'), frc.get_param(sort(t[2:4]),'b')
         ebt   = frc.get_param(t, 'ebt')
         if b1==None or b3==None or ebt==None:
-            missing += [['ebt', t]]
+            missing.add('ebt', t, terms(counts, i))
             c = 8*[0.0]
         else:
             if len(ebt) == 3: ebt += ebt
@@ -153,13 +226,13 @@ def endbondtorsion(types, frc):
     return coeffs,missing
     
 # Returns the mid-bond-torsion coefficients in an list for each type.
-def midbondtorsion(types, frc):
-    coeffs,missing = [],[]
-    for t in types:
+def midbondtorsion(types, frc, missing=None, counts=None):
+    coeffs,missing = [],collector(missing)
+    for i,t in enumerate(types):
         mb  = frc.get_param(sort(t[1:3]),'b')
         mbt = frc.get_param(t, 'mbt')
         if mb==None or mbt==None:
-            missing += [['mbt', t]]
+            missing.add('mbt', t, terms(counts, i))
             c = 4*[0.0]
         else:            
             c = mbt + [mb[0]]
@@ -167,13 +240,13 @@ def midbondtorsion(types, frc):
     return coeffs,missing
 
 # Returns the bond-bond13 coefficients in an list for each type.    
-def bondbond13(types, frc):
-    coeffs,missing = [],[]
-    for t in types:
+def bondbond13(types, frc, missing=None, counts=None):
+    coeffs,missing = [],collector(missing)
+    for i,t in enumerate(types):
         b1,b3 = frc.get_param(sort(t[0:2]),'b'), frc.get_param(sort(t[2:4]),'b')        
         bb13  = frc.get_param(t, 'bb13')
         if b1==None or b3==None or bb13==None:
-            missing += [['bb13', t]]
+            missing.add('bb13', t, terms(counts, i))
             c = 3*[0.0]
         else:            
             c = bb13 + [b1[0], b3[0]]
@@ -181,16 +254,128 @@ def bondbond13(types, frc):
     return coeffs,missing
     
 # Returns the mid-bond-torsion coefficients in an list for each type.
-def angletorsion(types, frc):
-    coeffs,missing = [],[]
-    for t in types:
+def angletorsion(types, frc, missing=None, counts=None):
+    coeffs,missing = [],collector(missing)
+    for i,t in enumerate(types):
         a1,a2 = frc.get_param(sort(t[0:3]),'a'),frc.get_param(sort(t[1:4]),'a')        
         at    = frc.get_param(t, 'at')
         if a1==None or a2==None or at==None:
-            missing += [['at', t]]
+            missing.add('at', t, terms(counts, i))
             c = 8*[0.0]
         else:
             if len(at) == 3: at += at
             c = at + [a1[0], a2[0]]
         coeffs.append(tuple(c))
     return coeffs,missing
+
+# Returns a function giving the sorted types t[i:j] of a term type t.
+def subtypes(i, j):
+    return lambda t: sort(list(t[i:j]))
+
+# Returns a function giving the sorted types of t in the order given.
+def picked(order, sortf=sort):
+    return lambda t: sortf([t[i] for i in order])
+
+same = lambda t: t
+# Columns of a parameter that are used: all, the first (an equilibrium value)
+# or reversed (epsilon, sigma of van der Waals parameters).
+every, first, backward = slice(None), [0], [1,0]
+
+# The parameters gathered into the coefficients of each function above, as
+# the kind of types it is given and the interaction, types and columns of
+# each part.  Coefficients are zero where any part is missing.
+compiled_sections = {
+    'pair':              ('atom',     [('vdw', same, backward)]),
+    'bond':              ('bond',     [('b',   same, every)]),
+    'angle':             ('angle',    [('a',   same, every)]),
+    'torsion':           ('dihedral', [('tor', same, every)]),
+    'oop':               ('improper', [('oop', same, every)]),
+    'bondbond':          ('angle',    [('bb',  same, every),
+                                       ('b',   subtypes(0,2), first),
+                                       ('b',   subtypes(1,3), first)]),
+    'bondangle':         ('angle',    [('ba',  same, every),
+                                       ('b',   subtypes(0,2), first),
+                                       ('b',   subtypes(1,3), first)]),
+    'angleangle':        ('improper', [('aa',  picked([0,1,2,3], sortaa), every),
+                                       ('aa',  picked([3,1,0,2], sortaa), every),
+                                       ('aa',  picked([0,1,3,2], sortaa), every),
+                                       ('a',   picked([0,1,2]), first),
+                                       ('a',   picked([0,1,3]), first),
+                                       ('a',   picked([2,1,3]), first)]),
+    'angleangletorsion': ('dihedral', [('aat', same, every),
+                                       ('a',   subtypes(0,3), first),
+                                       ('a',   subtypes(1,4), first)]),
+    'endbondtorsion':    ('dihedral', [('ebt', same, every),
+                                       ('b',   subtypes(0,2), first),
+                                       ('b',   subtypes(2,4), first)]),
+    'midbondtorsion':    ('dihedral', [('mbt', same, every),
+                                       ('b',   subtypes(1,3), first)]),
+    'bondbond13':        ('dihedral', [('bb13', same, every),
+                                       ('b',   subtypes(0,2), first),
+                                       ('b',   subtypes(2,4), first)]),
+    'angletorsion':      ('dihedral', [('at',  same, every),
+                                       ('a',   subtypes(0,3), first),
+                                       ('a',   subtypes(1,4), first)])}
+
+# Coefficients of the types of a system gathered from parameters resolved
+# once (see frc.Compiled), instead of looking up each type in the frc tables.
+# kinds holds the atom, bond, angle, dihedral and improper types.  The rows
+# of the compiled tables that each part of each section is gathered from are
+# found once, so that the coefficients are array gathers.
+class Tables:
+    def __init__(self, kinds, frc):
+        self.kinds, self.frc = kinds, frc
+        combos, rows, self.positions = {}, {}, {}
+        for name, (kind, parts) in compiled_sections.items():
+            self.positions[name] = []
+            for interaction, sub, cols in parts:
+                position = np.empty(len(kinds[kind]), dtype=np.int32)
+                for i,t in enumerate(kinds[kind]):
+                    s   = sub(t)
+                    key = (interaction, type_key(s))
+                    if not key in rows:
+                        rows[key] = len(combos.setdefault(interaction, []))
+                        combos[interaction].append(s)
+                    position[i] = rows[key]
+                self.positions[name].append(position)
+        self.compiled = frc.compile(combos)
+        self.gather()
+
+    # Finds the table rows of the parts of each section and the types of
+    # each section with missing parameters.  Needed again only when the
+    # combinations are resolved again.
+    def gather(self):
+        self.rows, self.missing, self.layout = {}, {}, self.compiled.layout
+        for name, (kind, parts) in compiled_sections.items():
+            rows = [self.compiled.index[interaction][position] for
+                    (interaction, sub, cols), position in zip(parts, self.positions[name])]
+            self.rows[name]    = rows
+            self.missing[name] = np.flatnonzero(np.any([r < 0 for r in rows], axis=0))
+
+    # Reads the parameters again after the frc tables have changed.
+    def update(self):
+        self.compiled.update()
+        if self.layout != self.compiled.layout: self.gather()
+
+    # Same as f(types, frc, missing, counts), one of the functions above, for
+    # the types of its kind, but returns the coefficients as an array.  Only
+    # the types with missing parameters are passed to f, to collect them.
+    def coeffs(self, f, missing=None, counts=None):
+        name        = f.__name__
+        missing     = collector(missing)
+        kind, parts = compiled_sections[name]
+        table       = self.compiled.table
+        c = np.hstack([table[interaction][rows][:,cols] for
+                       (interaction, sub, cols), rows in zip(parts, self.rows[name])])
+        types = self.kinds[kind]
+        for i in self.missing[name]:
+            c[i] = 0.0
+            f(types[i:i+1], self.frc, missing, None if counts is None else counts[i:i+1])
+        return c, missing
+
+# Returns tables (a Tables) of the kinds of types for frc, updated if they
+# were compiled for the same frc, or compiled if not.
+def compiled(tables, kinds, frc):
+    if tables is None or tables.frc is not frc: return Tables(kinds, frc)
+    tables.update()
+    return tables
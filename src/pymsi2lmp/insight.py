@@ -3,19 +3,244 @@
  insight.py - this module provides routines for reading .car and .mdf files
               generated by materials studio (exported as InsightII).
 """
+import os
+import re
+import numpy as np
+import timing
+import bonding
+from box import Box
+from itertools import izip, imap
 from molecular import Atom, System
+from topology import expand
 
-# Reads the car and mdf files and returns an array of atoms and bonds.
-def get_system(base):
+# Reads the car and mdf files and returns an array of atoms and bonds.  If
+# there is no mdf file, or perceive is true, the bonds are perceived from the
+# coordinates instead (see perceive_bonds).  Bonds of unphysical lengths are
+# reported (see check_bonds).
+def get_system(base, perceive=False, frc=None):
     if base.endswith('.car') or base.endswith('.mdf'):
         base = base[0:-4]
         
-    atoms, index, pbc, bounds = read_car(base + '.car')
-    read_mdf(base+'.mdf', atoms, index)
-    system = System(atoms, base, pbc, bounds)
-    system.remap_to_box()
+    model  = read_model(base, perceive, frc)
+    with timing.stage('check bonds') as counts:
+        counts['bonds'] = len(model.indices)//2
+        counts['unphysical'] = check_bonds(model, frc)
+    with timing.stage('system') as counts:
+        system = System(model.atoms(), base, model.pbc, model.bounds, model.box)
+        system.remap_to_box()
+        counts['atoms'] = len(system.atoms)
     return system
 
+# Reads the car and mdf files in bulk and returns a Model of arrays.  The
+# bonds are perceived if there is no mdf file or perceive is true.
+def read_model(base, perceive=False, frc=None):
+    with timing.stage('read car') as counts:
+        model = read_car_arrays(base + '.car')
+        counts['atoms'] = len(model.x)
+    if perceive or not os.path.exists(base + '.mdf'):
+        with timing.stage('perceive bonds') as counts:
+            perceive_bonds(model, frc)
+            counts['bonds'] = len(model.indices)//2
+        return model
+    with timing.stage('read mdf') as counts:
+        read_mdf_arrays(base + '.mdf', model)
+        counts['bonds'] = len(model.indices)//2
+    return model
+
+# Arrays of a model read from car and mdf files.  Fftypes and element
+# symbols are interned: each is stored once in a sorted table and atoms hold
+# its index in the table.
+class Model:
+    def __init__(self):
+        self.pbc      = False
+        self.bounds   = None
+        self.box      = None                        # box.Box if periodic.
+        self.x        = np.zeros((0,3))             # (N,3) coordinates.
+        self.q        = np.zeros(0)                 # Charges (mdf, else car).
+        self.seq      = np.zeros(0, dtype=np.int32) # Residue numbers - 1.
+        self.ff       = np.zeros(0, dtype=np.int32) # Index into ff_names.
+        self.sym      = np.zeros(0, dtype=np.int32) # Index into sym_names.
+        self.ff_names  = []
+        self.sym_names = []
+        self.index    = {}                          # Atom id -> atom.
+        # CSR connectivity, the neighbors of atom i are
+        # indices[indptr[i]:indptr[i+1]] in the order of the mdf, or in
+        # increasing order if perceived.
+        self.indptr   = np.zeros(1, dtype=np.int32)
+        self.indices  = np.zeros(0, dtype=np.int32)
+
+    # Returns a list of molecular.Atom.
+    def atoms(self):
+        x, conn = self.x.tolist(), self.indices.tolist()
+        p = self.indptr.tolist()
+        seq, q = self.seq.tolist(), self.q.tolist()
+        ff  = [self.ff_names[t] for t in self.ff.tolist()]
+        sym = [self.sym_names[t] for t in self.sym.tolist()]
+        atoms = []
+        for i in range(len(x)):
+            a      = Atom()
+            a.x    = x[i]
+            a.conn = conn[p[i]:p[i+1]]
+            a.seq  = seq[i]
+            a.ff   = ff[i]
+            a.sym  = sym[i]
+            a.q    = q[i]
+            atoms.append(a)
+        return atoms
+
+# Returns the text of the file at path following the first line that starts
+# with marker.
+def text_after(path, marker):
+    text = open(path, 'r').read()
+    if text.startswith(marker): start = 0
+    else:
+        start = text.find('\n' + marker) + 1
+        if start == 0: return ''
+    end = text.find('\n', start)
+    if end == -1: return ''
+    return text[end+1:]
+
+# Splits text into tokens and returns them with the number of tokens on each
+# line, counted from the starts of tokens in the bytes of the text.
+def tokenize(text):
+    tokens = text.split()
+    b      = np.frombuffer(text, dtype=np.uint8)
+    space  = b <= 32
+    start  = ~space
+    start[1:] &= space[:-1]
+    line  = np.append(0, np.flatnonzero(b==10) + 1)
+    line  = line[line < len(b)]
+    count = np.zeros(len(line), dtype=np.int32)
+    if len(line):
+        count = np.add.reduceat(start.view(np.uint8), line, dtype=np.int32)
+    if count.sum() != len(tokens):
+        # Control characters that do not split tokens.
+        count = np.array([len(l.split()) for l in text.split('\n')],
+                         dtype=np.int32)
+    return tokens, count
+
+# Returns the numbers in a list of strings as an array.
+def numbers(s, dtype=float):
+    return np.fromstring(' '.join(s), dtype=dtype, sep=' ')
+
+# Returns the sorted table of unique strings of s and the index of each.
+def unique(s):
+    table = [intern(t) for t in sorted(set(s))]
+    index = dict((t,i) for i,t in enumerate(table))
+    return table, lookup(index, s)
+
+# Returns the values of dictionary d for the keys s as an array.
+def lookup(d, s):
+    return np.fromiter(imap(d.__getitem__, s), dtype=np.int32, count=len(s))
+
+# Returns the tokens at positions k.
+def take(tokens, k):
+    return [tokens[j] for j in k.tolist()]
+
+# Reads the car file from MS into a Model.  Atom lines are tokenized as one
+# block, each column being a strided slice of the tokens.
+def read_car_arrays(path):
+    model = Model()
+    # Lines are matched from their leading newline.
+    text  = '\n' + text_after(path, '!DATE')
+    # PBC a b c alpha beta gamma, the angles being optional.
+    for line in re.findall('\nPBC[^\n]*', text):
+        line = line.split()
+        if len(line) < 6: continue
+        cell = [float(x) for x in line[1:7] if not x.startswith('(')]
+        model.box    = Box(cell[0:3], cell[3:6] if len(cell) == 6 else (90.0,)*3)
+        model.bounds = model.box.bounds
+        model.pbc    = True
+    tokens, count = tokenize(re.sub('\n(?:PBC|end)[^\n]*', '', text))
+    if ((count != 0) & (count != 9)).any():
+        # Some lines are not atom lines, so take the tokens of atom lines.
+        first = np.cumsum(count) - count
+        for k in np.flatnonzero((count >= 6) & (count != 9)):
+            print 'Invalid data line', ' '.join(tokens[first[k]:first[k]+count[k]])
+        line, local = expand(9*(count == 9))
+        tokens = take(tokens, first[line] + local)
+    n = len(tokens)//9
+    model.x = np.empty((n,3))
+    for c in range(3):
+        model.x[:,c] = numbers(tokens[1+c::9])
+    model.seq = numbers(tokens[5::9], np.int32) - 1
+    model.ff_names,  model.ff  = unique(tokens[6::9])
+    model.sym_names, model.sym = unique(tokens[7::9])
+    # Atom ids are segment_residue:name, as in the mdf file.
+    ids = map('%s_%s:%s'.__mod__, izip(tokens[4::9], tokens[5::9], tokens[0::9]))
+    model.index  = dict(izip(ids, xrange(n)))
+    model.q      = numbers(tokens[8::9])
+    model.indptr = np.zeros(n+1, dtype=np.int32)
+    return model
+
+# Reads charges and connectivity from the mdf file into model.  The atom
+# block is tokenized at once, bond orders are stripped from all connections
+# at once and atom ids are resolved in the id dictionary.
+def read_mdf_arrays(path, model):
+    tokens, count = tokenize(text_after(path, '@molecule'))
+    first  = np.cumsum(count) - count
+    atom   = count >= 12
+    first, count = first[atom], count[atom] - 12
+    ids = take(tokens, first)
+    i   = lookup(model.index, ids)
+    model.q[i] = numbers(take(tokens, first + 6))
+    # Connections are in the residue of the atom unless one is given.
+    owner, local = expand(count)
+    conn    = take(tokens, first[owner] + 12 + local)
+    conn    = re.sub('/\S*', '', ' '.join(conn)).split()
+    residue = [s[0:s.find(':')+1] for s in ids]
+    conn = [s if ':' in s else residue[o] + s
+            for o,s in izip(owner.tolist(), conn)]
+    j = lookup(model.index, conn)
+    # Connections of each atom in file order, with atoms in car order.
+    row   = i[owner]
+    order = np.argsort(row, kind='mergesort')
+    model.indices = j[order]
+    degree = np.bincount(row, minlength=len(model.x))
+    np.cumsum(degree, out=model.indptr[1:])
+
+# Returns the covalent radius of each atom of model (see bonding.radii).  The
+# element of each atom is that of its fftype in frc (a frc.Frc) if given,
+# or else the element in the car file.
+def atom_radii(model, frc=None, default=None):
+    if frc is None:
+        return bonding.radii(model.sym_names, default)[model.sym]
+    # The car element of the first atom of each type not in frc.
+    first = np.zeros(len(model.ff_names), dtype=np.int64)
+    first[model.ff[::-1]] = np.arange(len(model.ff))[::-1]
+    elements = [frc.types[t][0] if t in frc.types else
+                model.sym_names[model.sym[first[k]]]
+                for k,t in enumerate(model.ff_names)]
+    return bonding.radii(elements, default)[model.ff]
+
+# Perceives the bonds of model from the coordinates (see bonding.py).
+def perceive_bonds(model, frc=None):
+    model.indptr, model.indices = bonding.perceive(model.x, atom_radii(model, frc),
+                                                   model.box)
+
+# Number of unphysical bonds listed by check_bonds.
+listed_bonds = 10
+
+# Warns of the bonds of model whose lengths are unphysical (see
+# bonding.unphysical_bonds), to the nearest image if the model is periodic,
+# e.g. a molecule split by a wrong wrap or a box that does not fit the
+# model.  Elements without a covalent radius are taken as carbon.  Returns
+# the number of such bonds.
+def check_bonds(model, frc=None):
+    i, j = bonding.bond_pairs(model.indptr, model.indices)
+    r = atom_radii(model, frc, bonding.covalent_radii['C'])
+    bad, d = bonding.unphysical_bonds(model.x, r, i, j, model.box)
+    if len(bad) == 0: return 0
+    print 'Warning: %d bonds of unphysical length, check the coordinates' %len(bad),
+    print 'and the periodic box of the model:'
+    atoms = set(i[bad].tolist() + j[bad].tolist())
+    names = dict((k,s) for s,k in model.index.iteritems() if k in atoms)
+    for k, l in izip(bad[:listed_bonds].tolist(), d.tolist()):
+        print '    %s - %s %10.3f' %(names[i[k]], names[j[k]], l)
+    if len(bad) > listed_bonds:
+        print '    ... and %d more' %(len(bad) - listed_bonds)
+    return len(bad)
+
 # Reads the car file from MS.
 def read_car(path):
     fid         = open(path, 'r')
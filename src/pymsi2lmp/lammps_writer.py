@@ -7,7 +7,13 @@
 """
 
 import frc2lmp
+import timing
+import bundle
 import sys
+import gzip
+import itertools
+import numpy as np
+from collections import OrderedDict
 
 # Template string for the system bounds specified to LAMMPS.
 lmp_bounds = """
@@ -15,135 +21,262 @@ lmp_bounds = """
  %15.9f %15.9f ylo yhi
  %15.9f %15.9f zlo zhi
 """
+# Tilt factors of a triclinic box.
+lmp_tilt = " %15.9f %15.9f %15.9f xy xz yz\n"
 
-# Writes the LAMMPS output file. 
-def write_data(system, frc):
-    fid = open(system.title+'.lammps','w')
-    atoms,  types  = system.atom_types()
-    bonds,  btypes = system.bonds()
-    angles, atypes = system.angles()
-    dihed,  dtypes = system.dihedrals()
-    oop,    otypes = system.impropers()       
-        
-    fid.write('LAMMPS 2005 data file for ' + system.title + '\n\n')
-    fid.write(' %6d atoms\n'       %len(atoms))
-    fid.write(' %6d bonds\n'       %len(bonds))
-    fid.write(' %6d angles\n'      %len(angles))
-    fid.write(' %6d dihedrals\n'   %len(dihed))
-    fid.write(' %6d impropers\n\n' %len(oop))         
-    fid.write(' %3d atom types\n'  %len(types))
-    fid.write(' %3d bond types\n'  %len(btypes))
-    fid.write(' %3d angle types\n' %len(atypes))          
-    if len(dtypes): fid.write(' %3d dihedral types\n' %len(dtypes))
-    if len(otypes): fid.write(' %3d improper types\n' %len(otypes))
-    fid.write(lmp_bounds %system.compute_bounds())
+# Coeffs sections: header, frc2lmp function and the kind of types it is given.
+coeff_sections = [('Pair Coeffs',              frc2lmp.pair,              'atom'),
+                  ('Bond Coeffs',              frc2lmp.bond,              'bond'),
+                  ('Angle Coeffs',             frc2lmp.angle,             'angle'),
+                  ('Dihedral Coeffs',          frc2lmp.torsion,           'dihedral'),
+                  ('Improper Coeffs',          frc2lmp.oop,               'improper'),
+                  ('BondBond Coeffs',          frc2lmp.bondbond,          'angle'),
+                  ('BondAngle Coeffs',         frc2lmp.bondangle,         'angle'),
+                  ('AngleAngle Coeffs',        frc2lmp.angleangle,        'improper'),
+                  ('AngleAngleTorsion Coeffs', frc2lmp.angleangletorsion, 'dihedral'),
+                  ('EndBondTorsion Coeffs',    frc2lmp.endbondtorsion,    'dihedral'),
+                  ('MiddleBondTorsion Coeffs', frc2lmp.midbondtorsion,    'dihedral'),
+                  ('BondBond13 Coeffs',        frc2lmp.bondbond13,        'dihedral'),
+                  ('AngleTorsion Coeffs',      frc2lmp.angletorsion,      'dihedral')]
+# Formats of the type index and of each coefficient, if not '%3d' and ' %10.4f'.
+coeff_formats = {'Pair Coeffs': (' %3d', ' %14.10f')}
+
+# Number of rows formatted and written at a time.
+chunk_rows = 8192
+
+# Compression level of gzipped data files.  Data files compress about 3.5
+# times at level 1; level 6 makes them a quarter smaller but takes about
+# five times longer, which is more than formatting them.
+gzip_level = 1
+
+# Opens a data file for writing, gzipped if path ends in .gz.
+def open_data(path):
+    if path.endswith('.gz'): return gzip.open(path, 'wb', gzip_level)
+    return open(path, 'w')
+
+# Writes rows (tuples from any iterable) with the row format fmt, formatting
+# chunk_rows rows with a single % operation and write.
+def write_rows(fid, fmt, rows):
+    rows = iter(rows)
+    while True:
+        block = list(itertools.islice(rows, chunk_rows))
+        if not block: break
+        fid.write((fmt*len(block)) %tuple(itertools.chain.from_iterable(block)))
+
+# Writes the rows of each 2D array in blocks with the row format fmt.
+def write_blocks(fid, fmt, blocks):
+    for block in blocks:
+        fid.write((fmt*len(block)) %tuple(block.ravel().tolist()))
+
+# Returns rows of (term id, type, atoms...) from a list of AtomSets.
+def term_rows(terms):
+    for i,x in enumerate(terms):
+        yield (i+1, x.type_index+1) + tuple([a+1 for a in x.atoms])
+
+# Yields blocks of rows of (term id, type, atoms...) from the arrays of atom
+# indices and type indices returned by the topology engine.
+def term_blocks(indices, type_index):
+    for i in range(0, len(indices), chunk_rows):
+        atoms = indices[i:i+chunk_rows]
+        block = np.empty((len(atoms), 2+atoms.shape[1]), dtype=np.int64)
+        block[:,0]  = np.arange(i+1, i+1+len(atoms))
+        block[:,1]  = type_index[i:i+chunk_rows] + 1
+        block[:,2:] = atoms + 1
+        yield block
+
+# Writes a list of AtomSets, or if type_index is given, the arrays of atom 
+# indices and type indices from the topology engine.
+def write_terms(fid, fmt, terms, type_index=None):
+    if type_index is None: write_rows(fid, fmt, term_rows(terms))
+    else:                  write_blocks(fid, fmt, term_blocks(terms, type_index))
+
+# Writes the LAMMPS output file.  If stream is true, the topology is built
+# by the array engine (topology.py) and each section is written straight
+# from the arrays, so that no Python object is made per term.  The array
+# engine enumerates the terms in the given number of processes.  If compiled
+# is true, the coefficients are gathered from parameters resolved once for
+# the types of the system (see frc2lmp.Tables).  If compress is true, the
+# file is gzipped as title.lammps.gz, and if binary is true, the sections
+# are also written as arrays to title.npz (see bundle.py).
+def write_data(system, frc, stream=False, processes=1, compiled=False,
+               compress=False, binary=False):
+    fid = open_data(system.title + ('.lammps.gz' if compress else '.lammps'))
+    writer  = DataWriter(system, stream, processes, compiled)
+    missing = writer.write(fid, frc)
+    fid.close()
+    if binary: writer.write_bundle(system.title + '.npz')
+    return missing
+
+# Builds atom types or a kind of term with builder, timed as a stage.
+def build(name, builder):
+    with timing.stage('topology ' + name) as counts:
+        result = builder()
+        counts['terms'], counts['types'] = len(result[0]), len(result[-1])
+    return result
+
+# Writes the sections of a LAMMPS data file for a system.  The topology is
+# built once, so that the Masses and Coeffs sections can be written again
+# for other force field parameters (see pymsi2lmp.Session).
+class DataWriter:
+    def __init__(self, system, stream=False, processes=1, compiled=False):
+        self.system = system
+        self.atoms  = system.atoms
+        if stream:
+            topology = system.topology(processes)
+            try:
+                self.atom_type_index, self.types = build('atom types', topology.atom_types)
+                self.bonds,  self.bond_type,  self.btypes = build('bonds',     topology.bonds)
+                self.angles, self.angle_type, self.atypes = build('angles',    topology.angles)
+                self.dihed,  self.dihed_type, self.dtypes = build('dihedrals', topology.dihedrals)
+                self.oop,    self.oop_type,   self.otypes = build('impropers', topology.impropers)
+            finally:
+                topology.close()
+        else:
+            self.atoms,  self.types  = build('atom types', system.atom_types)
+            self.bonds,  self.btypes = build('bonds',      system.bonds)
+            self.angles, self.atypes = build('angles',     system.angles)
+            self.dihed,  self.dtypes = build('dihedrals',  system.dihedrals)
+            self.oop,    self.otypes = build('impropers',  system.impropers)
+            self.atom_type_index = [self.types.index(x.ff) for x in self.atoms]
+            self.bond_type = self.angle_type = None
+            self.dihed_type = self.oop_type = None
+        self.counts = self.type_counts()
+        self.kinds  = {'atom': self.types, 'bond': self.btypes, 'angle': self.atypes,
+                       'dihedral': self.dtypes, 'improper': self.otypes}
+        self.compiled, self.tables = compiled, None
+        # Masses and coefficients of each Coeffs section last written.
+        self.masses, self.coeffs = [], OrderedDict()
+
+    # Returns the number of atoms or terms of each type, for each kind.
+    def type_counts(self):
+        counts = {}
+        for kind, terms, tid, types in [
+                ('atom',     self.atoms,  self.atom_type_index, self.types),
+                ('bond',     self.bonds,  self.bond_type,       self.btypes),
+                ('angle',    self.angles, self.angle_type,      self.atypes),
+                ('dihedral', self.dihed,  self.dihed_type,      self.dtypes),
+                ('improper', self.oop,    self.oop_type,        self.otypes)]:
+            if tid is None: tid = [x.type_index for x in terms]
+            tid = np.asarray(tid, dtype=np.int64)
+            counts[kind] = np.bincount(tid, minlength=len(types))
+        return counts
+
+    # Writes the whole data file, returns the missing parameters.
+    def write(self, fid, frc):
+        with timing.stage('write header'):
+            self.write_header(fid)
+        missing = self.write_coeffs(fid, frc)
+        self.write_body(fid)
+        return missing
+
+    # Writes the counts, the box bounds and the tilt of a triclinic box.
+    def write_header(self, fid):
+        system, types = self.system, self.types
+        btypes, atypes, dtypes, otypes = self.btypes, self.atypes, self.dtypes, self.otypes
+        fid.write('LAMMPS 2005 data file for ' + system.title + '\n\n')
+        fid.write(' %6d atoms\n'       %len(self.atoms))
+        fid.write(' %6d bonds\n'       %len(self.bonds))
+        fid.write(' %6d angles\n'      %len(self.angles))
+        fid.write(' %6d dihedrals\n'   %len(self.dihed))
+        fid.write(' %6d impropers\n\n' %len(self.oop))         
+        fid.write(' %3d atom types\n'  %len(types))
+        fid.write(' %3d bond types\n'  %len(btypes))
+        fid.write(' %3d angle types\n' %len(atypes))          
+        if len(dtypes): fid.write(' %3d dihedral types\n' %len(dtypes))
+        if len(otypes): fid.write(' %3d improper types\n' %len(otypes))
+        fid.write(lmp_bounds %system.bounds)
+        if system.box and system.box.triclinic:
+            fid.write(lmp_tilt %system.box.tilt)
     
-    fid.write('\nMasses\n\n')
-    for i,t in enumerate(types):
-        if not t in frc.types:
-            print 'Atom type', t, 'not found, enter it into the frc file.'
-            sys.exit(1)
+    # Writes the Masses and Coeffs sections, returns the missing parameters
+    # (a frc2lmp.Missing) with the number of terms that need each one.
+    def write_coeffs(self, fid, frc):
+        types = self.types
+        fid.write('\nMasses\n\n')
+        self.masses = []
+        for i,t in enumerate(types):
+            if not t in frc.types:
+                print 'Atom type', t, 'not found, enter it into the frc file.'
+                sys.exit(1)
             
-        atom_type = frc.types[t][1]
-        fid.write('%4d %10.6f\n' %(i+1, frc.types[t][1]))
+            atom_type = frc.types[t][1]
+            fid.write('%4d %10.6f\n' %(i+1, frc.types[t][1]))
+            self.masses.append(frc.types[t][1])
 
-    fid.write('\nPair Coeffs\n\n')       
-    vdwcoeff,vdwmissing = frc2lmp.pair(types, frc)
-    for i,c in enumerate(vdwcoeff):
-        fid.write(' %3d'%(i+1) + len(c)*' %14.10f'%c + '\n')
-    
-    bondcoeff,bondmissing = frc2lmp.bond(btypes, frc)
-    if len(btypes): fid.write('\nBond Coeffs\n\n')
-    for i,c in enumerate(bondcoeff):
-        fid.write('%3d'%(i+1) + len(c)*' %10.4f'%c + '\n')
-       
-    anglecoeff,anglemissing = frc2lmp.angle(atypes, frc)
-    if len(atypes): fid.write('\nAngle Coeffs\n\n')
-    for i,c in enumerate(anglecoeff):
-        fid.write('%3d'%(i+1) + len(c)*' %10.4f'%c + '\n')        
-   
-    torsioncoeff,torsionmissing = frc2lmp.torsion(dtypes, frc)
-    if len(dtypes): fid.write('\nDihedral Coeffs\n\n')
-    for i,c in enumerate(torsioncoeff):
-        fid.write('%3d'%(i+1) + len(c)*' %10.4f'%c + '\n')
-    
-    oopcoeff,oopmissing = frc2lmp.oop(otypes, frc)
-    if len(otypes): fid.write('\nImproper Coeffs\n\n')
-    for i,c in enumerate(oopcoeff):
-        fid.write('%3d'%(i+1) + len(c)*' %10.4f'%c + '\n')
-
-    bbcoeff,bbmissing = frc2lmp.bondbond(atypes,frc)
-    if len(atypes): fid.write('\nBondBond Coeffs\n\n')
-    for i,c in enumerate(bbcoeff):
-        fid.write('%3d'%(i+1) + len(c)*' %10.4f'%c + '\n')
-        
-    bacoeff,bamissing = frc2lmp.bondangle(atypes,frc)
-    if len(atypes): fid.write('\nBondAngle Coeffs\n\n')
-    for i,c in enumerate(bacoeff):
-        fid.write('%3d'%(i+1) + len(c)*' %10.4f'%c + '\n')
-        
-    aacoeff,aamissing = frc2lmp.angleangle(otypes,frc)
-    if len(otypes): fid.write('\nAngleAngle Coeffs\n\n')
-    for i,c in enumerate(aacoeff):
-        fid.write('%3d'%(i+1) + len(c)*' %10.4f'%c + '\n')
-    
-    aatcoeff,aatmissing = frc2lmp.angleangletorsion(dtypes,frc)
-    if len(dtypes): fid.write('\nAngleAngleTorsion Coeffs\n\n')
-    for i,c in enumerate(aatcoeff):
-        fid.write('%3d'%(i+1) + len(c)*' %10.4f'%c + '\n')
-
-    ebtcoeff,ebtmissing = frc2lmp.endbondtorsion(dtypes,frc)
-    if len(dtypes): fid.write('\nEndBondTorsion Coeffs\n\n')
-    for i,c in enumerate(ebtcoeff):
-        fid.write('%3d'%(i+1) + len(c)*' %10.4f'%c + '\n')
-    
-    mbtcoeff,mbtmissing = frc2lmp.midbondtorsion(dtypes,frc)
-    if len(dtypes): fid.write('\nMiddleBondTorsion Coeffs\n\n')
-    for i,c in enumerate(mbtcoeff):
-        fid.write('%3d'%(i+1) + len(c)*' %10.4f'%c + '\n')
-        
-    bb13coeff,bb13missing = frc2lmp.bondbond13(dtypes,frc)
-    if len(dtypes): fid.write('\nBondBond13 Coeffs\n\n')
-    for i,c in enumerate(bb13coeff):
-        fid.write('%3d'%(i+1) + len(c)*' %10.4f'%c + '\n')
-        
-    atcoeff,atmissing = frc2lmp.angletorsion(dtypes,frc)
-    if len(dtypes): fid.write('\nAngleTorsion Coeffs\n\n')
-    for i,c in enumerate(atcoeff):
-        fid.write('%3d'%(i+1) + len(c)*' %10.4f'%c + '\n')
-        
-    missing  = vdwmissing + bondmissing + anglemissing + torsionmissing
-    missing += oopmissing + bbmissing   + bamissing    + aamissing + aatmissing
-    missing += ebtmissing + mbtmissing  + bb13missing  + atmissing       
-    
-    #  Now list atoms, bonds, angles, etc.
-    fid.write('\nAtoms\n\n')
-    for i,x in enumerate(atoms):
-        fid.write(' %6d %6d %3d %9.6f' %(i+1, x.seq, types.index(x.ff)+1, x.q))
-        fid.write('%15.9f %15.9f %15.9f\n' %tuple(x.x))
-
-    # Writes a string of atom indices to a file.
-    def write_atom_indices(fid, atoms):
-        fid.write(('%6d '*len(atoms)).strip() %tuple([a+1 for a in atoms]) + '\n')
-        
-    fid.write('\nBonds\n\n')
-    for i,x in enumerate(bonds):
-        fid.write('%6d %3d' %(i+1, x.type_index+1))
-        write_atom_indices(fid, x.atoms)
-
-    fid.write('\nAngles\n\n')
-    for i,x in enumerate(angles):
-        fid.write('%6d %3d ' %(i+1, x.type_index+1))
-        write_atom_indices(fid, x.atoms)
-
-    fid.write('\nDihedrals\n\n')
-    for i,x in enumerate(dihed):
-        fid.write('%6d %3d ' %(i+1, x.type_index+1)) 
-        write_atom_indices(fid, x.atoms)
-        
-    fid.write('\nImpropers\n\n')
-    for i,x in enumerate(oop):
-        fid.write('%6d %3d ' %(i+1, x.type_index+1)) 
-        write_atom_indices(fid, x.atoms)
-    
-    return missing
+        if self.compiled:
+            with timing.stage('coeffs compile') as counts:
+                before = frc.lookup_stats()
+                self.tables = frc2lmp.compiled(self.tables, self.kinds, frc)
+                timing.add_lookups(counts, frc, before)
+
+        missing = frc2lmp.Missing()
+        kinds   = self.kinds
+        for header, f, kind in coeff_sections:
+            with timing.stage('coeffs ' + f.__name__) as counts:
+                before = frc.lookup_stats()
+                if self.tables:
+                    coeff, missing = self.tables.coeffs(f, missing, self.counts[kind])
+                else:
+                    coeff, missing = f(kinds[kind], frc, missing, self.counts[kind])
+                if header == 'Pair Coeffs' or len(kinds[kind]):
+                    fid.write('\n%s\n\n' %header)
+                index, value = coeff_formats.get(header, ('%3d', ' %10.4f'))
+                for i,c in enumerate(coeff):
+                    fid.write(index%(i+1) + len(c)*value%tuple(c) + '\n')
+                self.coeffs[header] = coeff
+                counts['types'] = len(kinds[kind])
+                timing.add_lookups(counts, frc, before)
+        return missing
+
+    # Writes the Atoms, Bonds, Angles, Dihedrals and Impropers sections.
+    def write_body(self, fid):
+        with timing.stage('write atoms') as counts:
+            fid.write('\nAtoms\n\n')
+            rows = ((i+1, x.seq, t+1, x.q, x.x[0], x.x[1], x.x[2]) 
+                    for i,(x,t) in enumerate(itertools.izip(self.atoms, self.atom_type_index)))
+            write_rows(fid, ' %6d %6d %3d %9.6f%15.9f %15.9f %15.9f\n', rows)
+            counts['rows'] = len(self.atoms)
+
+        for header, fmt, terms, type_index in [
+                ('Bonds',     '%6d %3d%6d %6d\n',               self.bonds,  self.bond_type),
+                ('Angles',    '%6d %3d %6d %6d %6d\n',          self.angles, self.angle_type),
+                ('Dihedrals', '%6d %3d %6d %6d %6d %6d\n',      self.dihed,  self.dihed_type),
+                ('Impropers', '%6d %3d %6d %6d %6d %6d\n',      self.oop,    self.oop_type)]:
+            with timing.stage('write ' + header.lower()) as counts:
+                fid.write('\n%s\n\n' %header)
+                write_terms(fid, fmt, terms, type_index)
+                counts['rows'] = len(terms)
+
+    # Returns the sections of the data file as arrays (see bundle.py), with
+    # the masses and coefficients last written by write_coeffs.
+    def arrays(self):
+        system = self.system
+        arrays = {'bounds':    np.array(system.bounds),
+                  'atom_type': np.asarray(self.atom_type_index, dtype=np.int32) + 1,
+                  'molecule':  np.array([a.seq for a in self.atoms], dtype=np.int32),
+                  'charge':    np.array([a.q for a in self.atoms]),
+                  'x':         system.x,
+                  'atom_types': np.array(list(self.types), dtype=str),
+                  'masses':    np.array(self.masses)}
+        if system.box and system.box.triclinic:
+            arrays['tilt'] = np.array(system.box.tilt)
+        for name, kind, k, terms, type_index, types in [
+                ('bonds',     'bond',     2, self.bonds,  self.bond_type,  self.btypes),
+                ('angles',    'angle',    3, self.angles, self.angle_type, self.atypes),
+                ('dihedrals', 'dihedral', 4, self.dihed,  self.dihed_type, self.dtypes),
+                ('impropers', 'improper', 4, self.oop,    self.oop_type,   self.otypes)]:
+            if type_index is None:
+                type_index = [x.type_index for x in terms]
+                terms      = [x.atoms for x in terms]
+            arrays[name] = np.asarray(terms, dtype=np.int32).reshape(-1, k) + 1
+            arrays[kind + '_type']  = np.asarray(type_index, dtype=np.int32) + 1
+            arrays[kind + '_types'] = np.array(list(types), dtype=str).reshape(-1, k)
+        for header, coeff in self.coeffs.items():
+            arrays[bundle.coeffs_name(header)] = np.array(coeff, dtype=float)
+        return arrays
+
+    # Writes the arrays of the data file as a bundle to path.
+    def write_bundle(self, path):
+        with timing.stage('write bundle') as counts:
+            bundle.write(path, self.arrays())
+            counts['atoms'] = len(self.atoms)
@@ -4,104 +4,162 @@
                to build lammps data files.
 """
 
+import numpy as np
+import box as boxes
 from frc import sort_bond_or_angle, sort_oop, sort_torsion
 
-# 
-class AtomSet:
+# Ordered table of interaction types.  Each type is mapped to its index in
+# order of first appearance through a dictionary, so lookups do not scan.
+class TypeTable(list):
+    def __init__(self):
+        list.__init__(self)
+        self.ids   = {}
+        self.ranks = {}
+
+    # Returns the index of type t, adding it to the table if it is new.
+    def id(self, t):
+        key = type_key(t)
+        i   = self.ids.get(key)
+        if i == None:
+            i = self.ids[key] = len(self)
+            self.append(t)
+        return i
+
+    # Returns the index of the type with the atom type ranks r (a list, see
+    # rank_types), adding the type named by names if it is new.  Types are
+    # hashed as tuples of ranks, and their names are only built once.
+    def rank_id(self, r, names):
+        key = tuple(r)
+        i   = self.ranks.get(key)
+        if i == None:
+            i = self.ranks[key] = self.id([names[p] for p in r])
+        return i
+
+    # Same as list.index, but found with a dictionary lookup.
+    def index(self, t):
+        return self.ids[type_key(t)]
+
+    def __contains__(self, t):
+        return type_key(t) in self.ids
+
+# Types are lists of fftype strings (or a single string for atoms).
+def type_key(t):
+    if isinstance(t, list): return tuple(t)
+    return t
+
+# Ranks the atom types by name.  Returns the sorted names and the rank of the
+# type of each atom, so that comparing ranks gives the same result as
+# comparing the fftype strings in the frc.sort_* functions.
+def rank_types(atoms):
+    ff    = [a.ff for a in atoms]
+    names = sorted(set(ff))
+    rank  = dict((t,i) for i,t in enumerate(names))
+    return names, [rank[t] for t in ff]
+
+# Atoms of a topology term and the index of its type.  Slotted, so that
+# instances have no per-instance dictionary.
+class AtomSet(object):
+    __slots__ = ('atoms', 'type_index')
     def __init__(self, atoms, type_index):
-        self.atoms      = atoms
+        self.atoms      = tuple(atoms)
         self.type_index = type_index        
 
-# Atomic data class.
-class Atom:
+# Atomic data class, slotted like AtomSet.
+class Atom(object):
+    __slots__ = ('x', 'conn', 'seq', 'ff', 'sym', 'q')
     def __init__(self):
         self.x    = []
         self.conn = []
         self.seq  = 0
         self.ff   = 0
         self.sym  = 0        
+        self.q    = 0.0
     # Writes to a string.
     def __str__(self):
         s = '%5s: % 9.6f % 9.6f % 9.6f' %tuple([self.ff] + self.x)
         s += '  ' + str(self.conn)
         return s
 
-# System of atoms and bonds.
+# System of atoms and bonds.  The bounds, and the box (a box.Box) of a
+# periodic system, are set up once here and written by the data file.
 class System:
-    def __init__(self, atoms, title, pbc, bounds):
+    def __init__(self, atoms, title, pbc, bounds, box=None):
         self.atoms  = atoms     # List of atoms in the system.
         self.title  = title     # System title.        
         self.pbc    = pbc       # Periodic boundary conditions.
-        if bounds==None: self.bounds = self.compute_bounds()
-        else:            self.bounds = bounds
+        # (N,3) array of atom coordinates.
+        self.x = np.array([a.x for a in atoms], dtype=np.float64).reshape(-1,3)
+        if pbc and box is None: box = boxes.from_bounds(bounds)
+        self.box = box if pbc else None
+        if pbc:            self.bounds = box.bounds
+        elif bounds==None: self.bounds = self.compute_bounds()
+        else:              self.bounds = bounds
 
-    # Remaps atom coordinates so that they fit in the simulation box.
+    # Remaps atom coordinates so that they fit in the simulation box (see
+    # box.Box.wrap).  Atoms in the box or on a face are not moved.
     def remap_to_box(self):
         if not self.pbc: return
-        dx = [self.bounds[1]-self.bounds[0], 
-              self.bounds[3]-self.bounds[2], 
-              self.bounds[5]-self.bounds[4]]
-        for a in self.atoms:
-            for i in range(3):
-                while a.x[i] < self.bounds[i*2]:
-                    a.x[i] += dx[i]
-                while a.x[i] > self.bounds[i*2+1]:
-                    a.x[i] -= dx[i]
+        x   = self.x
+        out = np.flatnonzero(self.box.outside(x))
+        x[out] = self.box.wrap(x[out])
+        y = x[out].ravel().tolist()
+        for k,i in enumerate(out.tolist()): self.atoms[i].x[:] = y[3*k:3*k+3]
                             
     # Computes the bounds of the atoms in the domain. 
     def compute_bounds(self):
-        r = []
-        for i in range(3):
-            x  = [a.x[i] for a in self.atoms]
-            r += [min(x), max(x)]
-        return tuple(r)
+        r = np.column_stack((self.x.min(axis=0), self.x.max(axis=0)))
+        return tuple(r.ravel().tolist())
 
     # Returns an array of atomic types.
     def atom_types(self):
-        types = []
+        types = TypeTable()
         for a in self.atoms:
-            if not a.ff in types:
-                types.append(a.ff)
+            types.id(a.ff)
         return self.atoms,types
 
-    # Builds the bond table up.
+    # Returns the array based topology engine (see topology.py), which
+    # enumerates terms in the given number of processes.
+    def topology(self, processes=1):
+        from topology import Topology
+        return Topology(self, processes)
+
+    # Builds the bond table up.  Terms are ordered and typed by the ranks of
+    # their atom types (see rank_types), in this and the builders below.
     def bonds(self):
-        types,bonds = [],[]
+        names, rank = rank_types(self.atoms)
+        types,bonds = TypeTable(),[]
         for i, a in enumerate(self.atoms):
             for j in a.conn:
                 if i > j: continue
                 ij = [i,j]
-                t, ij = sort_bond_or_angle([self.atoms[p].ff for p in ij], ij)
-                if not t in types: types.append(t)
-                bonds.append(AtomSet(ij, types.index(t)))
+                r, ij = sort_bond_or_angle([rank[p] for p in ij], ij)
+                bonds.append(AtomSet(ij, types.rank_id(r, names)))
         return bonds, types
     
     # Builds up the angles from each atom.
     def angles(self):
-        types,angles = [],[]
+        names, rank = rank_types(self.atoms)
+        types,angles = TypeTable(),[]
         # Center is atom j.
         for j, a in enumerate(self.atoms):
             for i in a.conn:
                 for k in a.conn:
                     if k <= i: continue
                     ijk = [i,j,k]
-                    t,ijk = sort_bond_or_angle([self.atoms[p].ff for p in ijk], ijk)
-                    if not t in types: 
-                        types.append(t)
-                    angles.append(AtomSet(ijk, types.index(t)))
+                    r,ijk = sort_bond_or_angle([rank[p] for p in ijk], ijk)
+                    angles.append(AtomSet(ijk, types.rank_id(r, names)))
         return angles, types
 
     # Builds up improper groups.
     def impropers(self):
-        types,oop = [],[]
+        names, rank = rank_types(self.atoms)
+        types,oop = TypeTable(),[]
         # Center is atom j
         for j, a in enumerate(self.atoms):
             if len(a.conn)==3:
                 ijkl = [a.conn[0], j, a.conn[1], a.conn[2]]
-                t,ijkl = sort_oop([self.atoms[p].ff for p in ijkl], ijkl)
-                if not t in types: 
-                    types.append(t)
-                oop.append(AtomSet(ijkl, types.index(t)))
+                r,ijkl = sort_oop([rank[p] for p in ijkl], ijkl)
+                oop.append(AtomSet(ijkl, types.rank_id(r, names)))
         # Now loop over sets of 4 atoms.
         for j, a in enumerate(self.atoms):        
             if len(a.conn)==4:                
@@ -109,16 +167,15 @@ class System:
                            [a.conn[0], j, a.conn[2], a.conn[3]],
                            [a.conn[0], j, a.conn[1], a.conn[3]],
                            [a.conn[0], j, a.conn[1], a.conn[2]]]                
-                all_oop = [sort_oop([self.atoms[p].ff for p in q], q) for q in all_oop]
-                for t,ijkl in all_oop:
-                    if not t in types:
-                        types.append(t)
-                    oop.append(AtomSet(ijkl, types.index(t)))
+                all_oop = [sort_oop([rank[p] for p in q], q) for q in all_oop]
+                for r,ijkl in all_oop:
+                    oop.append(AtomSet(ijkl, types.rank_id(r, names)))
         return oop, types
 
     # Builds up dihedral groups.
     def dihedrals(self):
-        types,dihed = [],[]
+        names, rank = rank_types(self.atoms)
+        types,dihed = TypeTable(),[]
         for j, a in enumerate(self.atoms):
             if len(a.conn)<2: continue
             for k in a.conn:
@@ -128,9 +185,7 @@ class System:
                     for l in self.atoms[k].conn:
                         if l==j: continue
                         ijkl = [i,j,k,l]
-                        t,ijkl = sort_torsion([self.atoms[p].ff for p in ijkl], ijkl)
-                        if not t in types:
-                            types.append(t)
-                        dihed.append(AtomSet(ijkl, types.index(t)))
+                        r,ijkl = sort_torsion([rank[p] for p in ijkl], ijkl)
+                        dihed.append(AtomSet(ijkl, types.rank_id(r, names)))
         return dihed, types
         
\ No newline at end of file
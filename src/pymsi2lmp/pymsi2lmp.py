@@ -6,48 +6,285 @@
         Jay Oswald: j-oswald@asu.edu
                 
     SYNOPSIS
-        pymsi2lmp.py [-i INPUTPATH] [-frc COMPASSPATH]
+        pymsi2lmp.py [-i INPUTPATH] [-frc COMPASSPATH] [-stream] [-np N]
+                     [-compiled] [-perceive] [-gzip] [-npz] [-missing JSONPATH]
+                     [-timing PATH]
+        pymsi2lmp.py -batch PATH [PATH ...] [-frc COMPASSPATH] [-stream] [-np N]
+                     [-workers N] [-compiled] [-perceive] [-gzip] [-npz]
+                     [-missing JSONPATH] [-timing PATH]
         
     DESCRIPTION
         Converts INPUTPATH.mdf and INPUTPATH.car to INPUTPATH.lammps using the
-        COMPASS forcefield parameters specified by COMPASSPATH.
+        COMPASS forcefield parameters specified by COMPASSPATH.  If there is
+        no INPUTPATH.mdf, the bonds are perceived from the coordinates of
+        INPUTPATH.car (see -perceive).  Bonds of unphysical lengths, to the
+        nearest image in a periodic box, are reported before the data file
+        is written.  A periodic box with angles other than 90 degrees is
+        written as a triclinic box.
         
         -i INPUTFILE
             Basename of files exported by Materials Studio.  If left blank, the
-            first *.mdf found by glob will be used.
+            first *.mdf (or else *.car) found by glob will be used.
             
         -frc COMPASS PATH
             Specifies the location of the frc parameter file.  If compass.frc is
             located in the working path, then it will be used as a default.    
+            Files ending in .gz are decompressed, and - reads the frc file from
+            standard input.
+
+        -stream
+            Builds the topology with the array engine and writes each section
+            of the data file straight from the arrays in large chunks.  The
+            output is the same, but memory use is much lower on large models.
+
+        -np N
+            Implies -stream, and enumerates the terms of the topology on
+            chunks of atoms in N processes.  The output is the same.  In
+            batch mode, the models are then converted one at a time, as the
+            worker processes of -workers cannot start processes of their
+            own.
+
+        -compiled
+            Resolves the parameters of every type of the system once, through
+            equivalences and wildcards, into dense tables, from which the
+            coefficients are gathered.  The output is the same.
+
+        -perceive
+            Ignores the mdf file and perceives the bonds from the coordinates:
+            atoms closer than the sum of their covalent radii plus 0.45
+            Angstrom are bonded, with the elements of their types in the frc
+            file.  Periodic boxes are wrapped.  Charges are read from the car
+            file.
+
+        -batch PATH [PATH ...]
+            Converts many models.  Each PATH is the basename of a model or a
+            directory, which is searched recursively for models (a .car,
+            with a .mdf if there is one).  The frc file is parsed once and
+            shared by a pool of worker processes, which convert models in
+            parallel.  A summary of the missing parameters and time taken is
+            printed for each model.
+
+        -workers N
+            Converts N models at a time in batch mode (default one per cpu,
+            or one with -np).
+
+        -gzip
+            Writes the data file gzipped, as INPUTPATH.lammps.gz.  LAMMPS
+            reads it directly if it was built with gzip support.
+
+        -npz
+            Also writes the sections of the data file as arrays to
+            INPUTPATH.npz (see bundle.py), which other tools can map into
+            memory instead of parsing the data file.
+
+        -missing JSONPATH
+            Writes the missing parameters to JSONPATH, as a list of records
+            with the interaction, its frc section, the atom types and the
+            number of terms that need the parameter.  In batch mode, the
+            lists are written in an object keyed by model.
+
+        -timing PATH
+            Writes the wall time, rise in peak memory and counts (atoms,
+            terms, types and parameter lookups) of each stage of the
+            conversion to PATH as JSON, or to standard error if PATH is -.
+            In batch mode, the stages of each model are written in an object
+            keyed by model.  Setting the environment variable PYMSI2LMP_TIMING
+            to PATH does the same.
 """
+import os
+import sys
 import glob
+import time
+import json
+import multiprocessing
 import insight
 import lammps_writer
 import frc
+import frc2lmp
+import timing
+from cStringIO import StringIO
 
-def msi2lmp(rootname, frcpath):
-    system  = insight.get_system(rootname) 
-    compass = frc.Frc(frcpath)
-    missing = lammps_writer.write_data(system, compass)
+def msi2lmp(rootname, frcpath, stream=False, processes=1, compiled=False,
+            perceive=False, compress=False, binary=False):
+    with timing.stage('read frc') as counts:
+        compass = frc.Frc(frcpath)
+        counts['types'] = len(compass.types)
+    system  = insight.get_system(rootname, perceive, compass) 
+    missing = lammps_writer.write_data(system, compass, stream, processes,
+                                       compiled, compress, binary)
     return missing
 
+# Converts a model repeatedly with different force field parameters, e.g.
+# while fitting them.  The system and its topology are kept, and the header,
+# atoms and terms of the data file are formatted once, so that a conversion
+# only formats the Masses and Coeffs sections.
+class Session:
+    def __init__(self, rootname, stream=False, compiled=False):
+        self.system = insight.get_system(rootname)
+        self.writer = lammps_writer.DataWriter(self.system, stream, 1, compiled)
+        head, body  = StringIO(), StringIO()
+        self.writer.write_header(head)
+        self.writer.write_body(body)
+        self.head, self.body = head.getvalue(), body.getvalue()
+
+    # Writes the data file (rootname.lammps by default, gzipped if path ends
+    # in .gz) with the parameters of compass (a frc.Frc), returns the missing
+    # parameters.  If binary is true, the bundle of the data file is also
+    # written, to rootname.npz by default (see bundle.py).
+    def convert(self, compass, path=None, binary=False):
+        path = path or self.system.title+'.lammps'
+        fid  = lammps_writer.open_data(path)
+        fid.write(self.head)
+        missing = self.writer.write_coeffs(fid, compass)
+        fid.write(self.body)
+        fid.close()
+        if binary: self.writer.write_bundle(bundle_path(path))
+        return missing
+
+# Returns the path of the bundle of the data file at path, e.g. a.npz for
+# a.lammps or a.lammps.gz.
+def bundle_path(path):
+    for ext in ['.gz', '.lammps']:
+        if path.endswith(ext): path = path[:-len(ext)]
+    return path + '.npz'
+
+# Returns the basenames of the models in paths, each being a basename, a
+# .car or .mdf file, or a directory searched recursively for .car files.
+def find_models(paths):
+    models = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for f in sorted(files):
+                    if f.endswith('.car'): models.append(os.path.join(root, f[:-4]))
+        elif path.endswith('.car') or path.endswith('.mdf'):
+            models.append(path[:-4])
+        else:
+            models.append(path)
+    return models
+
+# Force field shared by the worker processes of a batch.  It is set before
+# the pool is made, so that the workers inherit it instead of parsing it.
+shared_frc = None
+
+# Converts one model in a worker process.  Returns the basename, the number
+# of atoms, the missing parameters, the time taken, an error message, which
+# is None if the model was converted, and the records of the timed stages
+# of the model (see timing.py).
+def convert_model(task):
+    base, stream, processes, compiled, perceive, compress, binary = task
+    t0 = time.time()
+    with timing.apart() as stages:
+        try:
+            system  = insight.get_system(base, perceive, shared_frc)
+            missing = lammps_writer.write_data(system, shared_frc, stream,
+                                               processes, compiled, compress,
+                                               binary)
+            result  = len(system.atoms), missing, None
+        except (Exception, SystemExit), e:
+            result  = 0, None, '%s: %s' %(type(e).__name__, e)
+    natoms, missing, error = result
+    return base, natoms, missing, time.time()-t0, error, stages
+
+# Converts the models in paths (see find_models) with the frc file at
+# frcpath, in a pool of worker processes (by default one per cpu), each
+# model with its topology enumerated in the given number of processes (see
+# msi2lmp).  As pool workers cannot start processes, models are converted
+# one at a time in this process if processes is more than 1.  Prints a
+# summary of each model and returns the results of convert_model.
+def batch(paths, frcpath, stream=False, processes=1, compiled=False,
+          perceive=False, compress=False, binary=False, workers=None):
+    global shared_frc
+    if processes > 1:
+        if workers > 1:
+            print '-np and -workers cannot both be more than 1 in batch mode.'
+            sys.exit(1)
+        workers = 1
+    models = find_models(paths)
+    with timing.stage('read frc') as counts:
+        shared_frc = frc.Frc(frcpath)
+        counts['types'] = len(shared_frc.types)
+    if not workers: workers = multiprocessing.cpu_count()
+    tasks = [(base, stream, processes, compiled, perceive, compress, binary)
+             for base in models]
+    if workers == 1:
+        results = map(convert_model, tasks)
+    else:
+        pool = multiprocessing.Pool(min(workers, max(len(models), 1)))
+        try:
+            # A timeout on get keeps the run interruptible by Ctrl-C.
+            results = pool.map_async(convert_model, tasks, 1).get(1e9)
+        finally:
+            pool.terminate()
+    print '%-40s %8s %8s %10s  %s' %('model', 'atoms', 'missing', 'time (s)',
+                                     'missing by interaction')
+    for base, natoms, missing, t, error, stages in results:
+        if error:
+            print '%-40s %8s %8s %10.2f  %s' %(base, '-', '-', t, error)
+            continue
+        print '%-40s %8d %8d %10.2f  %s' %(base, natoms, len(missing), t,
+                                          missing_summary(missing))
+    return results
+
+# Returns the number of missing parameters of each interaction, e.g. 'b:2'.
+def missing_summary(missing):
+    counts = {}
+    for m in missing: counts[m[0]] = counts.get(m[0], 0) + 1
+    return ' '.join('%s:%d' %(k, counts[k]) for k in sorted(counts))
+
 def main(args):
     # Default frc path.
     frcpath = 'compass.frc'
+    stream  = False
+    compiled  = False
+    perceive  = False
+    compress  = False
+    binary    = False
+    processes = None
+    workers   = None
+    paths     = []
+    jsonpath  = None
     # Sets a default rootname.
-    mdf = glob.glob('*.mdf')
+    mdf = glob.glob('*.mdf') or glob.glob('*.car')
     if len(mdf) > 0: rootname = mdf[0][:-4]
 
     # Input arguments
     for i in range(1, len(args)):
         if args[i] == '-i':     rootname = args[i+1]
         elif args[i] == '-frc': frcpath  = args[i+1]
+        elif args[i] == '-stream': stream = True
+        elif args[i] == '-np': processes = int(args[i+1])
+        elif args[i] == '-workers': workers = int(args[i+1])
+        elif args[i] == '-compiled': compiled = True
+        elif args[i] == '-perceive': perceive = True
+        elif args[i] == '-gzip': compress = True
+        elif args[i] == '-npz': binary = True
+        elif args[i] == '-missing': jsonpath = args[i+1]
+        elif args[i] == '-timing': timing.enable(args[i+1])
+        elif args[i] == '-batch':
+            for path in args[i+1:]:
+                if path.startswith('-'): break
+                paths.append(path)
         else: continue
+    if frcpath == '-': frcpath = sys.stdin
+    if processes: stream = True
+    if paths:
+        results = batch(paths, frcpath, stream, processes or 1, compiled,
+                        perceive, compress, binary, workers)
+        if jsonpath:
+            records = dict((r[0], r[2].records()) for r in results if not r[4])
+            json.dump(records, open(jsonpath, 'w'), indent=1, sort_keys=True)
+        timing.write(dict((r[0], r[5]) for r in results))
+        return results
 
-    missing = msi2lmp(rootname, frcpath)
+    missing = msi2lmp(rootname, frcpath, stream, processes or 1, compiled,
+                      perceive, compress, binary)
+    if jsonpath: missing.write_json(jsonpath)
     for m in missing: 
         term = frc.compass_key[m[0]][0][1::]
-        print 'Unable to find', term, 'data for', ' '.join(m[1])
+        print 'Unable to find', term, 'data for', ' '.join(frc2lmp.type_list(m[1]))
+    timing.write()
     
     
 if __name__ == '__main__':
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+ timing.py - lightweight timing of the stages of a conversion.  When timing
+             is enabled, each stage records its wall time, how much it
+             raised the peak memory of the process and counts such as terms
+             or parameter lookups.  Stages with the same name are
+             accumulated, so that repeated conversions (e.g. while fitting)
+             do not grow the report.  Timing is enabled with pymsi2lmp.py
+             -timing PATH, or by setting PYMSI2LMP_TIMING to the path of the
+             JSON report ('-' for stderr, which keeps it apart from the
+             messages of the conversion).  When it is disabled, a stage does
+             nothing but run its block.
+"""
+import os
+import sys
+import json
+import time
+import resource
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Path of the report, None if timing is disabled.
+path   = os.environ.get('PYMSI2LMP_TIMING') or None
+# Stage name -> accumulated record, in the order stages first ran.
+stages = OrderedDict()
+start  = time.time()
+
+# Enables timing, with the report written to path by write.
+def enable(report_path):
+    global path, start
+    path  = report_path
+    start = time.time()
+    stages.clear()
+
+# Returns the peak resident memory of the process in bytes.
+def peak_memory():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': return rss
+    return 1024*rss
+
+# Times the block of a with statement as the stage name.  The block is given
+# a dictionary to which counts can be added, e.g. counts['terms'] = n.
+@contextmanager
+def stage(name):
+    counts = {}
+    if path is None:
+        yield counts
+        return
+    t0, m0 = time.time(), peak_memory()
+    yield counts
+    t, rise = time.time() - t0, peak_memory() - m0
+    record = stages.get(name)
+    if record is None:
+        record = stages[name] = OrderedDict([('stage', name), ('calls', 0),
+                                             ('seconds', 0.0),
+                                             ('peak_memory_rise', 0),
+                                             ('counts', {})])
+    record['calls']      += 1
+    record['seconds']    += t
+    record['peak_memory_rise'] = max(record['peak_memory_rise'], rise)
+    for k, n in counts.items():
+        record['counts'][k] = record['counts'].get(k, 0) + n
+
+# Adds the parameter lookups of frc (a frc.Frc) made since the lookup
+# counters were before (see Frc.lookup_stats) to counts.
+def add_lookups(counts, frc, before):
+    for k, n in frc.lookup_stats().items():
+        if n != before.get(k, 0): counts['lookup_' + k] = n - before.get(k, 0)
+
+# Times the block of a with statement apart from the other stages, e.g. to
+# report each model of a batch apart.  The block is given a list, which is
+# filled with the records of the stages it ran; the stages run before it
+# are kept.
+@contextmanager
+def apart():
+    outer   = stages.values()
+    records = []
+    stages.clear()
+    try:
+        yield records
+    finally:
+        records.extend(stages.values())
+        stages.clear()
+        for record in outer: stages[record['stage']] = record
+
+# Returns the report: the wall time since timing was enabled, the peak
+# memory of the process and the records of its stages.  models, if given,
+# maps the name of each model converted elsewhere (e.g. in a worker process)
+# to the records of its stages.
+def report(models=None):
+    r = OrderedDict([('command',      ' '.join(sys.argv)),
+                     ('seconds',      time.time() - start),
+                     ('peak_memory',  peak_memory()),
+                     ('stages',       stages.values())])
+    if models is not None: r['models'] = models
+    return r
+
+# Writes the report (see report) as JSON to the path given when timing was
+# enabled.
+def write(models=None):
+    if path is None: return
+    if path == '-': fid = sys.stderr
+    else:           fid = open(path, 'w')
+    json.dump(report(models), fid, indent=1)
+    fid.write('\n')
+    if fid is not sys.stderr: fid.close()
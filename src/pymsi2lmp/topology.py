@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""
+ topology.py - array based topology engine.  Connectivity is stored as a CSR
+               adjacency (indptr/indices int32 arrays) and the bonds, angles,
+               dihedrals and impropers are enumerated with vectorized NumPy
+               operations.  Each builder returns an (n_terms, k) array of atom
+               indices, an array of type indices and the table of types, with
+               the same term order and type numbering as the builders in
+               molecular.System.
+"""
+import numpy as np
+import multiprocessing
+import multiprocessing.sharedctypes
+from molecular import TypeTable, rank_types
+
+# Returns the CSR adjacency (indptr, indices) of a list of atoms.
+def csr(atoms):
+    degree = np.array([len(a.conn) for a in atoms], dtype=np.int32)
+    indptr = np.zeros(len(atoms)+1, dtype=np.int32)
+    np.cumsum(degree, out=indptr[1:])
+    indices = np.fromiter((j for a in atoms for j in a.conn), dtype=np.int32,
+                          count=indptr[-1])
+    return indptr, indices
+
+# For groups of size n, returns the group and the position within the group
+# of every member, e.g. n=[2,1] gives [0,0,1] and [0,1,0].
+def expand(n):
+    group = np.repeat(np.arange(len(n), dtype=np.int32), n)
+    start = np.cumsum(n) - n
+    local = np.arange(group.size, dtype=np.int32) - start[group]
+    return group, local
+
+# Reverses the rows of a and r where mask is true.
+def reverse_rows(a, r, mask):
+    a[mask] = a[mask, ::-1]
+    r[mask] = r[mask, ::-1]
+
+# Swaps columns i and j of a and r where mask is true.
+def swap_columns(a, r, i, j, mask):
+    a[mask, i], a[mask, j] = a[mask, j], a[mask, i]
+    r[mask, i], r[mask, j] = r[mask, j], r[mask, i]
+
+# Vectorized sort_bond_or_angle, the rows of ranks r are sorted in place.
+def sort_bond_or_angle(a, r):
+    reverse_rows(a, r, r[:,0] > r[:,-1])
+
+# Vectorized sort_torsion.
+def sort_torsion(a, r):
+    reverse_rows(a, r, (r[:,0] > r[:,3]) | ((r[:,0]==r[:,3]) & (r[:,1]>r[:,2])))
+
+# Vectorized sort_oop, the same three swaps are made on every row.
+def sort_oop(a, r):
+    for i,j in [(0,2), (0,3), (2,3)]:
+        swap_columns(a, r, i, j, r[:,i] < r[:,j])
+
+# Enumerators of the terms anchored on the atoms lo to hi-1 of a CSR
+# adjacency: the first atom of a bond, the center of an angle or improper
+# and the second atom of a dihedral.  Each returns a list of (n, k) arrays,
+# so that concatenating each array over chunks of atoms in order, and then
+# the arrays of the list, gives the terms of the whole system in order.
+
+# Returns the bonds ij with i <= j.
+def bond_rows(indptr, indices, lo, hi):
+    d = np.diff(indptr[lo:hi+1])
+    i = np.repeat(np.arange(lo, hi, dtype=np.int32), d)
+    j = indices[indptr[lo]:indptr[hi]]
+    keep = i <= j
+    return [np.column_stack((i[keep], j[keep]))]
+
+# Returns the angles ijk centered on atom j.
+def angle_rows(indptr, indices, lo, hi):
+    d = np.diff(indptr[lo:hi+1])
+    j, c = expand(d*d)
+    start = indptr[lo+j]
+    i = indices[start + c//d[j]]
+    k = indices[start + c%d[j]]
+    keep = k > i
+    return [np.column_stack((i[keep], lo+j[keep], k[keep]))]
+
+# Returns the dihedrals ijkl about the bonds jk with j < k.
+def dihedral_rows(indptr, indices, lo, hi):
+    j = np.repeat(np.arange(lo, hi, dtype=np.int32), np.diff(indptr[lo:hi+1]))
+    k = indices[indptr[lo]:indptr[hi]]
+    keep = j < k
+    j, k = j[keep], k[keep]
+    dk = indptr[k+1] - indptr[k]
+    e, c = expand((indptr[j+1] - indptr[j])*dk)
+    j, k, dk = j[e], k[e], dk[e]
+    i = indices[indptr[j] + c//dk]
+    l = indices[indptr[k] + c%dk]
+    keep = (i != k) & (l != j)
+    return [np.column_stack((i[keep], j[keep], k[keep], l[keep]))]
+
+# Returns the impropers centered on atoms with 3 neighbors, and the four
+# impropers centered on each atom with 4 neighbors.
+def improper_rows(indptr, indices, lo, hi):
+    d, p = np.diff(indptr[lo:hi+1]), indptr
+    j = lo + np.flatnonzero(d==3).astype(np.int32)
+    n = indices[p[j][:,None] + np.arange(3)]
+    oop3 = np.column_stack((n[:,0], j, n[:,1], n[:,2]))
+    j = lo + np.flatnonzero(d==4).astype(np.int32)
+    n = indices[p[j][:,None] + np.arange(4)]
+    oop4 = np.empty((len(j), 4, 4), dtype=np.int32)
+    for q,(a,b,c) in enumerate([(1,2,3), (0,2,3), (0,1,3), (0,1,2)]):
+        oop4[:,q] = np.column_stack((n[:,a], j, n[:,b], n[:,c]))
+    return [oop3.reshape(-1, 4), oop4.reshape(-1, 4)]
+
+# Enumerator and canonical ordering of each kind of term.
+builders = {'bonds':     (bond_rows,     sort_bond_or_angle),
+            'angles':    (angle_rows,    sort_bond_or_angle),
+            'dihedrals': (dihedral_rows, sort_torsion),
+            'impropers': (improper_rows, sort_oop)}
+
+# Returns the canonically ordered terms of a kind anchored on atoms lo to
+# hi-1, as a list of arrays (see bond_rows).
+def chunk_terms(name, indptr, indices, rank, lo, hi):
+    rows, sort = builders[name]
+    parts = []
+    for a in rows(indptr, indices, lo, hi):
+        a = a.astype(np.int32)
+        sort(a, rank[a])
+        parts.append(a)
+    return parts
+
+# Returns a copy of an int32 array in shared memory, which is inherited by
+# the worker processes of a pool rather than copied to each one.
+def shared_array(a):
+    raw = multiprocessing.sharedctypes.RawArray('i', len(a))
+    s   = np.frombuffer(raw, dtype=np.int32)
+    s[:] = a
+    return raw, s
+
+# CSR adjacency and atom type ranks of the worker processes of a pool.
+shared = None
+
+# Sets the shared arrays of a new worker process.
+def init_worker(indptr, indices, rank):
+    global shared
+    shared = [np.frombuffer(raw, dtype=np.int32) for raw in (indptr, indices, rank)]
+
+# Returns the terms of a chunk of atoms (name, lo, hi) in a worker process.
+def run_chunk(task):
+    name, lo, hi = task
+    return chunk_terms(name, *(shared + [lo, hi]))
+
+# Atom types are ranked by name (see molecular.rank_types), so that ranks
+# compare as the fftype strings do in the frc.sort_* functions.  If
+# processes is more than 1, the terms are enumerated on chunks of chunk
+# atoms (by default 4 chunks per process) in a pool of that many worker
+# processes, with the adjacency in shared memory.  The chunks are merged in
+# order and types are numbered after merging, so the result is identical.
+# The pool is started by the first builder and used by the others until
+# close is called.
+class Topology:
+    def __init__(self, system, processes=1, chunk=None):
+        self.names, rank = rank_types(system.atoms)
+        self.rank = np.array(rank, dtype=np.int32)
+        self.indptr, self.indices = csr(system.atoms)
+        self.degree = np.diff(self.indptr)
+        self.processes = processes
+        self.chunk     = chunk
+        self.pool      = None
+        if processes > 1:
+            self.raw = []
+            for name in ['indptr', 'indices', 'rank']:
+                raw, a = shared_array(getattr(self, name))
+                self.raw.append(raw)
+                setattr(self, name, a)
+
+    # Returns the (lo, hi) atom ranges of the chunks.
+    def chunks(self):
+        n = len(self.rank)
+        chunk = self.chunk or max(1, -(-n // (4*self.processes)))
+        return [(lo, min(lo+chunk, n)) for lo in range(0, n, chunk)]
+
+    # Returns the canonically ordered terms of a kind, as a list of arrays.
+    def terms(self, name):
+        n = len(self.rank)
+        if self.processes <= 1 or n == 0:
+            return chunk_terms(name, self.indptr, self.indices, self.rank, 0, n)
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes, init_worker, self.raw)
+        try:
+            # A timeout on get keeps the run interruptible by Ctrl-C.
+            tasks  = [(name, lo, hi) for lo, hi in self.chunks()]
+            chunks = self.pool.map_async(run_chunk, tasks).get(1e9)
+        except:
+            self.close()
+            raise
+        return [np.concatenate([c[p] for c in chunks])
+                for p in range(len(chunks[0]))]
+
+    # Stops the worker processes, if any.
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __del__(self):
+        self.close()
+
+    # Numbers the rows of type ranks r in the order they first appear.
+    # Returns the type index of each row and the table of types.
+    def number_types(self, r):
+        types = TypeTable()
+        if len(r) == 0:
+            return np.zeros(0, dtype=np.int32), types
+        # Packs each row of ranks into a single integer key.
+        key = np.zeros(len(r), dtype=np.int64)
+        for c in range(r.shape[1]):
+            key = key*len(self.names) + r[:,c]
+        unique, first, inverse = np.unique(key, return_index=True,
+                                           return_inverse=True)
+        order  = np.argsort(first)
+        number = np.empty(len(order), dtype=np.int32)
+        number[order] = np.arange(len(order), dtype=np.int32)
+        for i in first[order]:
+            types.rank_id(r[i].tolist(), self.names)
+        return number[inverse], types
+
+    # Returns the terms of a kind with their types.
+    def finish(self, name):
+        a = np.vstack(self.terms(name))
+        tid, types = self.number_types(self.rank[a])
+        return a, tid, types
+
+    # Returns the type index of each atom and the table of atom types.
+    def atom_types(self):
+        types = TypeTable()
+        names = [self.names[p] for p in self.rank]
+        tid   = np.array([types.id(t) for t in names], dtype=np.int32)
+        return tid, types
+
+    # Each builder returns an (n_terms, k) array of atom indices, the type
+    # index of each term and the table of types (see bond_rows etc.).
+    def bonds(self):     return self.finish('bonds')
+    def angles(self):    return self.finish('angles')
+    def dihedrals(self): return self.finish('dihedrals')
+    def impropers(self): return self.finish('impropers')